@@ -49,18 +49,12 @@ img = Image.open(image_path)
 left_data, right_data = dlpyc900.load_bmp_halves_as_1bit_array(img, com = True)
 
 
-compression = True
-comp = 0
-left_data = left_data.flatten()
-right_data = right_data.flatten()
-
-if compression is True:
-    left_data = dlpyc900.run_length_encode(left_data)
-    right_data = dlpyc900.run_length_encode(right_data)
-    comp = 1
+# RLE with the 48 byte header, the size includes the header
+left_data, left_size = dlpyc900.run_length_encode([left_data])
+right_data, right_size = dlpyc900.run_length_encode([right_data])
 
 # Load bmp file
-dlp.initialize_pattern_bmp_load_fix(0, len(left_data),  len(right_data))
+dlp.initialize_pattern_bmp_load_fix(0, left_size, right_size)
 dlp.pattern_bmp_load_fix(left_data, right_data)
 
 # Start running the patterns  
@@ -1,5 +1,6 @@
 from .dlp import *
 from .dlp_errors import *
+from .cache import frame_cache
 
 
 AUTHOR = "Piet J.M. Swinkels"
\ No newline at end of file
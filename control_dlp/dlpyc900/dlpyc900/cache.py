@@ -0,0 +1,104 @@
+'''
+on-disk cache of encoded images, so images which are uploaded repeatedly only need to be encoded once
+'''
+
+import hashlib
+import os
+from pathlib import Path
+import numpy as np
+
+
+class frame_cache:
+    '''
+    encoded images stored as files named by a hash of the image and the encoding settings
+
+    when the files exceed max_bytes in total, the least recently used are deleted. Entries are written to a
+    temporary file which is then renamed, so the cache can be shared between processes
+
+    the total size is counted once and then kept up to date by put(), so the directory is only scanned when the
+    cache is full. Entries added by other processes are counted at the next scan. When the cache is full, entries
+    are deleted until it is below evict_fraction of max_bytes, so the next entries do not scan it again
+    '''
+    evict_fraction = 0.9
+
+    def __init__(self, cache_dir, max_bytes=2**30):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.total_bytes = sum(size for _, size, _ in self._entries())
+
+    @staticmethod
+    def key(image, *settings):
+        '''
+        hash of the image data, shape and dtype, and of the settings which determine the encoded bytes
+        '''
+        image = np.ascontiguousarray(image)
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f'{image.shape}{image.dtype.str}{settings!r}'.encode())
+        h.update(image.data)
+        return h.hexdigest()
+
+    def get(self, key):
+        '''
+        encoded bytes, or None if they are not in the cache
+        '''
+        fname = self.cache_dir / f'{key}.bin'
+        try:
+            data = fname.read_bytes()
+            # mark as recently used
+            os.utime(fname)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key, data):
+        '''
+        store the encoded bytes under key, deleting the least recently used entries if the cache is then too large
+        '''
+        fname = self.cache_dir / f'{key}.bin'
+        fname_temp = self.cache_dir / f'{key}.{os.getpid()}.tmp'
+        fname_temp.write_bytes(data)
+        try:
+            # an entry which is replaced no longer counts
+            self.total_bytes -= fname.stat().st_size
+        except FileNotFoundError:
+            pass
+        os.replace(fname_temp, fname)
+        self.total_bytes += len(data)
+        if self.total_bytes > self.max_bytes:
+            self.evict(int(self.evict_fraction * self.max_bytes))
+
+    def _entries(self):
+        '''
+        (modification time, size, file name) of all entries
+        '''
+        entries = []
+        for fname in self.cache_dir.glob('*.bin'):
+            try:
+                stat = fname.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, fname))
+        return entries
+
+    def evict(self, max_bytes=None):
+        '''
+        delete least recently used entries until the cache is smaller than max_bytes, by default self.max_bytes
+        '''
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = self._entries()
+        self.total_bytes = sum(e[1] for e in entries)
+        for _, size, fname in sorted(entries):
+            if self.total_bytes <= max_bytes:
+                break
+            fname.unlink(missing_ok=True)
+            self.total_bytes -= size
+
+    def clear(self):
+        '''
+        delete all entries
+        '''
+        for fname in self.cache_dir.glob('*.bin'):
+            fname.unlink(missing_ok=True)
+        self.total_bytes = 0
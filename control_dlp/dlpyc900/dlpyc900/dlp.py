@@ -6,17 +6,16 @@ Please see the example folder in this repo, which explains a bit more how this w
 
 ### TODO - 각 함수 수정. 헤더 함수 추가. send_command 최적화 필요. compression 함수 추가 필요. 
 
-import usb.core
-import usb.util
 import time
+import struct
 import numpy
 import sys, os
-from dlpyc900.erle import encode, get_header
+from dlpyc900.erle import encode, encode_rle, get_header, geometry, models
 from dlpyc900.dlp_errors import *
+from dlpyc900.transport import pyusb_transport, pack_command
 import array
 import itertools
 import numpy as np
-from tqdm import tqdm
 
 def bits_to_bytes(bits: str) -> list[int]:
     """Convert a string of bits to a list of bytes."""
@@ -80,38 +79,56 @@ def pack_bits_to_bytes(binary_array: np.ndarray) -> bytes:
     # 8개씩 그룹 → 바이트로 변환
     flat = flat.reshape(-1, 8)
     packed = np.packbits(flat, axis=1)
-    return packed.flatten().tolist()
+    return packed.tobytes()
 
-def run_length_encode(binary_data: np.ndarray) -> list:
+def run_length_encode(images) -> tuple[bytearray, int]:
     """
-    Run-Length Encoding for 1-bit data
+    Run-Length Encoding (RLE) of up to 24 binary images of one controller, in the format described in section
+    2.4.3.1 of the user guide. Returns (encoded, size) with the 48 byte header, like erle.encode(), ready for
+    initialize_pattern_bmp_load_fix() and pattern_bmp_load_fix(). See erle.encode_rle()
     """
-    if len(binary_data) == 0:
-        return []
+    return encode_rle(images)
 
-    encoded = []
-    current_value = binary_data[0]
-    count = 1
-
-    for val in binary_data[1:]:
-        if val == current_value and count < 255:
-            count += 1
+def split_payloads(data, header: bytes = b'', size: int = 504):
+    """
+    Split header + data into PATMEM_LOAD_DATA payloads of a 2 byte length followed by at most size bytes.
+    The payloads are built from memoryview slices, data is never copied as a whole.
+    """
+    try:
+        data = memoryview(data).cast('B')
+    except TypeError:
+        data = memoryview(bytes(data))
+    header = bytes(header)
+    total = len(header) + len(data)
+    for i in range(0, total, size):
+        j = min(i + size, total)
+        if i < len(header):
+            chunk = header[i:j] + data[:max(j - len(header), 0)]
         else:
-            encoded.extend([count, current_value])
-            current_value = val
-            count = 1
-    encoded.extend([count, current_value])
-    return encoded
+            chunk = data[i - len(header):j - len(header)]
+        yield struct.pack('<H', len(chunk)) + chunk
 
 
 
 class dmd():
     """
     DMD controller class
+
+    cache is an optional cache.frame_cache. Images uploaded with pattern_bmp_load_images() are then only encoded
+    the first time
+
+    transport is a transport.dlpc900_transport, by default a pyusb_transport for the first DMD found. Commands are
+    framed with transport.pack_command(), as in the dlpc900_dmd classes of control_dlp_v2, so both drivers send
+    the same packets. Use a transport.fake_transport to run without a DMD
     """
-    def __init__(self):
-        self.dev=usb.core.find(idVendor=0x0451 ,idProduct=0xc900 )
-        self.dev.set_configuration()
+    # time to wait for a reply, in ms
+    reply_timeout = 1000
+
+    def __init__(self, cache=None, transport=None):
+        self.cache = cache
+        self.transport = pyusb_transport() if transport is None else transport
+        # sequence byte of the last command, see send_command()
+        self.sequence_byte = 0
         self.current_mode = "pattern"
         self.display_modes = {'video':0, 'pattern':1, 'video-pattern':2, 'otf':3}
         self.display_modes_inv = {0:'video', 1:'pattern', 2:'video-pattern', 3:'otf'}
@@ -139,71 +156,68 @@ class dmd():
         mode : char
             'r' for read, 'w' for write
         sequence_byte : int
-            A byte to identify the command sequence, so you know what reply belongs to what command. Choose arbitrary number that fits in 1 byte.
+            Not used, kept so existing calls keep working. Each command gets the next value of the sequence_byte
+            attribute, so every reply can be matched to its command.
         command : int
             The command to be sent (16-bit integer), as found in the user guide. For instance '0x0200'
-        payload : int, optional
-            List of data bytes associated with the command. Leave empty when reading. Often just a simple number to set a mode, e.g. [1] for option 1. If more complex, you need to craft the byte(s) yourself.
+        payload : bytes, optional
+            Data bytes associated with the command, as bytes-like object or list of ints. Leave empty when reading. Often just a simple number to set a mode, e.g. [1] for option 1. If more complex, you need to craft the byte(s) yourself.
+
+        Raises
+        ------
+        DMDerror
+            If no reply to a read arrives within reply_timeout ms, or the reply has the error flag set
         """
         if payload is None:
-            payload = []
-
-        buffer = []
-
-        # Flag Byte
-        flag_string = '1' if mode == 'r' else '0'
-        flag_string += '1000000'
-        buffer.append(bits_to_bytes(flag_string)[0])
-
-        # Sequence Byte
-        buffer.append(sequence_byte)
-
-        # Length Bytes (payload length + 2 command bytes)
-        temp = bits_to_bytes(number_to_bits(len(payload) + 2, 16))
-        buffer.append(temp[0])
-        buffer.append(temp[1])
-
-        # Command Bytes (little-endian order)
-        buffer.append(command & 0xFF)         # Lower byte
-        buffer.append((command >> 8) & 0xFF)  # Upper byte
-
-        # Add data to buffer
-        if len(buffer) + len(payload) < 65:
-            buffer.extend(payload)
-            buffer.extend([0x00] * (64 - len(buffer)))
-            try:
-                self.dev.write(1, buffer)
-            except usb.USBError:
-                # sometimes timouts occur. If that happens, just wait a very short time and rerun, that will fix the issue in a good 90% of the cases.
-                time.sleep(0.1)
-                self.dev.write(1, buffer)
-        else:
-            remaining_data = payload
-            buffer.extend(remaining_data[:58])
-            self.dev.write(1, buffer)
-            remaining_data = remaining_data[58:]
-
-            while len(remaining_data) > 0:
-                chunk = remaining_data[:64]
-                remaining_data = remaining_data[64:]
-                if len(chunk) < 64:
-                    chunk.extend([0x00] * (64 - len(chunk)))
-                try:
-                    self.dev.write(1, chunk)
-                except usb.USBError:
-                    # sometimes timouts occur. If that happens, just wait a very short time and rerun, that will fix the issue in a good 90% of the cases.
-                    time.sleep(0.1)
-                    self.dev.write(1, chunk)
-        # read reply if required
+            payload = b''
+        sequence_byte = self._next_sequence_byte()
+
+        # Flag Byte. Reads set the read and reply bits, writes neither, as their replies would never be read
+        flag_string = '11' if mode == 'r' else '00'
+        flag_string += '000000'
+
+        # Flag Byte, Sequence Byte, Length Bytes (payload length + 2 command bytes), Command Bytes (little-endian order)
+        # and the data, padded to whole 64 byte packets
+        buffer = memoryview(pack_command(bits_to_bytes(flag_string)[0], sequence_byte, command, payload))
+        for i in range(0, len(buffer), 64):
+            self.transport.write(buffer[i:i + 64])
+
+        # read reply if required. The transport's read returns None when nothing arrives within the timeout,
+        # replies to earlier commands which timed out are skipped using the sequence byte
         if mode == 'r':
-            time.sleep(0.1) # give it some processing time...
-            answer = self.dev.read(0x81, 64)
+            answer = self.transport.read(self.reply_timeout / 1000)
+            while answer is not None and answer[1] != sequence_byte:
+                answer = self.transport.read(self.reply_timeout / 1000)
+            if answer is None:
+                raise DMDerror(f'No reply to command {command:#06x} within {self.reply_timeout} ms')
             if not answer[0]:
                 raise DMDerror('DMD reply has error flag set!')
         else:
             answer = None
         return parse_reply(answer)
 
+    def _next_sequence_byte(self) -> int:
+        self.sequence_byte = (self.sequence_byte + 1) % 256
+        return self.sequence_byte
+
+    def send_write_commands(self, command: int, payloads):
+        """
+        Send the same write command with each of the payloads, e.g. the PATMEM_LOAD_DATA payloads from
+        split_payloads(). The commands are framed as in send_command() and written as one stream of packets with
+        the transport's write_packets(), which the pyusb transport sends in large transfers.
+
+        Parameters
+        ----------
+        command : int
+            The command to be sent (16-bit integer), as found in the user guide
+        payloads : iterable
+            Data bytes of each command, as bytes-like objects or lists of ints
+        """
+        buffer = bytearray()
+        for payload in payloads:
+            buffer += pack_command(bits_to_bytes('00000000')[0], self._next_sequence_byte(), command, payload)
+        self.transport.write_packets(buffer)
+
 ## status commands (section 2.1)
     def get_hardware_status(self) -> tuple[str, int]:
         """
@@ -378,9 +392,7 @@ class dmd():
         tuple[int,int,int,int]
             data_port, px_clock, data_enable, vhsync. See set_port_clock_definition doc for their definitions.
         """
-        seq_byte = 243
-        answer = self.send_command('r', seq_byte, 0x1A03, [])
-        assert answer[2] == seq_byte, "received answer does not match command issued"
+        answer = self.send_command('r', 243, 0x1A03, [])
         data = answer[-1][0]
         data_port = data & 0x03
         px_clock = (data >> 2) & 0x03
@@ -416,9 +428,7 @@ class dmd():
         tuple[int,int]
             source, bitdepth. See set_input_source doc for their definitions.
         """
-        seq_byte = 112
-        answer = self.send_command('r', seq_byte, 0x1A00, [])
-        assert answer[2] == seq_byte, "received answer does not match command issued"
+        answer = self.send_command('r', 112, 0x1A00, [])
         data = answer[-1][0]
         source = data & 0x07
         bitdepth = (data >> 3) & 0x03
@@ -688,48 +698,19 @@ class dmd():
         5:2 bytes 
             31:0 bits - compressed bmp data
         """
-        primary_header = [0x53, 0x70, 0x6C, 0x64]
-        secondary_header = [0x53, 0x70, 0x6C, 0x64]
+        # headers are built once per geometry, only the number of bytes differs
+        # this was written for the DLP9000, which is assumed if the hardware is not a known model
+        width, height = geometry(self.hardware if self.hardware in models else 'DLP9000')
 
-        primary_header += bits_to_bytes(number_to_bits(int(2048/2) ,bitlen = 16)) #width
-        secondary_header += bits_to_bytes(number_to_bits(int(2048/2) ,bitlen = 16)) #width
+        primary_header = get_header(width, height, compression)
+        secondary_header = get_header(width, height, compression)
 
-        primary_header += bits_to_bytes(number_to_bits(1200,bitlen = 16)) #height
-        secondary_header += bits_to_bytes(number_to_bits(1200,bitlen = 16)) #height
+        struct.pack_into('<I', primary_header, 8, len(left_img))
+        struct.pack_into('<I', secondary_header, 8, len(right_img))
 
-        primary_header += bits_to_bytes(number_to_bits(len(left_img) ,bitlen = 32))
-        secondary_header += bits_to_bytes(number_to_bits(len(right_img) ,bitlen = 32))
-
-        background_color = [0x00, 0x00, 0x00, 0x00] 
-
-        primary_header += [0xFF] * 8 + background_color
-        secondary_header += [0xFF] * 8 + background_color
-
-        primary_header += [0x00] + [compression] + [0x01] + [0x00] *21
-        secondary_header += [0x00] + [compression] + [0x01] + [0x00] *21
-
-        primary_data = primary_header + left_img
-        secondary_data = secondary_header + right_img
-
-        primary_payload = []
-        secondary_payload = []
-        
-
-        for i in range(0, len(primary_data), 504):
-            primary = primary_data[i:i + 504]
-            secondary = secondary_data[i:i + 504]
-            primary_payload.append(bits_to_bytes(number_to_bits(len(primary),bitlen = 16)) + primary)
-            secondary_payload.append(bits_to_bytes(number_to_bits(len(secondary),bitlen = 16)) + secondary)
-
-
-        length = len(secondary_payload)
-
-        for i in tqdm(range(0, length)):
-            self.send_command('w', 31, 0x1A2D, secondary_payload[i])
-
-
-        for i in tqdm(range(0, length)):
-            self.send_command('w', 30, 0x1A2B, primary_payload[i])
+        # header is sent in front of the image data, without concatenating the two
+        self.send_write_commands(0x1A2D, split_payloads(right_img, secondary_header))
+        self.send_write_commands(0x1A2B, split_payloads(left_img, primary_header))
 
 
         # if len(primary_data)%504 == 0:
@@ -751,30 +732,8 @@ class dmd():
             5:2 bytes 
                 31:0 bits - compressed bmp data
             """
-            primary_data, secondary_data = list(primary_data), list(secondary_data)
-    
-
-            primary_payload = []
-            secondary_payload = []
-            
-
-            for i in range(0, len(primary_data), 504):
-                primary = primary_data[i:i + 504]
-                secondary = secondary_data[i:i + 504]
-                primary_payload.append(bits_to_bytes(number_to_bits(len(primary),bitlen = 16)) + primary)
-                secondary_payload.append(bits_to_bytes(number_to_bits(len(secondary),bitlen = 16)) + secondary)
-
-                # print(i)
-
-            length = len(secondary_payload)
-            for i in tqdm(range(0, length)):
-                # print("before send command")
-                self.send_command('w', 150 + i , 0x1A2D, secondary_payload[i])
-                # print("Send ", i ," commands")
-
-            length = len(primary_payload)
-            for i in tqdm(range(0, length)):
-                self.send_command('w', 100 + i, 0x1A2B, primary_payload[i])
+            self.send_write_commands(0x1A2D, split_payloads(secondary_data))
+            self.send_write_commands(0x1A2B, split_payloads(primary_data))
 
             # if len(primary_data)%504 == 0:
             #     pass
@@ -819,29 +778,32 @@ class dmd():
                 The rest of bits - reserved(filled 0)
             5:2 bytes 
                 31:0 bits - compressed bmp data
-            """
-            # data = list(data)
-
-            data_payload = []
-              
-
-            for i in range(0, len(data), 504):
-                d = data[i:i + 504]
-                data_payload.append(bits_to_bytes(number_to_bits(len(d),bitlen = 16)) + d)
-
-            length = len(data_payload)
 
+            data is sent as it is, so it is not looked up in self.cache. Use pattern_bmp_load_images() to encode
+            images with the cache.
+            """
             if primary == True:
                 command = 0x1A2B
             else:
                 command = 0x1A2D
 
-
-            for i in tqdm(range(0, length)):
-                seq = (50 + i)%256
-                self.send_command('w', seq, command, data_payload[i])
+            self.send_write_commands(command, split_payloads(data))
      
 
+    def pattern_bmp_load_images(self, image_index, images, primary = True, optimal = False):
+            """
+            Encode up to 24 binary images for one controller with erle.encode() and upload them as image
+            image_index, with initialize_pattern_bmp_load_v2() and pattern_bmp_load_v2().
+
+            Images found in self.cache are not encoded again, and newly encoded images are added to it.
+            optimal=True gives fewer bytes but encodes slower, see erle.tokenize_optimal().
+            Returns the number of bytes uploaded.
+            """
+            encoded, size = encode(images, optimal=optimal, cache=self.cache)
+            self.initialize_pattern_bmp_load_v2(image_index, size, primary)
+            self.pattern_bmp_load_v2(encoded, primary)
+            return size
+
     def initialize_pattern_bmp_load_v2(self, image_index, size, primary = True):
             """
             이미지의 데이터가 크기 떄문에, 컨트롤러에 upload할 이미지 데이터를 받아들일 준비를 해야한다. 
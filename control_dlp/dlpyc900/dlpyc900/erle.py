@@ -5,24 +5,46 @@ https://github.com/e841018/ERLE
 @author Ashu
 '''
 
-# encode image of shape (n<=24, 1200, 1920) with Enhanced Run-Length Encoding (ERLE) described in http://www.ti.com/lit/pdf/dlpu018
+# encode image of shape (n<=24, height, width) with Enhanced Run-Length Encoding (ERLE) described in http://www.ti.com/lit/pdf/dlpu018
 
+import functools
+import math
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import struct
 pack32be = struct.Struct('>I').pack  # uint32 big endian
 
+# width, height and number of controllers of each DMD model, as in the dlp6500 and dlp9000 classes of dmd.py
+models = {
+    'DLP6500': (1920, 1080, 1),
+    'DLP9000': (2048, 1200, 2),
+    'DLP500YX': (2048, 1200, 2),
+}
 
-def get_header():
+
+def geometry(model):
     '''
-    generate header defined in section 2.4.2
+    (width, height) of the image sent to each controller of a DMD model in models
+    '''
+    try:
+        width, height, n_controllers = models[model]
+    except KeyError:
+        raise ValueError(f'unknown DMD model {model!r}, must be one of {list(models)}') from None
+    return width // n_controllers, height
+
+
+@functools.lru_cache(maxsize=None)
+def _header(width, height, compression):
+    '''
+    header defined in section 2.4.2, built once for each geometry and compression
     '''
     header = bytearray(0)
     # signature
     header += bytearray([0x53, 0x70, 0x6c, 0x64])
     # width
-    header += bytearray([1024 % 256, 1024//256])
+    header += struct.pack('<H', width)
     # height
-    header += bytearray([1200 % 256, 1200//256])
+    header += struct.pack('<H', height)
     # number of bytes, will be overwritten later
     header += bytearray(4)
     # reserved
@@ -32,30 +54,69 @@ def get_header():
     # reserved
     header.append(0)
     # compression, 0=Uncompressed, 1=RLE, 2=Enhanced RLE
-    header.append(2)
+    header.append(compression)
     # reserved
     header.append(1)
     header += bytearray(21)
-    return header
+    return bytes(header)
+
+
+def get_header(width=1024, height=1200, compression=2):
+    '''
+    generate header defined in section 2.4.2
+    '''
+    return bytearray(_header(width, height, compression))
 
 header_template = get_header()
 
 
-def merge(images):
+def merge(images, out=None):
     '''
     merge up to 24 binary images into a single 24-bit image, each pixel is an uint32 of format 0x00BBGGRR
+
+    out can be given to reuse an uint32 array of shape (height, width)
     '''
-    image32 = np.zeros((1200, 1024), dtype=np.uint32)
-    n_img = len(images)
-    batches = [8]*(n_img//8)
-    if n_img % 8:
-        batches.append(n_img % 8)
-    for i, batch_size in enumerate(batches):
-        image8 = np.zeros((1200, 1024), dtype=np.uint8)
-        for j in range(batch_size):
-            image8 += images[i*8+j]*(1 << j)
-        image32 += image8*(1 << (i*8))
-    return image32
+    if len(images) > 24:
+        raise ValueError('at most 24 images can be merged into one image, use merge_stack() for more')
+    return merge_stack(images, out=None if out is None else out[None])[0]
+
+
+def merge_stack(images, out=None):
+    '''
+    merge n binary images into ceil(n/24) 24-bit images, shape = (ceil(n/24), height, width)
+
+    image 24*k + j is stored in bit j of image k. Each byte of the merged images is built from 8 images at a time
+    with uint8 shifts, so only one uint8 temporary is needed for the whole stack. out can be given to reuse an
+    uint32 array of that shape
+    '''
+    images = np.asarray(images)
+    if images.dtype == bool:
+        images = images.view(np.uint8)
+    n_img = images.shape[0]
+    # any shape is allowed after the first axis, e.g. (parts, height, width) for split images
+    shape = (-(-n_img // 24),) + images.shape[1:]
+    if out is None:
+        out = np.empty(shape, dtype='<u4')
+    elif out.shape != shape or out.dtype != np.dtype('<u4') or not out.flags.c_contiguous:
+        raise ValueError(f'out must be a contiguous uint32 array of shape {shape}')
+
+    # bytes RR GG BB 00 of each pixel
+    out_bytes = out.view(np.uint8).reshape(shape + (4,))
+    out_bytes[..., 3] = 0
+    byte = np.empty(shape, dtype=np.uint8)
+    shifted = np.empty_like(byte)
+    for i in range(3):
+        # images 24*k + 8*i + j for all k, the last merged image may have fewer
+        plane = images[8*i::24]
+        byte[:len(plane)] = plane
+        byte[len(plane):] = 0
+        for j in range(1, 8):
+            plane = images[8*i + j::24]
+            n = len(plane)
+            np.left_shift(plane, j, out=shifted[:n], casting='unsafe')
+            np.bitwise_or(byte[:n], shifted[:n], out=byte[:n])
+        out_bytes[..., i] = byte
+    return out
 
 
 def bgr(pixel):
@@ -89,18 +150,19 @@ def run_len(row, idx):
 
 def encode_row(row, same_prev):
     '''
-    encode a row of length 1920 with the format described in section 2.4.3.2
+    encode a row with the format described in section 2.4.3.2
     '''
-    # bool array indicating if same as previous row, shape = (1920, )
-#     same_prev = np.zeros(1920, dtype=bool) if i==0 else image[i]==image[i-1]
-    # bool array indicating if same as next element, shape = (1919, )
+    width = len(row)
+    # bool array indicating if same as previous row, shape = (width, )
+#     same_prev = np.zeros(width, dtype=bool) if i==0 else image[i]==image[i-1]
+    # bool array indicating if same as next element, shape = (width - 1, )
     same = np.logical_not(np.diff(row))
-    # same as previous row or same as next element, shape = (1919, )
-    same_either = np.logical_or(same_prev[:1023], same)
+    # same as previous row or same as next element, shape = (width - 1, )
+    same_either = np.logical_or(same_prev[:width-1], same)
 
     j = 0
     compressed = bytearray(0)
-    while j < 1024:
+    while j < width:
 
         # copy n pixels from previous line
         if same_prev[j]:
@@ -109,13 +171,13 @@ def encode_row(row, same_prev):
             compressed += b'\x00\x01' + enc128(r)
 
         # repeat single pixel n times
-        elif j < 1023 and same[j]:
+        elif j < width-1 and same[j]:
             r = run_len(same, j+1) + 2
             j += r
             compressed += enc128(r) + bgr(row[j-1])
 
         # single uncompressed pixel
-        elif j > 1021 or same_either[j+1]:
+        elif j > width-3 or same_either[j+1]:
             compressed += b'\x01' + bgr(row[j])
             j += 1
 
@@ -124,7 +186,7 @@ def encode_row(row, same_prev):
             j_start = j
             pixels = bgr(row[j]) + bgr(row[j+1])
             j += 2
-            while j == 1023 or not same_either[j]:
+            while j < width and (j == width-1 or not same_either[j]):
                 pixels += bgr(row[j])
                 j += 1
             compressed += b'\x00' + enc128(j-j_start) + pixels
@@ -132,24 +194,413 @@ def encode_row(row, same_prev):
     return compressed + b'\x00\x00'
 
 
-def encode(images):
+# token types used by the vectorized encoder, see encode()
+COPY, REPEAT, LITERAL, EOL = 0, 1, 2, 3
+
+
+def next_stop(mask):
     '''
-    encode image with the format described in section 2.4.3.2.1
+    index of the first False at or after each index of the flat bool array mask, which must end with False
+
+    True elements get an index past the end, which never is the minimum as a False element follows
     '''
-    # header
-    encoded = bytearray(header_template)
+    stop = np.multiply(mask, np.int32(mask.size), dtype=np.int32)
+    stop += np.arange(mask.size, dtype=np.int32)
+    return np.minimum.accumulate(stop[::-1])[::-1]
+
+
+def same_as_previous_row(image, out):
+    '''
+    set out[r, c] if pixel c of row r is the same as in row r-1, for an image of shape (height, width) or parts of
+    shape (n, height, width). The first row of each part has no previous row. out is a zeroed bool array of shape
+    (n*height, >= width), rows of all parts are stacked
+    '''
+    parts = image.reshape((-1,) + image.shape[-2:])
+    n, height, width = parts.shape
+    out = out.reshape(n, height, -1)
+    np.equal(parts[:, 1:], parts[:, :-1], out=out[:, 1:, :width])
+
+
+def tokenize(image):
+    '''
+    find the tokens of every row of image, using the same greedy rules as encode_row()
+
+    Pixels are indexed on a grid of shape (height, width+1), the extra column holds the end of line token.
+    The length of a token starting at each pixel is found with array operations, then the tokens of all rows are
+    followed at once, so the only loop is over the tokens of the longest row.
+
+    image can also have shape (n, height, width) for n parts which are encoded separately, e.g. the halves of a
+    DLP9000 image. Their rows are then stacked on the grid, and never copy from another part.
+
+    returns (starts, kind, length): flat grid index, token type and length in pixels of all tokens in order
+    '''
+    width = image.shape[-1]
+    height = image.size // width
+    stride = width + 1
+    size = height * stride
+
+    # bool array indicating if same as previous row, False in the extra column
+    same_prev = np.zeros((height, stride), dtype=bool)
+    same_as_previous_row(image, same_prev)
+    image = image.reshape(height, width)
+    # bool array indicating if same as next element, False for the last element
+    same = np.zeros((height, stride), dtype=bool)
+    np.equal(image[:, 1:], image[:, :-1], out=same[:, :width - 1])
+    # same as previous row or same as next element. The last element never ends a literal block,
+    # the extra column always does. Padded so that lookups may run past the last row.
+    same_either = np.ones(size + 2, dtype=bool)
+    grid = same_either[:size].reshape(height, stride)
+    np.logical_or(same_prev, same, out=grid)
+    grid[:, width - 1] = False
+    grid[:, width] = True
+    # single uncompressed pixel if the next pixel can be compressed, or near the end of the row
+    single = np.ones((height, stride), dtype=bool)
+    if width >= 2:
+        single[:, :width - 2] = grid[:, 1:width - 1]
+    single[:, width] = False
+
+    same_prev = same_prev.ravel()
+    same = same.ravel()
+    single = single.ravel()
+
+    # start of the token following one which starts at each pixel. The rules are applied in reverse order, each
+    # replacing the result where it applies, with arithmetic rather than np.where as it is much faster on bool masks
+    # multiple uncompressed pixels, up to the next pixel that can be compressed
+    # single uncompressed pixel, encoded as a repeat of length 1
+    # repeat single pixel n times
+    # copy n pixels from previous line
+    pixel = np.arange(size, dtype=np.int32)
+    following = np.empty(size + 1, dtype=np.int32)
+    after = following[:size]
+    after[:] = next_stop(~same_either)[2:]
+    for rule, stop in ((single, pixel + 1), (same, next_stop(same) + 1), (same_prev, next_stop(same_prev))):
+        stop -= after
+        stop *= rule
+        after += stop
+    # the end of line token is the last token of the row and leads to the extra element
+    following[width::stride] = size
+    following[size] = size
+
+    # the tokens of all rows are followed at once, until every row has reached its end of line
+    is_start = np.zeros(size + 1, dtype=bool)
+    pos = np.arange(height, dtype=np.int32) * stride
+    while True:
+        is_start[pos] = True
+        pos = following[pos]
+        if pos.min() == size:
+            break
+    is_start = is_start[:size]
+
+    starts = np.flatnonzero(is_start)
+    length = following[starts] - starts
+    # the token type is looked up from the rules which apply at its start
+    is_eol = np.zeros((height, stride), dtype=np.uint8)
+    is_eol[:, width] = 1
+    code = same_prev[starts].view(np.uint8) << 2
+    code |= (same[starts] | single[starts]).view(np.uint8) << 1
+    code |= is_eol.ravel()[starts]
+    kind = _token_kinds[code]
+    length *= kind != EOL
+    return starts, kind, length
+
+
+# token type from the rules at its start, indexed by copy << 2 | repeat << 1 | end of line
+_token_kinds = np.array([LITERAL, EOL, REPEAT, REPEAT, COPY, COPY, COPY, COPY], dtype=np.uint8)
+
+
+def tokenize_optimal(image):
+    '''
+    find the tokens of every row of image which give the fewest bytes, by dynamic programming along the rows
+
+    cost[k] is the fewest bytes needed for the first k pixels of each row. It never decreases with k, so a copy or
+    repeat ending at k is cheapest when it starts as early as possible, or at k-127 if it must stay below 128 pixels.
+    Uncompressed blocks ending at k only need the running minimum of cost[j] - 3*j over their starts j <= k-2.
+
+    the rows are handled together, but the columns one at a time, as each needs the costs of all columns before it.
+    This takes 3 to 4 times as long as tokenize(), about 100-140 ms for a DLP9000 half-frame on one core, so it is
+    not used unless asked for. It suits images which are encoded once and uploaded often, e.g. with a cache
+
+    returns (starts, kind, length) like tokenize(), and also accepts parts of shape (n, height, width)
+    '''
+    width = image.shape[-1]
+    height = image.size // width
+    stride = width + 1
+    rows = np.arange(height)
+    idx = np.arange(width, dtype=np.int32)[:, None]
+
+    # first pixel of the run of pixels which are the same as the previous row, containing each pixel
+    # (one past the pixel if it is not the same), shape = (width, height)
+    same_prev = np.zeros((height, width), dtype=bool)
+    same_as_previous_row(image, same_prev)
+    image = image.reshape(height, width)
+    copy_start = np.maximum.accumulate(np.where(same_prev.T, np.int32(0), idx + 1), axis=0)
+    # first pixel of the run of identical pixels, containing each pixel
+    run_start = np.ones((height, width), dtype=bool)
+    np.not_equal(image[:, 1:], image[:, :-1], out=run_start[:, 1:])
+    repeat_start = np.maximum.accumulate(np.where(run_start.T, idx, np.int32(0)), axis=0)
+
+    # cost, start and type of the last token of the first k pixels, shape = (width+1, height)
+    cost = np.zeros((width + 1, height), dtype=np.int32)
+    prev = np.zeros((width + 1, height), dtype=np.int32)
+    last = np.zeros((width + 1, height), dtype=np.uint8)
+    flat_cost = cost.ravel()
+
+    # candidates for the last token: short repeat, long repeat, short copy, long copy, uncompressed block.
+    # Costs are stored as cost*8 + candidate, so that the minimum also tells which candidate it is
+    kinds = np.array([REPEAT, REPEAT, COPY, COPY, LITERAL], dtype=np.uint8)
+    ctrl = (np.array([4, 5, 3, 4], dtype=np.int32) * 8 + np.arange(4, dtype=np.int32))[:, None]
+    never = np.int32(1 << 24)
+    j = np.zeros((5, height), dtype=np.int32)
+    c = np.zeros((5, height), dtype=np.int32)
+    flat_j = j.ravel()
+
+    # running minimum of cost[j] - 3*j over j <= k-2, and the last j reaching it
+    literal_min = np.full(height, never)
+    literal_arg = np.zeros(height, dtype=np.int32)
+
+    for k in range(1, width + 1):
+        if k >= 2:
+            v = cost[k - 2] - 3 * (k - 2)
+            lower = v <= literal_min
+            np.copyto(literal_min, v, where=lower)
+            np.copyto(literal_arg, k - 2, where=lower)
+
+        first = max(k - 127, 0)
+        np.maximum(repeat_start[k - 1], first, out=j[0])
+        j[1] = repeat_start[k - 1]
+        np.maximum(copy_start[k - 1], first, out=j[2])
+        j[3] = copy_start[k - 1]
+        j[4] = literal_arg
+
+        c[:4] = flat_cost[j[:4] * height + rows]
+        c[:4] *= 8
+        c[:4] += ctrl
+        # copies need at least one pixel, long tokens at least 128
+        c[2] += never * (j[2] == k)
+        if k > 127:
+            c[1] += never * (j[1] > k - 128)
+            c[3] += never * (j[3] > k - 128)
+        else:
+            c[1] = never
+            c[3] = never
+        # 0x00, 1-2 length bytes, 3 bytes per pixel. literal_arg is the last start reaching the minimum, so a block
+        # below 128 pixels reaches the minimum if and only if the block from literal_arg does
+        c[4] = (literal_min + 3 * k + 3 - (literal_arg > k - 128)) * 8 + 4
+
+        best = c.min(axis=0)
+        choice = best & 7
+        cost[k] = best >> 3
+        prev[k] = flat_j[choice * height + rows]
+        last[k] = kinds[choice]
+
+    # follow the chosen tokens back from the end of each row
+    is_start = np.zeros((height, stride), dtype=bool)
+    kind = np.zeros((height, stride), dtype=np.uint8)
+    length = np.zeros((height, stride), dtype=np.int32)
+    is_start[:, width] = True
+    kind[:, width] = EOL
+
+    pos = np.full(height, width)
+    while rows.size:
+        start = prev[pos, rows]
+        is_start[rows, start] = True
+        kind[rows, start] = last[pos, rows]
+        length[rows, start] = pos - start
+        keep = start > 0
+        rows = rows[keep]
+        pos = start[keep]
+
+    starts = np.flatnonzero(is_start)
+    return starts, kind.ravel()[starts], length.ravel()[starts]
+
+
+def emit(image, starts, kind, length, n_short=128, eol=True):
+    '''
+    write the tokens into a byte array, see tokenize() for the arguments
+
+    lengths below n_short take one byte and longer ones two, see enc128(). RLE lengths always take one byte, which
+    is written with n_short=256. With eol=False the end of line tokens are left out, the decoder then starts a new
+    row whenever a row is complete
+    '''
+    if not eol:
+        keep = kind != EOL
+        starts, kind, length = starts[keep], kind[keep], length[keep]
+    height, width = image.shape
+    length = length.astype(np.int64)
+    # index of the first pixel of each token in the flattened image
+    pixel = starts - starts // (width + 1)
+
+    two = length >= n_short
+    # the low byte of length | 0x80 is (length & 0x7f) | 0x80
+    lo = (length | (two << 7)).astype(np.uint8)
+    hi = (length >> 7).astype(np.uint8)
+
+    is_copy = kind == COPY
+    is_repeat = kind == REPEAT
+    is_literal = kind == LITERAL
+
+    n_ctrl = control_size(kind, length, n_short)
+    offset = np.zeros(len(starts) + 1, dtype=np.int64)
+    np.cumsum(token_size(kind, length, n_short), out=offset[1:])
+    body = offset[:-1] + n_ctrl
+    encoded = np.zeros(offset[-1], dtype=np.uint8)
+
+    # control bytes, zeros are already in place
+    # copy: 0x00 0x01 n, repeat: n pixel, literal: 0x00 n pixels, end of line: 0x00 0x00
+    # the first two bytes are written for all tokens at once, the second byte of a short repeat is overwritten by
+    # its pixel below
+    encoded[offset[:-1]] = lo * is_repeat
+    second = lo * is_literal
+    second |= hi * (is_repeat & two)
+    second |= is_copy
+    encoded[offset[:-1] + 1] = second
+    copy = np.flatnonzero(is_copy)
+    encoded[offset[copy] + 2] = lo[copy]
+    encoded[offset[copy[two[copy]]] + 3] = hi[copy[two[copy]]]
+    long_literal = np.flatnonzero(is_literal & two)
+    encoded[offset[long_literal] + 2] = hi[long_literal]
+
+    # repeated pixel value
+    src = pixel[is_repeat] + length[is_repeat] - 1
+    dst = body[is_repeat]
+    n_literal = length[is_literal]
+    if n_literal.sum() >= 64 * n_literal.size > 0:
+        # a few long blocks of uncompressed pixels, e.g. from noise, are copied as slices of the B G R bytes
+        bgr = np.ascontiguousarray(image, dtype='<u4').view(np.uint8).reshape(-1, 4)[:, 2::-1].ravel()
+        for p, n, d in zip(pixel[is_literal].tolist(), n_literal.tolist(), body[is_literal].tolist()):
+            encoded[d:d + 3*n] = bgr[3*p:3*(p + n)]
+    elif n_literal.size:
+        # uncompressed pixels. The shift from pixel index to output position is constant within a block
+        literal_src = np.repeat(pixel[is_literal] - offset_of(n_literal), n_literal)
+        literal_src += np.arange(len(literal_src))
+        literal_dst = np.repeat(body[is_literal] - 3 * pixel[is_literal], n_literal)
+        literal_dst += 3 * literal_src
+        src = np.concatenate((src, literal_src))
+        dst = np.concatenate((dst, literal_dst))
+
+    # pixels 0x00BBGGRR are written as BB GG RR, each is read once and its bytes are shifted out
+    pixels = np.ascontiguousarray(image, dtype='<u4').ravel()[src]
+    for c in range(3):
+        encoded[dst + c] = pixels >> (16 - 8*c)
+    return encoded
+
+
+def control_size(kind, length, n_short=128):
+    '''
+    number of control bytes of each token: copy 3-4, repeat 1-2, literal 2-3, end of line 2, see emit() for n_short
+    '''
+    return 2 + (length >= n_short) + (kind == COPY) - (kind == REPEAT)
+
+
+def token_size(kind, length, n_short=128):
+    '''
+    number of encoded bytes of each token, control bytes plus 3 bytes per pixel written
+    '''
+    n_pixels = (kind == LITERAL) * length + (kind == REPEAT)
+    return control_size(kind, length, n_short) + 3 * n_pixels
+
+
+def offset_of(counts):
+    '''
+    exclusive cumulative sum of counts
+    '''
+    offset = np.zeros(len(counts), dtype=np.int64)
+    np.cumsum(counts[:-1], out=offset[1:])
+    return offset
+
+
+def encode(images, optimal=False, cache=None, model=None, threads=1):
+    '''
+    encode image with the format described in section 2.4.3.2.1
+
+    produces the same bytes as calling encode_row() on every row, but finds the tokens of all rows with array
+    operations instead of walking each row pixel by pixel. With optimal=True, the tokens are chosen by
+    tokenize_optimal() instead, which gives the fewest bytes but is slower, see there
+
+    the images can have any size, which is written to the header. If model is given, e.g. 'DLP6500', the size is
+    checked against the image size for one controller of that model, see geometry()
+
+    cache is an optional cache.frame_cache. Images found in it are not encoded again, and new ones are added
 
-    # uint32 array, shape = (1200, 1920)
+    with threads > 1, blocks of rows are encoded in a pool of threads, see emit_blocks() for what this gains
+    '''
+    # uint32 array, shape = (height, width)
     image = merge(images)
+    height, width = image.shape
+    if model is not None and (width, height) != geometry(model):
+        raise ValueError(f'images have size {width}x{height}, but {model} expects {"x".join(map(str, geometry(model)))}')
+
+    if cache is not None:
+        key = cache.key(image, 'erle', optimal)
+        encoded = cache.get(key)
+        if encoded is not None:
+            return bytearray(encoded), len(encoded)
+
+    if threads > 1:
+        encoded, size = with_header(emit_blocks(image[None], threads, optimal)[0], width, height)
+    else:
+        tokens = tokenize_optimal(image) if optimal else tokenize(image)
+        encoded, size = finish(image, *tokens)
+
+    if cache is not None:
+        cache.put(key, encoded)
+
+    return encoded, len(encoded)
+
+
+def emit_rows(image, first, stop, optimal=False, eol=True):
+    '''
+    image content of rows first to stop, the same bytes as these rows get from emit() for the whole image, see there
+    for eol
+
+    the row above is tokenized together with the block, so the first row can copy from it, and its tokens are dropped
+    '''
+    top = max(first - 1, 0)
+    starts, kind, length = tokenize_optimal(image[top:stop]) if optimal else tokenize(image[top:stop])
+    if top < first:
+        stride = image.shape[1] + 1
+        keep = starts >= stride
+        starts, kind, length = starts[keep] - stride, kind[keep], length[keep]
+    return emit(image[first:stop], starts, kind, length, eol=eol)
 
-    # image content
-    for i in range(1200):
-        # bool array indicating if same as previous row, shape = (1920, )
-        same_prev = np.zeros(1024, dtype=bool) if i == 0 else image[i] == image[i-1]
-        encoded += encode_row(image[i], same_prev)
 
-    # end of image
-    encoded += b'\x00\x01\x00'
+def emit_blocks(parts, threads, optimal=False, eol=True):
+    '''
+    image content of each of the parts of shape (n, height, width), like emit()
+
+    each part is split into one block of rows per thread, and the blocks are encoded with emit_rows() in a pool of
+    threads. The bytes are the same as without threads. NumPy releases the GIL in much of the work, so encoding one
+    image may take less time on several cores. This has only been timed on one core, where a DLP9000 frame split in
+    two takes the same time with 1, 2 or 4 threads (about 300 ms for sparse noise, 165 ms for gratings), so the pool
+    costs nothing measurable there, but the gain on several cores is not known
+    '''
+    n_parts, height, _ = parts.shape
+    bounds = np.linspace(0, height, min(threads, height) + 1).astype(int)
+    blocks = [(i, first, stop) for i in range(n_parts) for first, stop in zip(bounds[:-1], bounds[1:])]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        encoded = list(pool.map(lambda b: emit_rows(parts[b[0]], b[1], b[2], optimal, eol), blocks))
+    n_blocks = len(bounds) - 1
+    return [np.concatenate(encoded[i*n_blocks:(i+1)*n_blocks]) for i in range(n_parts)]
+
+
+def finish(image, starts, kind, length):
+    '''
+    header, image content from emit(), end of image and padding, returns (encoded, size) like encode()
+    '''
+    height, width = image.shape
+    return with_header(emit(image, starts, kind, length), width, height)
+
+
+def with_header(body, width, height, compression=2):
+    '''
+    header, encoded image content body, end of image and padding, returns (encoded, size) like encode()
+
+    compression is 2 for ERLE and 1 for RLE, which has a shorter end of image
+    '''
+    # header, image content, end of image
+    encoded = get_header(width, height, compression)
+    encoded += memoryview(body)
+    encoded += b'\x00\x01\x00' if compression == 2 else b'\x00\x01'
 
     # pad to 4-byte boundary
     encoded += bytearray((-len(encoded)) % 4)
@@ -159,3 +610,298 @@ def encode(images):
     struct.pack_into('<I', encoded, 8, len(encoded))
 
     return encoded, len(encoded)
+
+
+def encode_split(images, n_parts=2, optimal=False, flipud=False, threads=1):
+    '''
+    encode full width images for a DMD with several controllers, e.g. the primary (left) and secondary (right) halves
+    of a DLP9000, in a single pass
+
+    the images are merged straight into one array per part, and the tokens of all parts are found together, so the
+    row comparisons are shared. With flipud=True, the images are flipped upside down as a view, without copying.
+    returns a list with (encoded, size) for each part, the same as calling encode() on each part. threads is the
+    same as for encode()
+    '''
+    images = np.asarray(images)
+    if flipud:
+        images = images[:, ::-1]
+    n_img, height, width = images.shape
+    if width % n_parts:
+        raise ValueError(f'image width {width} cannot be split into {n_parts} parts')
+    part_width = width // n_parts
+
+    # shape = (n_parts, height, part_width)
+    parts = merge(images.reshape(n_img, height, n_parts, part_width).transpose(0, 2, 1, 3))
+    if threads > 1:
+        return [with_header(body, part_width, height) for body in emit_blocks(parts, threads, optimal)]
+
+    tokens = tokenize_optimal(parts) if optimal else tokenize(parts)
+    return [with_header(body, part_width, height) for body in emit_parts(parts, *tokens)]
+
+
+def emit_parts(parts, starts, kind, length, n_short=128, eol=True):
+    '''
+    image content of each of the parts of shape (n, height, width), from the tokens of all parts found together by
+    tokenize() or tokenize_optimal(). The tokens of each part are contiguous, so they are split at the part
+    boundaries and written with emit(), see there for n_short and eol
+    '''
+    n_parts, height, width = parts.shape
+    part_size = height * (width + 1)
+    bounds = np.searchsorted(starts, part_size * np.arange(n_parts + 1))
+    encoded = []
+    for i in range(n_parts):
+        tokens = slice(bounds[i], bounds[i+1])
+        encoded.append(emit(parts[i], starts[tokens] - i*part_size, kind[tokens], length[tokens], n_short, eol))
+    return encoded
+
+
+def tokenize_rle(image):
+    '''
+    find the tokens of every row of image for run-length encoding (RLE), described in section 2.4.3.1
+
+    runs of two or more equal pixels are repeats, and consecutive single pixels are sent uncompressed. Lengths are
+    one byte, so longer runs are split into pieces of 255 pixels. A lone single pixel, also one left over when
+    splitting uncompressed pixels, is a repeat of length 1. RLE has no copy tokens.
+
+    returns (starts, kind, length) on the same grid as tokenize()
+    '''
+    height, width = image.shape
+    size = height * width
+
+    # runs of equal pixels, each row starts a new run
+    run_start = np.ones((height, width), dtype=bool)
+    np.not_equal(image[:, 1:], image[:, :-1], out=run_start[:, 1:])
+    starts = np.flatnonzero(run_start)
+    single = np.diff(starts, append=size) == 1
+
+    # consecutive single pixels in a row are merged into one block
+    merged = np.zeros(len(starts), dtype=bool)
+    merged[1:] = single[1:] & single[:-1] & (starts[1:] % width != 0)
+    is_literal = single[~merged]
+    starts = starts[~merged]
+    lengths = np.diff(starts, append=size)
+
+    # split into pieces of at most 255 pixels
+    n_pieces = -(-lengths // 255)
+    block = np.repeat(np.arange(len(starts)), n_pieces)
+    k = np.arange(len(block)) - np.repeat(offset_of(n_pieces), n_pieces)
+    piece_start = starts[block] + 255 * k
+    length = np.minimum(lengths[block] - 255 * k, 255)
+    kind = np.where(is_literal[block] & (length > 1), LITERAL, REPEAT)
+
+    # end of line tokens in the extra column of the grid
+    piece_start += piece_start // width
+    eol = np.arange(height) * (width + 1) + width
+    order = np.argsort(np.concatenate((piece_start, eol)), kind='stable')
+    starts = np.concatenate((piece_start, eol))[order]
+    kind = np.concatenate((kind, np.full(height, EOL)))[order]
+    length = np.concatenate((length, np.zeros(height, dtype=length.dtype)))[order]
+    return starts, kind, length
+
+
+def encode_rle(images):
+    '''
+    encode image with run-length encoding (RLE), see tokenize_rle(). Returns (encoded, size) like encode()
+
+    RLE lengths are one byte and there are no copy tokens, so it is larger than ERLE for most images, but it is
+    cheaper to encode
+    '''
+    image = merge(images)
+    height, width = image.shape
+    starts, kind, length = tokenize_rle(image)
+    return with_header(emit(image, starts, kind, length, n_short=256), width, height, compression=1)
+
+
+def encode_raw(images):
+    '''
+    uncompressed image, three bytes B G R for each pixel. Returns (encoded, size) like encode()
+
+    nothing has to be encoded, so the pixel bytes are copied once, straight from the merged image into the
+    encoded bytes after the header
+    '''
+    image = merge(images)
+    height, width = image.shape
+    n_bytes = 3 * width * height
+    encoded = get_header(width, height, compression=0)
+    n_header = len(encoded)
+    # pixels and padding to 4-byte boundary, uncompressed images have no end of image
+    encoded += bytearray(n_bytes + (-n_bytes) % 4)
+    pixels = np.frombuffer(encoded, dtype=np.uint8, count=n_bytes, offset=n_header)
+    pixels.reshape(height, width, 3)[:] = image.view(np.uint8).reshape(height, width, 4)[..., 2::-1]
+    struct.pack_into('<I', encoded, 8, len(encoded))
+    return encoded, len(encoded)
+
+
+class encoded_frame:
+    '''
+    encoded 24-bit image which can be updated without encoding it again from scratch
+
+    the tokens of a row only depend on the row and the row before it, through the copy tokens. The encoded bytes
+    of each row are kept with their offsets, and updating bit planes or rows re-encodes only the rows which
+    changed and the rows after them, then splices the new bytes into the encoded image. Changed rows are found by
+    comparing with the stored merged image, which is exact and cheaper than hashing the rows
+    '''
+
+    def __init__(self, images, optimal=False):
+        # uint32 array, shape = (height, width)
+        self.image = merge(images)
+        self.optimal = optimal
+        self.height, self.width = self.image.shape
+        # encoded image content without header and end of image. Row r is body[row_offset[r]:row_offset[r+1]]
+        self.body = None
+        self.row_offset = np.zeros(self.height + 1, dtype=np.int64)
+        self._reencode(np.arange(self.height))
+
+    def set_planes(self, planes, bits=None, row=0):
+        '''
+        replace bit planes of the image, or a band of rows of them
+
+        planes has shape (n, rows, width) and replaces bits (default 0, ..., n-1) of rows row, ..., row+rows-1
+        '''
+        planes = np.asarray(planes)
+        if bits is None:
+            bits = range(len(planes))
+        if len(bits) != len(planes):
+            raise ValueError(f'got {len(planes)} planes for {len(bits)} bits')
+        if row < 0 or row + planes.shape[1] > self.height or planes.shape[2] != self.width:
+            raise ValueError(f'planes of shape {planes.shape[1:]} starting at row {row} do not fit in image of '
+                             f'shape {self.image.shape}')
+        mask = np.uint32(sum(1 << b for b in bits))
+        # place each plane in its bit with merge_stack, which puts plane j in bit j
+        stack = np.zeros((24,) + planes.shape[1:], dtype=np.uint8)
+        stack[list(bits)] = planes
+        band = self.image[row:row + planes.shape[1]]
+        self.set_rows((band & ~mask) | merge(stack), row)
+
+    def set_rows(self, rows, row=0):
+        '''
+        replace rows row, ..., row+len(rows)-1 of the merged image, rows is an uint32 array of format 0x00BBGGRR
+        '''
+        rows = np.asarray(rows, dtype='<u4')
+        band = self.image[row:row + len(rows)]
+        if row < 0 or band.shape != rows.shape:
+            raise ValueError(f'rows of shape {rows.shape} starting at row {row} do not fit in image of shape '
+                             f'{self.image.shape}')
+        changed = np.zeros(self.height + 1, dtype=bool)
+        np.any(band != rows, axis=1, out=changed[row:row + len(rows)])
+        band[:] = rows
+        # the copy tokens of the next row refer to the changed row
+        changed[1:] |= changed[:-1]
+        self._reencode(np.flatnonzero(changed[:self.height]))
+
+    def _reencode(self, dirty):
+        '''
+        encode the rows in the sorted array dirty, and splice them into body
+        '''
+        if not dirty.size:
+            return
+        if dirty.size == self.height:
+            starts, kind, length = tokenize_optimal(self.image) if self.optimal else tokenize(self.image)
+            self.body = emit(self.image, starts, kind, length)
+            row_size = np.bincount(starts // (self.width + 1), weights=token_size(kind, length), minlength=self.height)
+            np.cumsum(row_size.astype(np.int64), out=self.row_offset[1:])
+            return
+
+        # each row is encoded as the second row of a part with its previous row, so all rows are tokenized at once.
+        # Row 0 has no previous row, its part gets a row with bits set above bit 23, which never equals a pixel
+        pairs = np.empty((len(dirty), 2, self.width), dtype='<u4')
+        pairs[:, 1] = self.image[dirty]
+        pairs[:, 0] = self.image[dirty - 1]
+        if dirty[0] == 0:
+            pairs[0, 0] = self.image[0] | 0xff000000
+        starts, kind, length = tokenize_optimal(pairs) if self.optimal else tokenize(pairs)
+
+        # drop the tokens of the previous rows
+        row = starts // (self.width + 1)
+        keep = row % 2 == 1
+        starts, kind, length, row = starts[keep], kind[keep], length[keep], row[keep]
+        encoded = emit(pairs.reshape(-1, self.width), starts, kind, length)
+        row_size = np.bincount(row // 2, weights=token_size(kind, length), minlength=len(dirty)).astype(np.int64)
+
+        # new bytes of each row, and old bytes in between. Unchanged bytes are copied once
+        new_offset = np.zeros(len(dirty) + 1, dtype=np.int64)
+        np.cumsum(row_size, out=new_offset[1:])
+        pieces = []
+        end = 0
+        for i, r in enumerate(dirty):
+            pieces.append(self.body[self.row_offset[end]:self.row_offset[r]])
+            pieces.append(encoded[new_offset[i]:new_offset[i + 1]])
+            end = r + 1
+        pieces.append(self.body[self.row_offset[end]:])
+        self.body = np.concatenate(pieces)
+
+        sizes = np.diff(self.row_offset)
+        sizes[dirty] = row_size
+        np.cumsum(sizes, out=self.row_offset[1:])
+
+    def encode(self):
+        '''
+        encoded image with header, returns (encoded, size) like encode()
+        '''
+        return with_header(self.body, self.width, self.height)
+
+
+class grating:
+    '''
+    binary grating, pixel (x, y) is on if (a*x + b*y + offset) mod period < duty
+
+    all parameters are integers, so the grating is exactly periodic. (a, b) sets the direction, e.g. (1, 0) for
+    lines along y, the period perpendicular to the lines is period / sqrt(a**2 + b**2) pixels, and offset shifts
+    the phase in steps of 1/period, e.g. for phase-shifted SIM patterns. duty defaults to half the period
+    '''
+
+    def __init__(self, a, b, period, duty=None, offset=0):
+        self.a = a
+        self.b = b
+        self.period = period
+        self.duty = period // 2 if duty is None else duty
+        self.offset = offset
+
+    @property
+    def row_period(self):
+        '''
+        number of rows after which the rows repeat
+        '''
+        return self.period // math.gcd(self.b, self.period)
+
+    def rows(self, y, width):
+        '''
+        rows y of the grating, bool array of shape (len(y), width)
+        '''
+        x = np.arange(width, dtype=np.int64)
+        y = np.asarray(y, dtype=np.int64)[:, None]
+        return (self.a * x + self.b * y + self.offset) % self.period < self.duty
+
+    def image(self, width, height):
+        '''
+        the full grating, bool array of shape (height, width)
+        '''
+        return self.rows(np.arange(height), width)
+
+
+def encode_gratings(gratings, width, height, optimal=False):
+    '''
+    encode gratings without drawing the full images, yields (encoded, size) like encode() for each group of 24
+
+    the rows of each group repeat after the least common multiple q of the row periods of its gratings, and the
+    tokens of a row only depend on the row and the row before it. So only the first q+1 rows are drawn and encoded,
+    and the encoded bytes of rows 1, ..., q are repeated for the rest of the image
+    '''
+    for i in range(0, len(gratings), 24):
+        group = gratings[i:i + 24]
+        q = math.lcm(*[g.row_period for g in group])
+        n_rows = min(height, q + 1)
+        image = merge([g.rows(np.arange(n_rows), width) for g in group])
+        starts, kind, length = tokenize_optimal(image) if optimal else tokenize(image)
+        body = emit(image, starts, kind, length)
+        if n_rows == height:
+            yield with_header(body, width, height)
+            continue
+
+        # end of the bytes of each row
+        row_end = np.cumsum(np.bincount(starts // (width + 1), weights=token_size(kind, length), minlength=n_rows))
+        row_end = row_end.astype(np.int64)
+        first = body[:row_end[0]].tobytes()
+        period = body[row_end[0]:].tobytes()
+        repeats, remainder = divmod(height - 1, q)
+        yield with_header(first + period * repeats + period[:row_end[remainder] - row_end[0]], width, height)
@@ -0,0 +1,379 @@
+"""
+USB transports for the DLPC900, shared by dlpyc900.dlp.dmd and the dlpc900_dmd classes in control_dlp_v2/dmd.py.
+A transport moves 64 byte HID packets to and from the device, and pack_command() builds the packets of a command,
+so both drivers frame commands and upload patterns the same way.
+"""
+from typing import Optional
+import sys
+import os
+import select
+import threading
+import time
+from struct import pack, unpack_from
+from pathlib import Path
+from warnings import warn
+
+try:
+    import pywinusb.hid as pyhid
+except ImportError:
+    pyhid = None
+    if sys.platform == "win32":
+        warn("pywinusb could not be imported")
+
+try:
+    import usb.core
+    import usb.util
+except ImportError:
+    usb = None
+
+
+def pack_command(flag_byte: int,
+                 sequence_byte: int,
+                 command: int,
+                 data=b"",
+                 packet_length: int = 64) -> bytearray:
+    """
+    Build the packets of one command: the flag byte, the sequence byte, the length of the data plus the two command
+    bytes, the command, and the data, padded with zeros to whole packets
+
+    :param flag_byte: bit 7 is set for reads, bit 6 requests a reply, bits 0-2 give the destination
+    :param sequence_byte: returned in the reply, to match it to the command
+    :param command: two byte USB command number
+    :param data: bytes-like object, or list of integers where each integer gives a byte
+    :param packet_length: USB packet length
+    :return buffer:
+    """
+    buffer = bytearray(pack('<BBHH', flag_byte, sequence_byte, len(data) + 2, command))
+    buffer.extend(data)
+    buffer.extend(bytes(-len(buffer) % packet_length))
+    return buffer
+
+
+class dlpc900_transport:
+    """
+    Interface for moving 64 byte USB HID packets to and from a DLPC900. dlpc900_dmd builds all commands and pattern
+    uploads on top of write() and read(), so the backends only differ in how packets reach the device. Backends are
+    chosen by name with the transport argument of dlpc900_dmd, see transport_backends.
+    """
+
+    # USB packet length not including report_id_byte
+    packet_length = 64
+
+    # path identifying the device, e.g. the HID path. Used as hid_path by dlpc900_dmd
+    path = None
+
+    def write(self, packet):
+        """
+        Send one packet
+
+        :param packet: bytes-like object of length packet_length
+        """
+        raise NotImplementedError()
+
+    def write_packets(self, buffer):
+        """
+        Send consecutive packets, e.g. the commands queued by dlpc900_dmd.batch()
+
+        :param buffer: bytes-like object whose length is a multiple of packet_length
+        """
+        buffer = memoryview(buffer).cast("B")
+        for ii in range(0, len(buffer), self.packet_length):
+            self.write(buffer[ii:ii + self.packet_length])
+
+    def read(self, timeout: Optional[float] = 5) -> Optional[list]:
+        """
+        Wait for one reply packet
+
+        :param timeout: timeout in seconds. If None, wait indefinitely
+        :return reply: list of bytes, or None if no reply was received before the timeout
+        """
+        raise NotImplementedError()
+
+    def clear(self):
+        """
+        Discard replies which have been received but not read
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+class pywinusb_transport(dlpc900_transport):
+    """
+    Windows HID transport using pywinusb. Replies are received on a pywinusb thread and collected in a list. The
+    thread signals a condition variable, so read() returns as soon as a reply arrives instead of polling
+    """
+
+    def __init__(self,
+                 vendor_id: int = 0x0451,
+                 product_id: int = 0xc900,
+                 dmd_index: int = 0,
+                 hid_path: Optional[str] = None):
+        """
+        :param vendor_id: vendor id, used to find DMD USB device
+        :param product_id: product id, used to find DMD USB device
+        :param dmd_index: If multiple DMD's are attached, choose this one. Indexing starts at zero
+        :param hid_path: HID device path. If provided, it overrides dmd_index
+        """
+        if pyhid is None:
+            raise ImportError("pywinusb is required for the pywinusb transport")
+
+        if hid_path is None:
+            devices = pyhid.HidDeviceFilter(vendor_id=vendor_id,
+                                           product_id=product_id).get_devices()
+            devices = [d for d in devices if d.product_name == "DLPC900"]
+
+            if len(devices) <= dmd_index:
+                raise ValueError(f"Not enough DMD's detected for dmd_index={dmd_index:d}."
+                                 f"Only {len(devices):d} DMD's were detected.")
+            self._device = devices[dmd_index]
+        else:
+            self._device = pyhid.HidDevice(hid_path)
+        self.path = self._device.device_path
+
+        self._device.open()
+        self._responses = []
+        self._reply_received = threading.Condition()
+        self._device.set_raw_data_handler(self._handle_data)
+        # the output report is looked up once, instead of for every packet
+        self._report = self._device.find_output_reports()[0]
+
+    def _handle_data(self, data):
+        # strip off first return byte and add rest to the responses
+        with self._reply_received:
+            self._responses.append(data[1:])
+            self._reply_received.notify()
+
+    def write(self, packet):
+        report_id_byte = b"\x00"
+        self._report.send(report_id_byte + bytes(packet))
+
+    def read(self, timeout: Optional[float] = 5) -> Optional[list]:
+        with self._reply_received:
+            if not self._reply_received.wait_for(lambda: self._responses != [], timeout):
+                print('read command timed out')
+                return None
+
+            return list(self._responses.pop(0))
+
+    def clear(self):
+        with self._reply_received:
+            self._responses = []
+
+    def close(self):
+        self._device.close()
+
+
+class pyusb_transport(dlpc900_transport):
+    """
+    Transport using pyusb and libusb, which works on Linux, macOS and Windows. The HID interface is detached from
+    the kernel driver if necessary, and packets are written to and read from its interrupt endpoints directly.
+    """
+
+    out_endpoint = 0x01
+    in_endpoint = 0x81
+    # maximum number of bytes written in one transfer by write_packets()
+    transfer_size = 16384
+
+    def __init__(self,
+                 vendor_id: int = 0x0451,
+                 product_id: int = 0xc900,
+                 dmd_index: int = 0,
+                 hid_path: Optional[str] = None):
+        """
+        :param vendor_id: vendor id, used to find DMD USB device
+        :param product_id: product id, used to find DMD USB device
+        :param dmd_index: If multiple DMD's are attached, choose this one. Indexing starts at zero
+        :param hid_path: "bus:address" of the device. If provided, it overrides dmd_index
+        """
+        if usb is None:
+            raise ImportError("pyusb is required for the pyusb transport")
+
+        devices = list(usb.core.find(find_all=True, idVendor=vendor_id, idProduct=product_id))
+        if hid_path is not None:
+            devices = [d for d in devices if f"{d.bus:d}:{d.address:d}" == hid_path]
+            if devices == []:
+                raise ValueError(f"no DMD was found at '{hid_path:s}'")
+            dmd_index = 0
+
+        if len(devices) <= dmd_index:
+            raise ValueError(f"Not enough DMD's detected for dmd_index={dmd_index:d}."
+                             f"Only {len(devices):d} DMD's were detected.")
+        self._device = devices[dmd_index]
+        self.path = f"{self._device.bus:d}:{self._device.address:d}"
+
+        try:
+            if self._device.is_kernel_driver_active(0):
+                self._device.detach_kernel_driver(0)
+        except (NotImplementedError, usb.core.USBError):
+            # not supported on all platforms, e.g. on Windows there is no kernel driver to detach
+            pass
+        self._device.set_configuration()
+
+    def write(self, packet):
+        try:
+            self._device.write(self.out_endpoint, packet)
+        except usb.core.USBError:
+            # sometimes timeouts occur. Waiting a very short time and writing the packet again fixes most of them
+            time.sleep(0.1)
+            self._device.write(self.out_endpoint, packet)
+
+    def write_packets(self, buffer):
+        # libusb splits each transfer into packets, so there is no python call per packet
+        buffer = memoryview(buffer).cast("B")
+        for ii in range(0, len(buffer), self.transfer_size):
+            self._device.write(self.out_endpoint, buffer[ii:ii + self.transfer_size])
+
+    def read(self, timeout: Optional[float] = 5) -> Optional[list]:
+        try:
+            # pyusb timeouts are in ms, and 0 waits indefinitely
+            return list(self._device.read(self.in_endpoint,
+                                          self.packet_length,
+                                          0 if timeout is None else max(int(timeout * 1e3), 1)))
+        except usb.core.USBTimeoutError:
+            print('read command timed out')
+            return None
+
+    def close(self):
+        usb.util.dispose_resources(self._device)
+
+
+class hidraw_transport(dlpc900_transport):
+    """
+    Linux transport using the hidraw device files of the kernel HID driver, with no dependencies outside the
+    standard library. Reading /dev/hidraw* usually requires a udev rule giving users access to the DMD.
+    """
+
+    def __init__(self,
+                 vendor_id: int = 0x0451,
+                 product_id: int = 0xc900,
+                 dmd_index: int = 0,
+                 hid_path: Optional[str] = None):
+        """
+        :param vendor_id: vendor id, used to find DMD USB device
+        :param product_id: product id, used to find DMD USB device
+        :param dmd_index: If multiple DMD's are attached, choose this one. Indexing starts at zero
+        :param hid_path: hidraw device file, e.g. "/dev/hidraw0". If provided, it overrides dmd_index
+        """
+        if hid_path is None:
+            paths = self.find_devices(vendor_id, product_id)
+            if len(paths) <= dmd_index:
+                raise ValueError(f"Not enough DMD's detected for dmd_index={dmd_index:d}."
+                                 f"Only {len(paths):d} DMD's were detected.")
+            hid_path = paths[dmd_index]
+
+        self.path = hid_path
+        self._fd = os.open(hid_path, os.O_RDWR)
+
+    @staticmethod
+    def find_devices(vendor_id: int = 0x0451,
+                     product_id: int = 0xc900) -> list:
+        """
+        Find the hidraw device files of all attached devices with the given ids
+
+        :return paths:
+        """
+        hid_id = f"HID_ID=0003:{vendor_id:08X}:{product_id:08X}"
+        paths = []
+        for uevent in sorted(Path("/sys/class/hidraw").glob("hidraw*/device/uevent")):
+            if hid_id in uevent.read_text().split():
+                paths.append(f"/dev/{uevent.parent.parent.name:s}")
+
+        return paths
+
+    def write(self, packet):
+        # the DLPC900 does not use numbered reports, so the report id is 0
+        os.write(self._fd, b"\x00" + bytes(packet))
+
+    def read(self, timeout: Optional[float] = 5) -> Optional[list]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            print('read command timed out')
+            return None
+
+        # the report id is not included in reports read from hidraw
+        return list(os.read(self._fd, self.packet_length))
+
+    def clear(self):
+        while select.select([self._fd], [], [], 0)[0]:
+            os.read(self._fd, self.packet_length)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class fake_transport(dlpc900_transport):
+    """
+    In-process transport which does not need a DMD. It keeps track of the commands which are written, and answers
+    every command which requests a reply with a reply of zeros, or with the data returned by a responder function.
+    Use it to test code using dlpc900_dmd, or to measure the time spent building commands.
+    """
+
+    def __init__(self,
+                 responder=None,
+                 record: bool = True):
+        """
+        :param responder: function called as responder(command, data) for each command requesting a reply, where
+          command is the USB command number and data is the command data. It returns the reply data. If None, the
+          reply data is 60 zero bytes.
+        :param record: if True, keep all packets which were written in the list packets
+        """
+        self.responder = responder
+        self.record = record
+        self.path = "fake"
+        self.packets = []
+        self._replies = []
+        # packets of the current command, and the number of bytes still to come
+        self._command = bytearray()
+        self._remaining = 0
+
+    def write(self, packet):
+        if len(packet) != self.packet_length:
+            raise ValueError(f"packets must be {self.packet_length:d} bytes long, but had length {len(packet):d}")
+        if self.record:
+            self.packets.append(bytes(packet))
+
+        if self._remaining <= 0:
+            # first packet of a command. The length includes the 2 command bytes, but not the 4 byte header
+            self._command = bytearray(packet)
+            self._remaining = 4 + unpack_from('<H', packet, 2)[0] - self.packet_length
+        else:
+            self._command += packet
+            self._remaining -= self.packet_length
+
+        flag_byte, sequence_byte, data_len, command = unpack_from('<BBHH', self._command)
+        if self._remaining <= 0 and flag_byte & 0x40:
+            data = bytes(self._command[6:4 + data_len])
+            reply_data = bytes(60) if self.responder is None else bytes(self.responder(command, data))
+            self._replies.append(list(pack('<BBH', flag_byte & 0xc0, sequence_byte, len(reply_data)) + reply_data))
+
+    def read(self, timeout: Optional[float] = 5) -> Optional[list]:
+        if self._replies == []:
+            return None
+        return self._replies.pop(0)
+
+    def clear(self):
+        self._replies = []
+
+
+# transports which can be chosen by name
+transport_backends = {"pywinusb": pywinusb_transport,
+                      "pyusb": pyusb_transport,
+                      "hidraw": hidraw_transport,
+                      "fake": fake_transport}
+
+
+def default_transport(platform: str) -> str:
+    """
+    Name of the transport used on a platform when none is chosen
+
+    :param platform: platform as in sys.platform
+    :return transport: key of transport_backends
+    """
+    if platform == "win32":
+        return "pywinusb"
+    elif platform.startswith("linux"):
+        return "hidraw"
+    else:
+        return "pyusb"
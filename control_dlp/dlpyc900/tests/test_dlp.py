@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from dlpyc900 import erle
+from dlpyc900.dlp import dmd, split_payloads
+from dlpyc900.dlp_errors import DMDerror
+from dlpyc900.transport import fake_transport, pack_command
+
+
+def display_mode_responder(command, data):
+    # answers every read with display mode 3, 'otf'
+    return [3]
+
+
+def commands(packets):
+    '''
+    split the packets recorded by fake_transport into (flag byte, sequence byte, command, data)
+    '''
+    out = []
+    i = 0
+    while i < len(packets):
+        flag, seq, length = packets[i][0], packets[i][1], int.from_bytes(packets[i][2:4], 'little')
+        n = -(-(4 + length) // 64)
+        buffer = b''.join(packets[i:i + n])
+        out.append((flag, seq, int.from_bytes(buffer[4:6], 'little'), buffer[6:4 + length]))
+        i += n
+    return out
+
+
+def test_pack_command():
+    buffer = pack_command(0xc0, 7, 0x1A2B, bytes(range(100)))
+    assert len(buffer) == 128
+    assert buffer[:6] == bytes([0xc0, 7, 102, 0, 0x2B, 0x1A])
+    assert buffer[6:106] == bytes(range(100))
+    assert not any(buffer[106:])
+    assert len(pack_command(0x40, 0, 0x0100)) == 64
+
+
+def test_send_command_framing():
+    transport = fake_transport(responder=display_mode_responder)
+    dlp = dmd(transport=transport)
+    transport.packets.clear()
+    dlp.send_command('w', 9, 0x1A34, list(range(80)))
+    assert [len(p) for p in transport.packets] == [64, 64]
+    # writes do not ask for a reply
+    assert b''.join(transport.packets) == pack_command(0x00, dlp.sequence_byte, 0x1A34, bytes(range(80)))
+    assert transport._replies == []
+
+
+def test_sequence_bytes():
+    transport = fake_transport(responder=display_mode_responder)
+    dlp = dmd(transport=transport)
+    transport.packets.clear()
+    # the same sequence byte is passed for both commands, but each gets its own
+    dlp.set_display_mode('otf')
+    assert dlp.get_display_mode() == 'otf'
+    dlp.send_write_commands(0x1A2B, [b'\x00'] * 300)
+    sent = commands(transport.packets)
+    # set_display_mode() reads the mode back
+    assert [flag for flag, _, _, _ in sent] == [0x00, 0xc0, 0xc0] + [0x00] * 300
+    seqs = [seq for _, seq, _, _ in sent]
+    assert seqs == [(seqs[0] + i) % 256 for i in range(len(sent))]
+
+
+def test_reply_matching():
+    transport = fake_transport(responder=display_mode_responder)
+    dlp = dmd(transport=transport)
+    # a late reply to an earlier command is skipped
+    transport._replies.append([0xc0, 0x77, 1, 0, 0])
+    assert dlp.get_display_mode() == 'otf'
+    assert transport._replies == []
+
+
+def test_reply_timeout(monkeypatch):
+    dlp = dmd(transport=fake_transport())
+    monkeypatch.setattr(dlp.transport, 'read', lambda timeout: None)
+    with pytest.raises(DMDerror):
+        dlp.get_display_mode()
+
+
+def test_upload_packets():
+    transport = fake_transport()
+    dlp = dmd(transport=transport)
+    images = np.random.default_rng(0).random((24, 40, 64)) < 0.1
+    transport.packets.clear()
+    size = dlp.pattern_bmp_load_images(2, images, primary=False)
+    encoded, _ = erle.encode(images)
+    sent = commands(transport.packets)
+
+    assert sent[0][2] == 0x1A2C
+    assert sent[0][3] == bytes([2, 0]) + size.to_bytes(4, 'little')
+    payloads = list(split_payloads(encoded))
+    assert [c for _, _, c, _ in sent[1:]] == [0x1A2D] * len(payloads)
+    assert [d for _, _, _, d in sent[1:]] == payloads
+    assert b''.join(d[2:] for _, _, _, d in sent[1:]) == bytes(encoded)
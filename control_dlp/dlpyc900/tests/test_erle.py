@@ -0,0 +1,282 @@
+import itertools
+import struct
+import time
+import numpy as np
+import pytest
+from dlpyc900 import erle
+from dlpyc900.cache import frame_cache
+
+
+def encode_reference(images):
+    '''
+    encode row by row with encode_row(), the original per-pixel implementation
+    '''
+    image = erle.merge(images)
+    encoded = erle.get_header(image.shape[1], image.shape[0])
+    for i in range(image.shape[0]):
+        same_prev = np.zeros(image.shape[1], dtype=bool) if i == 0 else image[i] == image[i-1]
+        encoded += erle.encode_row(image[i], same_prev)
+    encoded += b'\x00\x01\x00'
+    encoded += bytearray((-len(encoded)) % 4)
+    struct.pack_into('<I', encoded, 8, len(encoded))
+    return encoded, len(encoded)
+
+
+def rle_reference(images):
+    '''
+    run-length encode row by row, one run at a time
+    '''
+    image = erle.merge(images)
+    encoded = erle.get_header(image.shape[1], image.shape[0], compression=1)
+    for row in image:
+        runs = [(value, len(list(run))) for value, run in itertools.groupby(row.tolist())]
+        i = 0
+        while i < len(runs):
+            value, n = runs[i]
+            if n > 1:
+                for k in range(0, n, 255):
+                    encoded += bytes([min(n - k, 255)]) + erle.bgr(value)
+                i += 1
+                continue
+            # consecutive single pixels
+            j = i
+            while j < len(runs) and runs[j][1] == 1:
+                j += 1
+            values = [value for value, _ in runs[i:j]]
+            for k in range(0, len(values), 255):
+                block = values[k:k + 255]
+                if len(block) > 1:
+                    encoded += bytes([0, len(block)]) + b''.join(erle.bgr(v) for v in block)
+                else:
+                    encoded += b'\x01' + erle.bgr(block[0])
+            i = j
+        encoded += b'\x00\x00'
+    encoded += b'\x00\x01'
+    encoded += bytearray((-len(encoded)) % 4)
+    struct.pack_into('<I', encoded, 8, len(encoded))
+    return encoded, len(encoded)
+
+
+def patterns(name):
+    rng = np.random.default_rng(0)
+    x = np.arange(1024)
+    y = np.arange(1200)[:, None]
+    if name == 'zeros':
+        return [np.zeros((1200, 1024), dtype=np.uint8)]
+    if name == 'noise':
+        return [rng.integers(0, 2, (1200, 1024), dtype=np.uint8) for _ in range(3)]
+    if name == 'sparse':
+        return [(rng.random((1200, 1024)) < 0.02).astype(np.uint8) for _ in range(24)]
+    if name == 'grating':
+        return [((x + 0.3 * y + k) // 7 % 2).astype(np.uint8) for k in range(24)]
+    if name == 'blocks':
+        block = np.kron(rng.integers(0, 2, (150, 128)), np.ones((8, 8))).astype(np.uint8)
+        return [block, block[::-1].copy()]
+
+
+def test_merge_stack():
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 2, (53, 40, 32), dtype=np.uint8)
+    out = np.zeros((3, 40, 32), dtype=np.uint32)
+    merged = erle.merge_stack(images, out=out)
+    assert merged is out
+    for k in range(3):
+        group = images[24*k:24*k + 24].astype(np.uint32)
+        expected = np.sum(group << np.arange(len(group), dtype=np.uint32)[:, None, None], axis=0)
+        assert np.array_equal(merged[k], expected)
+        assert np.array_equal(erle.merge(images[24*k:24*k + 24]), expected)
+
+
+@pytest.mark.parametrize('name', ['zeros', 'noise', 'sparse', 'grating', 'blocks'])
+def test_encode_matches_encode_row(name):
+    images = patterns(name)
+    assert erle.encode(images) == encode_reference(images)
+
+
+@pytest.mark.parametrize('name', ['zeros', 'noise', 'sparse', 'grating', 'blocks'])
+def test_encode_rle(name):
+    images = patterns(name)
+    assert erle.encode_rle(images) == rle_reference(images)
+    # single pixels and runs longer than 255 in the same row
+    image = np.zeros((3, 700), dtype=np.uint8)
+    image[:, 300:600:2] = 1
+    image[1, 300:] = 1
+    assert erle.encode_rle([image]) == rle_reference([image])
+
+
+@pytest.mark.parametrize('shape', [(1200, 1024), (5, 3)])
+def test_encode_raw(shape):
+    rng = np.random.default_rng(0)
+    images = [(rng.random(shape) < 0.3).astype(np.uint8) for _ in range(24)]
+    image = erle.merge(images)
+    encoded, size = erle.encode_raw(images)
+    expected = erle.get_header(shape[1], shape[0], compression=0) + b''.join(erle.bgr(p) for p in image.ravel())
+    expected += bytearray((-len(expected)) % 4)
+    struct.pack_into('<I', expected, 8, len(expected))
+    assert (encoded, size) == (expected, len(expected))
+
+
+@pytest.mark.parametrize('shape', [(1080, 1920), (37, 333), (5, 3), (5, 2), (5, 1), (1, 1)])
+def test_encode_geometry(shape):
+    rng = np.random.default_rng(0)
+    images = [(rng.random(shape) < 0.3).astype(np.uint8) for _ in range(5)]
+    images[1][1:] = images[1][:1]
+    encoded, size = erle.encode(images)
+    assert (encoded, size) == encode_reference(images)
+    assert struct.unpack_from('<HHI', encoded, 4) == (shape[1], shape[0], size)
+
+
+def test_encode_model():
+    images = [np.zeros((1080, 1920), dtype=np.uint8)]
+    assert erle.encode(images, model='DLP6500') == erle.encode(images)
+    assert erle.geometry('DLP9000') == (1024, 1200)
+    with pytest.raises(ValueError):
+        erle.encode(images, model='DLP9000')
+
+
+@pytest.mark.parametrize('optimal', [False, True])
+@pytest.mark.parametrize('flipud', [False, True])
+def test_encode_split(optimal, flipud):
+    rng = np.random.default_rng(0)
+    images = (rng.random((5, 120, 2048)) < 0.1).astype(np.uint8)
+    images[:, 40:80] = images[:, 40:41]
+    halves = images[:, ::-1] if flipud else images
+    expected = [erle.encode(halves[..., :1024], optimal=optimal), erle.encode(halves[..., 1024:], optimal=optimal)]
+    assert erle.encode_split(images, optimal=optimal, flipud=flipud) == expected
+
+
+@pytest.mark.parametrize('optimal', [False, True])
+@pytest.mark.parametrize('threads', [2, 7])
+def test_encode_threads(optimal, threads):
+    rng = np.random.default_rng(0)
+    images = (rng.random((5, 40, 256)) < 0.1).astype(np.uint8)
+    # repeated rows across the edges of the row blocks
+    images[:, 10:30] = images[:, 10:11]
+    assert erle.encode(images, optimal=optimal, threads=threads) == erle.encode(images, optimal=optimal)
+    assert (erle.encode_split(images, optimal=optimal, threads=threads)
+            == erle.encode_split(images, optimal=optimal))
+    # parts of width 1
+    images = images[..., :2]
+    assert (erle.encode_split(images, optimal=optimal, threads=threads)
+            == [erle.encode(images[..., :1], optimal=optimal), erle.encode(images[..., 1:], optimal=optimal)])
+
+
+def test_encode_threads_time():
+    # a DLP9000 frame split in two. Threads should not be slower even on one core, see emit_blocks()
+    rng = np.random.default_rng(0)
+    images = (rng.random((24, 1600, 2560)) < 0.05).astype(np.uint8)
+
+    def best_time(threads):
+        times = []
+        for _ in range(3):
+            start = time.perf_counter()
+            erle.encode_split(images, 2, threads=threads)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    assert best_time(4) < 1.5 * best_time(1)
+
+
+@pytest.mark.parametrize('optimal', [False, True])
+def test_encoded_frame(optimal):
+    rng = np.random.default_rng(0)
+    images = (rng.random((24, 60, 128)) < 0.1).astype(np.uint8)
+    images[:, 20:40] = images[:, 20:21]
+    frame = erle.encoded_frame(images, optimal=optimal)
+    assert frame.encode() == erle.encode(images, optimal=optimal)
+    # bands at the first and last rows, inside the repeated rows, and updates which change nothing
+    for row, n in [(0, 3), (57, 3), (25, 5), (10, 30), (40, 1)]:
+        bits = [0, 7, 23]
+        planes = (rng.random((3, n, 128)) < 0.1).astype(np.uint8)
+        frame.set_planes(planes, bits=bits, row=row)
+        images[bits, row:row + n] = planes
+        assert frame.encode() == erle.encode(images, optimal=optimal)
+        frame.set_planes(images[bits, row:row + n], bits=bits, row=row)
+        assert frame.encode() == erle.encode(images, optimal=optimal)
+    frame.set_rows(erle.merge(images[:, ::-1]))
+    assert frame.encode() == erle.encode(images[:, ::-1], optimal=optimal)
+
+
+@pytest.mark.parametrize('optimal', [False, True])
+def test_encode_gratings(optimal):
+    gratings = [erle.grating(3, 2, 13, duty=6 + k % 3, offset=k) for k in range(24)]
+    gratings += [erle.grating(1, 0, 4), erle.grating(0, 1, 6), erle.grating(5, 7, 11, offset=3)]
+    for width, height in [(1024, 1200), (333, 37)]:
+        expected = [erle.encode([g.image(width, height) for g in gratings[i:i + 24]], optimal=optimal)
+                    for i in (0, 24)]
+        assert list(erle.encode_gratings(gratings, width, height, optimal=optimal)) == expected
+
+
+def optimal_size_reference(image):
+    '''
+    fewest bytes for each row, trying every possible last token
+    '''
+    def n_len(n):
+        return 1 if n < 128 else 2
+    total = 0
+    for i, row in enumerate(image):
+        cost = [0] + [None] * len(row)
+        for k in range(1, len(row) + 1):
+            options = []
+            for j in range(k):
+                n = k - j
+                if np.all(row[j:k] == row[j]):
+                    options.append(cost[j] + n_len(n) + 3)
+                if i > 0 and np.all(row[j:k] == image[i-1, j:k]):
+                    options.append(cost[j] + 2 + n_len(n))
+                if n >= 2:
+                    options.append(cost[j] + 1 + n_len(n) + 3*n)
+            cost[k] = min(options)
+        total += cost[-1] + 2
+    return total
+
+
+def test_tokenize_optimal_size():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 3, (4, 300)).astype(np.uint32)
+    image[:, 100:250] = image[:, 100:101]
+    image[1:][rng.random((3, 300)) < 0.7] = 0
+    starts, kind, length = erle.tokenize_optimal(image)
+    assert len(erle.emit(image, starts, kind, length)) == optimal_size_reference(image)
+
+
+@pytest.mark.parametrize('name', ['noise', 'sparse', 'grating'])
+def test_encode_optimal(name):
+    images = patterns(name)
+    image = erle.merge(images)
+    starts, kind, length = erle.tokenize_optimal(image)
+    # tokens cover every row exactly
+    assert np.all(np.bincount(starts // 1025, weights=length) == 1024)
+    assert erle.encode(images, optimal=True)[1] <= erle.encode(images)[1]
+
+
+def test_encode_cache(tmp_path):
+    cache = frame_cache(tmp_path)
+    for name in ['sparse', 'grating']:
+        images = patterns(name)
+        expected = erle.encode(images)
+        assert erle.encode(images, cache=cache) == expected
+        assert erle.encode(images, cache=cache) == expected
+    assert len(list(tmp_path.glob('*.bin'))) == 2
+
+    # least recently used entry is evicted
+    erle.encode(patterns('sparse'), cache=cache)
+    cache.max_bytes = max(f.stat().st_size for f in tmp_path.glob('*.bin'))
+    cache.evict()
+    assert len(list(tmp_path.glob('*.bin'))) == 1
+    assert erle.encode(patterns('sparse'), cache=cache) == erle.encode(patterns('sparse'))
+
+
+def test_cache_size(tmp_path):
+    cache = frame_cache(tmp_path, max_bytes=1000)
+    for i in range(5):
+        cache.put(f'{i}', bytes(300))
+    # the size is tracked without scanning, and the oldest entries are evicted below evict_fraction of max_bytes
+    assert cache.total_bytes == sum(f.stat().st_size for f in tmp_path.glob('*.bin')) <= 900
+    assert cache.get('4') is not None and cache.get('0') is None
+    cache.put('4', bytes(100))
+    assert cache.total_bytes == sum(f.stat().st_size for f in tmp_path.glob('*.bin'))
+    # entries of other processes are counted when a new cache is opened
+    assert frame_cache(tmp_path).total_bytes == cache.total_bytes
+    cache.clear()
+    assert cache.total_bytes == 0 and not list(tmp_path.glob('*.bin'))
@@ -1,8 +1,9 @@
 """
 Control the Light Crafter 6500DLP evaluation module, or other DMD's relying on the DLPC900 controller over USB.
 The code is based around the dlp6500 class, which builds the command packets to be sent to the DMD.
-Currently, this code only supports Windows. Extensions to Linux can be accomplished by implementing two functions,
-_send_raw_packet() and _get_device(). This would likely also require importing a Linux compatible HID module.
+USB communication goes through a transport, see dlpc900_transport. On Windows the default transport uses pywinusb,
+on Linux it uses the hidraw device files, and elsewhere pyusb. Other operating systems can be supported by adding
+a transport to transport_backends.
 
 Although Texas Instruments has an SDK for this evaluation module (http://www.ti.com/tool/DLP-ALC-LIGHTCRAFTER-SDK),
 it is not very well documented, and we had difficulty building it. Further, it is intended to produce a static library
@@ -15,30 +16,40 @@ from collections.abc import Sequence
 from typing import Union, Optional
 import sys
 import time
-from struct import pack, unpack
+import hashlib
+from struct import pack, unpack, pack_into, unpack_from
 import numpy as np
 from copy import deepcopy
+from contextlib import contextmanager
 import datetime
 from argparse import ArgumentParser
+from itertools import chain
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
 # for dealing with configuration files
 import json
 import zarr
 from warnings import warn
 from pathlib import Path
-from numcodecs import packbits
-
-try:
-    import pywinusb.hid as pyhid
-except ImportError:
-    pyhid = None
-    warn("pywinusb could not be imported")
+from numcodecs import packbits, register_codec
+from numcodecs.abc import Codec
+from numcodecs.compat import ensure_contiguous_ndarray, ndarray_copy
+from zarr.core.sync import sync
+# ERLE encoder, pattern cache and USB transports shared with the dlpyc900 driver
+from dlpyc900 import erle
+from dlpyc900.cache import frame_cache
+from dlpyc900.transport import (dlpc900_transport, pywinusb_transport, pyusb_transport, hidraw_transport,
+                                fake_transport, transport_backends, default_transport, pack_command)
 
 
 ##############################################
 # compress DMD pattern data
 ##############################################
 def combine_patterns(patterns: np.ndarray,
-                     bit_depth: int = 1):
+                     bit_depth: int = 1,
+                     out: Optional[np.ndarray] = None) -> np.ndarray:
     """
     Given a series of binary patterns, combine these into 24 bit RGB images to send to DMD. For binary patterns,
     the DMD supports sending a group of up to 24 patterns as an RGB image, with each bit of the 24 bit
@@ -46,60 +57,182 @@ def combine_patterns(patterns: np.ndarray,
 
     :param patterns: nimgs x ny x nx array of uint8
     :param bit_depth: 1
-    :return combined_patterns:
+    :param out: ncombined x 3 x ny x nx uint8 array to write the combined patterns to, where
+      ncombined = ceil(nimgs / 24). If None, a new array is created.
+    :return combined_patterns: ncombined x 3 x ny x nx uint8 array
     """
 
     if bit_depth != 1:
         raise NotImplementedError('not implemented')
 
-    if not np.all(np.logical_or(patterns == 0, patterns == 1)):
-        raise ValueError('patterns must be binary')
+    patterns = _as_binary_patterns(patterns)
+    nimgs, ny, nx = patterns.shape
+    n_combined_patterns = int(np.ceil(nimgs / 24))
+    if out is None:
+        out = np.empty((n_combined_patterns, 3, ny, nx), dtype=np.uint8)
+    elif out.shape != (n_combined_patterns, 3, ny, nx) or out.dtype != np.uint8:
+        raise ValueError(f"out must be a uint8 array of shape {(n_combined_patterns, 3, ny, nx)}")
+
+    # pattern ii of each group is stored in bit ii % 8 of one color channel. The first 8 patterns are encoded in the
+    # B byte of the color image, the next 8 in G, and the last 8 in R. Each bit is set for all groups at once
+    shifted = np.empty((n_combined_patterns, ny, nx), dtype=np.uint8)
+    for ii in range(24):
+        channel = out[:, 2 - ii // 8]
+        # the last group may have fewer than 24 patterns
+        current = patterns[ii::24]
+        n = len(current)
+        if ii % 8 == 0:
+            channel[:n] = current
+            channel[n:] = 0
+        else:
+            np.left_shift(current, ii % 8, out=shifted[:n])
+            np.bitwise_or(channel[:n], shifted[:n], out=channel[:n])
 
-    combined_patterns = []
-    # determine number of compressed images and create them
-    n_combined_patterns = int(np.ceil(len(patterns) / 24))
-    for num_pat in range(n_combined_patterns):
+    return out
 
-        combined_pattern_current = np.zeros((3, patterns.shape[1], patterns.shape[2]), dtype=np.uint8)
 
-        for ii in range(np.min([24, len(patterns) - 24*num_pat])):
-            # first 8 patterns encoded in B byte of color image, next 8 in G, last 8 in R
-            if ii < 8:
-                combined_pattern_current[2, :, :] += patterns[ii + 24*num_pat, :, :] * 2**ii
-            elif ii >= 8 and ii < 16:
-                combined_pattern_current[1, :, :] += patterns[ii + 24*num_pat, :, :] * 2**(ii-8)
-            elif ii >= 16 and ii < 24:
-                combined_pattern_current[0, :, :] += patterns[ii + 24*num_pat, :, :] * 2**(ii-16)
+def pack_patterns(patterns: np.ndarray,
+                  bit_depth: int = 1,
+                  out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Combine binary patterns into 24 bit RGB images as combine_patterns() does, but store each pixel as a single
+    uint32. This is the representation all encoders work on internally, see _pack_rgb(), so pixels and rows can be
+    compared with single array operations. Each color byte is built for all combined patterns at once and then
+    written to the packed pixels, so the 3 color channels are never stored separately.
 
-        combined_patterns.append(combined_pattern_current)
+    :param patterns: nimgs x ny x nx array of uint8 or bool
+    :param bit_depth: 1
+    :param out: ncombined x ny x nx array of dtype '<u4' to write the packed patterns to. If None, a new array
+      is created.
+    :return packed_patterns: ncombined x ny x nx array of dtype '<u4'. Pattern jj of each group is stored in bit jj,
+      so the bytes of each pixel are B, G, R, 0 and packed_patterns[ii] is the same as
+      _pack_rgb(combine_patterns(patterns)[ii]). This is the layout of erle.merge_stack(), which does the packing
+    """
 
-    return combined_patterns
+    if bit_depth != 1:
+        raise NotImplementedError('not implemented')
+
+    patterns = _as_binary_patterns(patterns)
+    nimgs, ny, nx = patterns.shape
+    shape = (int(np.ceil(nimgs / 24)), ny, nx)
+    if out is not None and (out.shape != shape or out.dtype != _packed_dtype or not out.flags.c_contiguous):
+        raise ValueError(f"out must be a contiguous '<u4' array of shape {shape}")
+
+    # patterns 0-7 of each group are stored in the B byte, 8-15 in G, and 16-23 in R, see combine_patterns()
+    return erle.merge_stack(patterns, out=out)
 
 
-def split_combined_patterns(combined_patterns) -> np.ndarray:
+def _as_binary_patterns(patterns: np.ndarray) -> np.ndarray:
     """
-    Split binary patterns which have been combined into a single uint8 RGB image back to separate images.
+    Check patterns are binary and convert them to uint8
 
-    :param combined_patterns: 3 x Ny x Nx uint8 array representing up to 24 combined patterns. Actually
-      will accept input of arbitrary dimensions as long as first dimension has size 3.
-    :return: 24 x Ny x Nx array. This will always have a first dimension of size 24 because the number of
-      zero patterns at the end is ambiguous.
+    :param patterns: array of bool, or integer values which are 0 or 1
+    :return patterns: uint8 array
     """
-    patterns = np.zeros((24,) + combined_patterns.shape[1:], dtype=np.uint8)
+    patterns = np.asarray(patterns)
+    if patterns.dtype == bool:
+        patterns = patterns.view(np.uint8)
+    elif patterns.dtype.kind == "u":
+        if patterns.max(initial=0) > 1:
+            raise ValueError('patterns must be binary')
+    elif not np.all(np.logical_or(patterns == 0, patterns == 1)):
+        raise ValueError('patterns must be binary')
+
+    if patterns.dtype != np.uint8:
+        patterns = patterns.astype(np.uint8)
 
+    return patterns
+
+
+def split_combined_patterns(combined_patterns: np.ndarray,
+                            out: Optional[np.ndarray] = None,
+                            lazy: bool = False):
+    """
+    Split binary patterns which have been combined into a single uint8 RGB image back to separate images.
+    This is the inverse of combine_patterns().
+
+    :param combined_patterns: 3 x Ny x Nx uint8 array representing up to 24 combined patterns, or a batch of these
+      images as an ncombined x 3 x Ny x Nx array. Actually will accept input of other dimensions as long as the
+      first dimension has size 3. Packed patterns as produced by pack_patterns() are also accepted, as a
+      Ny x Nx or ncombined x Ny x Nx array of dtype '<u4'.
+    :param out: 24 x Ny x Nx (or 24*ncombined x Ny x Nx) uint8 array to write the patterns to. If None, a new array
+      is created.
+    :param lazy: if True, return a combined_pattern_view which only extracts patterns when they are indexed
+      instead of splitting all patterns at once
+    :return: 24 x Ny x Nx array, or 24*ncombined x Ny x Nx for a batch. The first dimension is always a
+      multiple of 24 because the number of zero patterns at the end is ambiguous.
+    """
+    combined_patterns = np.asarray(combined_patterns)
+    if combined_patterns.dtype == _packed_dtype:
+        # view the color bytes of the packed pixels as channels
+        combined_patterns = np.moveaxis(_packed_bytes(combined_patterns)[..., 2::-1], -1, -3)
+
+    if combined_patterns.ndim != 4:
+        combined_patterns = combined_patterns[None]
+
+    if combined_patterns.shape[1] != 3:
+        raise ValueError(f"combined_patterns must have 3 color channels, but had shape {combined_patterns.shape}")
+
+    if lazy:
+        if out is not None:
+            raise ValueError("out cannot be used with lazy=True")
+        return combined_pattern_view(combined_patterns)
+
+    ncombined = combined_patterns.shape[0]
+    shape = (24 * ncombined,) + combined_patterns.shape[2:]
+    if out is None:
+        out = np.empty(shape, dtype=np.uint8)
+    elif out.shape != shape or out.dtype != np.uint8 or not out.flags.c_contiguous:
+        raise ValueError(f"out must be a contiguous uint8 array of shape {shape}")
+
+    # the first 8 patterns are in the B channel, the next 8 in G and the last 8 in R. Each bit is extracted from
+    # all channels and combined patterns at once
+    channels = combined_patterns[:, ::-1]
+    pattern_bits = out.reshape((ncombined, 3, 8) + combined_patterns.shape[2:])
     for ii in range(8):
-        patterns[ii] = (combined_patterns[2] & 2**ii) >> ii
+        np.right_shift(channels, ii, out=pattern_bits[:, :, ii], casting="unsafe")
+        np.bitwise_and(pattern_bits[:, :, ii], 1, out=pattern_bits[:, :, ii])
 
-    for ii in range(8, 16):
-        patterns[ii] = (combined_patterns[1] & 2 ** (ii-8)) >> (ii-8)
+    return out
 
-    for ii in range(16, 24):
-        patterns[ii] = (combined_patterns[0] & 2 ** (ii - 16)) >> (ii+8)
 
-    return patterns
+class combined_pattern_view(Sequence):
+    """
+    Read-only sequence of the binary patterns stored in combined patterns, as returned by
+    split_combined_patterns(..., lazy=True). Patterns are extracted from the combined patterns when they are
+    indexed, so verifying or reading a few patterns does not require splitting all of them.
+    """
+
+    def __init__(self, combined_patterns: np.ndarray):
+        """
+        :param combined_patterns: ncombined x 3 x Ny x Nx array
+        """
+        self.combined_patterns = combined_patterns
+        self.shape = (24 * combined_patterns.shape[0],) + combined_patterns.shape[2:]
+
+    def __len__(self) -> int:
+        return self.shape[0]
 
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return np.stack([self[ii] for ii in range(*item.indices(len(self)))])
 
-def encode_erle(pattern: np.ndarray) -> list:
+        if item < 0:
+            item += len(self)
+        if item < 0 or item >= len(self):
+            raise IndexError(f"pattern index {item:d} out of range for {len(self):d} patterns")
+
+        ind, bit = divmod(item, 24)
+        return (self.combined_patterns[ind, 2 - bit // 8] >> (bit % 8)) & 1
+
+    def __array__(self, dtype=None, copy=None):
+        patterns = split_combined_patterns(self.combined_patterns)
+        return patterns if dtype is None else patterns.astype(dtype)
+
+
+def encode_erle(pattern: np.ndarray,
+                optimal: bool = False,
+                threads: int = 1) -> bytes:
     """
     Encode a 24bit pattern in enhanced run length encoding (ERLE).
 
@@ -112,66 +245,149 @@ def encode_erle(pattern: np.ndarray) -> list:
     0          , n>1        , n/a        , n uncompressed RGB pixels follow
     n>1        , n/a        , n/a        , repeat following pixel n times
 
+    Each row is split into spans which are copied from the previous row, repeats of a single pixel, or blocks of
+    uncompressed pixels, by the same tokenizer and emitter as the dlpyc900 driver, see erle.tokenize() and
+    erle.emit(). Unlike the bitmaps written by erle.encode(), rows end when they are complete, so no end of line
+    tokens are written (eol=False), and there is no padding to 4 bytes, as the header from _pattern_header()
+    gives the exact number of bytes.
+
     :param pattern: uint8 3 x Ny x Nx array of RGB values, or Ny x Nx array
+    :param optimal: if True, choose the spans giving the fewest bytes using erle.tokenize_optimal(). This reduces
+      the amount of data which must be sent to the DMD, usually by a few percent, but is slower than the default
+      greedy choice, up to about 10 times for patterns which compress well. It is meant for patterns which are
+      compressed ahead of time, e.g. stored in an encoded_pattern_set or encoded_pattern_cache, not for patterns
+      compressed right before they are uploaded
+    :param threads: number of threads to encode blocks of rows in, see encode_erle_split()
     :return pattern_compressed:
     """
 
+    return encode_erle_split(pattern, nsplit=1, optimal=optimal, threads=threads)[0]
+
+
+def encode_erle_split(pattern: np.ndarray,
+                      nsplit: int = 2,
+                      optimal: bool = False,
+                      flipud: bool = False,
+                      threads: int = 1) -> list:
+    """
+    Split a 24bit pattern into parts along the x-direction and encode each part in ERLE, as is needed for dual
+    controller DMD's such as the DLP9000, where the left half is sent to the primary controller and the right half
+    to the secondary controller. The result is the same as calling encode_erle() on each part, but the pattern is
+    packed directly into one array per part and the rows of all parts are compared at once.
+
+    :param pattern: uint8 3 x Ny x Nx array of RGB values, Ny x Nx array, or packed Ny x Nx array as produced by
+      pack_patterns()
+    :param nsplit: number of parts
+    :param optimal: see encode_erle()
+    :param flipud: if True, encode the pattern flipped upside down. This is done with a view, not a copy
+    :param threads: if > 1, each part is split into this many blocks of rows, which are encoded in a pool of
+      threads. The result is the same, as the tokens of each row only depend on the row above it. See
+      erle.emit_blocks() for the timing
+    :return compressed_parts: list of compressed parts
+    """
+
+    if pattern.dtype != _packed_dtype:
+        pattern = _as_rgb_pattern(pattern)
+    if flipud:
+        pattern = pattern[..., ::-1, :]
+
+    ny, nx = pattern.shape[-2:]
+    if nx % nsplit != 0:
+        raise ValueError(f"pattern width {nx:d} cannot be split into {nsplit:d} parts")
+    nx_part = nx // nsplit
+
+    # nsplit x Ny x Nx/nsplit
+    if pattern.dtype == _packed_dtype:
+        image = np.ascontiguousarray(pattern.reshape(ny, nsplit, nx_part).transpose(1, 0, 2))
+    else:
+        image = _pack_rgb(pattern.reshape(3, ny, nsplit, nx_part).transpose(0, 2, 1, 3))
+
+    if threads > 1:
+        bodies = erle.emit_blocks(image, threads, optimal, eol=False)
+    else:
+        if optimal:
+            tokens = erle.tokenize_optimal(image)
+        else:
+            tokens = erle.tokenize(image)
+        bodies = erle.emit_parts(image, *tokens, eol=False)
+
+    # bytes indicating image end
+    return [body.tobytes() + b"\x00\x01\x00" for body in bodies]
+
+
+# dtype of packed patterns, see _pack_rgb()
+_packed_dtype = np.dtype("<u4")
+
+
+def _pack_rgb(pattern: np.ndarray) -> np.ndarray:
+    """
+    Pack RGB pattern into one uint32 per pixel, so that pixels can be compared in a single operation. The layout is
+    that of erle.merge_stack(), where pattern jj of a group of 24 is stored in bit jj
+
+    :param pattern: uint8 3 x Ny x Nx array. Any shape is allowed after the first axis, e.g. 3 x nparts x Ny x Nx
+    :return image: Ny x Nx array of dtype '<u4', the bytes of each pixel are B, G, R, 0
+    """
+    shape = pattern.shape[1:]
+    image = np.zeros(shape, dtype="<u4")
+    image_bytes = image.view(np.uint8).reshape(shape + (4,))
+    for ii in range(3):
+        image_bytes[..., ii] = pattern[2 - ii]
+
+    return image
+
+
+def _packed_bytes(image: np.ndarray) -> np.ndarray:
+    """
+    View the bytes B, G, R, 0 of packed pixels, without copying. Works for views such as the parts of a split
+    pattern, as long as the pixels along the last axis are contiguous. The color channels in the order R, G, B
+    of the encoded patterns are _packed_bytes(image)[..., 2::-1]
+
+    :param image: array of dtype '<u4', as produced by _pack_rgb()
+    :return image_bytes: uint8 array with the shape of image plus a last axis of size 4
+    """
+    return image[..., None].view(np.uint8)
+
+
+def _as_packed_pattern(pattern: np.ndarray,
+                       rows: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Get a pattern with one uint32 per pixel. Packed patterns are returned as they are, and other patterns are
+    packed with _pack_rgb()
+
+    :param pattern: packed Ny x Nx array as produced by pack_patterns(), or a pattern accepted by _as_rgb_pattern()
+    :param rows: if provided, only these rows are returned, and only they are packed
+    :return image: Ny x Nx array of dtype '<u4'
+    """
+    if pattern.dtype == _packed_dtype:
+        return pattern if rows is None else pattern[rows]
+
+    pattern = _as_rgb_pattern(pattern)
+    return _pack_rgb(pattern if rows is None else pattern[:, rows])
+
+
+def _as_rgb_pattern(pattern: np.ndarray) -> np.ndarray:
+    """
+    Check pattern is uint8, and expand 2D pattern to RGB with pattern in B layer and RG=0
+
+    :param pattern: uint8 3 x Ny x Nx array of RGB values, or Ny x Nx array
+    :return pattern: uint8 3 x Ny x Nx array
+    """
     # pattern must be uint8
     if pattern.dtype != np.uint8:
         raise ValueError('pattern must be of type uint8')
 
-    # if 2D pattern, expand this to RGB with pattern in B layer and RG=0
     if pattern.ndim == 2:
         pattern = np.concatenate((np.zeros((1,) + pattern.shape, dtype=np.uint8),
                                   np.zeros((1,) + pattern.shape, dtype=np.uint8),
                                   np.array(pattern[None, :, :], copy=True)), axis=0)
 
-    if pattern.ndim != 3 and pattern.shape[0] != 3:
+    if pattern.ndim != 3 or pattern.shape[0] != 3:
         raise ValueError("Image data is wrong shape. Must be 3 x ny x nx, with RGB values in each layer.")
 
-    pattern_compressed = []
-    _, ny, nx = pattern.shape
-
-    # todo: not sure if this is allowed to cross row_rgb boundaries? If so, could pattern.ravel() instead of looping
-    # todo: don't think above suggestion works, but if last n pixels of above row_rgb are same as first n of this one
-    # todo: then with ERLE encoding I can use \x00\x01 Hex(n). But checking this may not be so easy. Right now
-    # todo: only implemented if entire rows are the same!
-    # todo: erle and rle are different enough probably should split apart more
-    # loop over pattern rows
-    for ii in range(pattern.shape[1]):
-        row_rgb = pattern[:, ii, :]
-
-        # if this row_rgb is the same as the last row_rgb, can communicate this by sending length of row_rgb
-        # and then \x00\x01 (copy n pixels from previous line)
-        # todo: can also do this for shorter sequences than the entire row_rgb
-        if ii > 0 and np.array_equal(row_rgb, pattern[:, ii - 1, :]):
-            msb, lsb = erle_len2bytes(nx)
-            pattern_compressed += [0x00, 0x01, msb, lsb]
-        else:
-            # find points along row where pixel value changes
-            # for RGB image, change happens when ANY pixel value changes
-            value_changed = np.sum(np.abs(np.diff(row_rgb, axis=1)), axis=0) != 0
-            # also need to include zero, as this will need to be encoded.
-            # add one to index to get position of first new value instead of last old value
-            inds_change = np.concatenate((np.array([0]), np.where(value_changed)[0] + 1))
-
-            # get lengths for each repeat, including last one which extends until end of the line
-            run_lens = np.concatenate((np.array(inds_change[1:] - inds_change[:-1]),
-                                       np.array([nx - inds_change[-1]])))
-
-            # now build compressed list
-            for jj, rlen in zip(inds_change, run_lens):
-                v = row_rgb[:, jj]
-                length_bytes = erle_len2bytes(rlen)
-                pattern_compressed += length_bytes + [v[0], v[1], v[2]]
-
-    # bytes indicating image end
-    pattern_compressed += [0x00, 0x01, 0x00]
+    return pattern
 
-    return pattern_compressed
 
-
-def encode_rle(pattern: np.ndarray) -> list:
+def encode_rle(pattern: np.ndarray) -> bytes:
     """
     Compress pattern use run length encoding (RLE)
     row_rgb length encoding (RLE). Information is encoded as number of repeats
@@ -191,162 +407,618 @@ def encode_rle(pattern: np.ndarray) -> list:
     0          , n>=2      , n uncompressed RGB pixels follow
     n>0        , n/a       , repeat following RGB pixel n times
 
-    :param pattern:
+    Runs never continue past the end of a row. Unlike encode_erle(), every row ends with the end of line bytes, as
+    in the rows described by the programmer's guide and in the patterns from erle.encode_rle(). The tokens are
+    chosen by erle.tokenize_rle(), so this matches the dlpyc900 driver apart from the header and padding
+
+    :param pattern: uint8 3 x Ny x Nx array of RGB values, Ny x Nx array, or packed Ny x Nx array as produced by
+      pack_patterns()
     :return pattern_compressed:
     """
-    if pattern.dtype != np.uint8:
-        raise ValueError('pattern must be of type uint8')
+    image = _as_packed_pattern(pattern)
 
-    # if 2D pattern, expand this to RGB with pattern in B layer and RG=0
-    if pattern.ndim == 2:
-        pattern = np.concatenate((np.zeros((1,) + pattern.shape, dtype=np.uint8),
-                                  np.zeros((1,) + pattern.shape, dtype=np.uint8),
-                                  np.array(pattern[None, :, :], copy=True)), axis=0)
+    # bytes indicating image end
+    return erle.emit(image, *erle.tokenize_rle(image), n_short=256).tobytes() + b"\x00\x01"
 
-    if pattern.ndim != 3 and pattern.shape[0] != 3:
-        raise ValueError("Image data is wrong shape. Must be 3 x ny x nx, with RGB values in each layer.")
 
-    pattern_compressed = []
-    _, ny, nx = pattern.shape
+def encode_raw(pattern: np.ndarray) -> bytes:
+    """
+    Uncompressed pattern data. The three bytes of each pixel are sent in the same order as for encode_erle()
 
-    # loop over pattern rows
-    for ii in range(pattern.shape[1]):
-        row_rgb = pattern[:, ii, :]
+    :param pattern: uint8 3 x Ny x Nx array of RGB values, Ny x Nx array, or packed Ny x Nx array as produced by
+      pack_patterns()
+    :return pattern_data:
+    """
+    # tobytes() copies the strided view in C order, so the pixels are only copied once
+    if pattern.dtype == _packed_dtype:
+        return _packed_bytes(pattern)[..., 2::-1].tobytes()
 
-        # if this row_rgb is the same as the last row_rgb, can communicate this by sending length of row_rgb
-        # and then \x00\x01 (copy n pixels from previous line)
-        # todo: can also do this for shorter sequences than the entire row_rgb
-        if ii > 0 and np.array_equal(row_rgb, pattern[:, ii - 1, :]):
-            msb, lsb = erle_len2bytes(nx)
-            pattern_compressed += [0x00, 0x01, msb, lsb]
-        else:
+    pattern = _as_rgb_pattern(pattern)
+    return np.moveaxis(pattern, 0, -1).tobytes()
 
-            # find points along row where pixel value changes
-            # for RGB image, change happens when ANY pixel value changes
-            value_changed = np.sum(np.abs(np.diff(row_rgb, axis=1)), axis=0) != 0
-            # also need to include zero, as this will need to be encoded.
-            # add one to index to get position of first new value instead of last old value
-            inds_change = np.concatenate((np.array([0]), np.where(value_changed)[0] + 1))
-
-            # get lengths for each repeat, including last one which extends until end of the line
-            run_lens = np.concatenate((np.array(inds_change[1:] - inds_change[:-1]),
-                                       np.array([nx - inds_change[-1]])))
-
-            # now build compressed list
-            for jj, rlen in zip(inds_change, run_lens):
-                v = row_rgb[:, jj]
-                if rlen <= 255:
-                    pattern_compressed += [rlen, v[0], v[1], v[2]]
-                else:  # if run is longer than one byte, need to break it up
-
-                    counter = 0
-                    while counter < rlen:
-                        end_pt = np.min([counter + 255, rlen]) - 1
-                        current_len = end_pt - counter + 1
-                        pattern_compressed += [current_len, v[0], v[1], v[2]]
-
-                        counter = end_pt + 1
-            # todo: do I need an end of line character?
-
-    # todo: is this correct for RLE?
-    # bytes indicating image end
-    pattern_compressed += [0x00]
 
-    return pattern_compressed
+def encode_raw_parts(combined_patterns: np.ndarray,
+                     nsplit: int = 1,
+                     out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Uncompressed pattern data for a series of 24 bit RGB patterns, each split into nsplit parts along the
+    x-direction as in compress_pattern_parts(). The data of all parts is written to a single array with one copy,
+    and out[ii, jj] is the contiguous pattern data of part jj of pattern ii, identical to encode_raw() of that part.
+    The parts can be sent directly from this array, e.g. with memoryview(out[ii, jj]), without encoding or copying.
+
+    :param combined_patterns: N x 3 x Ny x Nx uint8 array, as produced by combine_patterns(), or packed
+      N x Ny x Nx array, as produced by pack_patterns()
+    :param nsplit: number of parts. Nx must be divisible by nsplit
+    :param out: N x nsplit x Ny x (Nx / nsplit) x 3 uint8 array to write the pattern data to. If None, a new array
+      is created.
+    :return out:
+    """
+    if combined_patterns.dtype == _packed_dtype:
+        combined_patterns = np.moveaxis(_packed_bytes(combined_patterns)[..., 2::-1], -1, 1)
+
+    n, _, ny, nx = combined_patterns.shape
+    if nx % nsplit != 0:
+        raise ValueError(f"pattern width {nx:d} cannot be split into {nsplit:d} parts")
+
+    shape = (n, nsplit, ny, nx // nsplit, 3)
+    if out is None:
+        out = np.empty(shape, dtype=np.uint8)
+    elif out.shape != shape or out.dtype != np.uint8:
+        raise ValueError(f"out must be a uint8 array of shape {shape}")
+
+    out[:] = combined_patterns.reshape(n, 3, ny, nsplit, nx // nsplit).transpose(0, 3, 2, 4, 1)
+    return out
+
+
+def estimate_compressed_size(pattern: np.ndarray,
+                             compression_mode: str = 'erle',
+                             nsample_rows: int = 64) -> int:
+    """
+    Estimate the size of a compressed pattern without compressing the whole pattern. The size of the first row
+    and of randomly chosen rows is computed, each together with the row above it which it may be copied from, and
+    scaled to the full pattern. The rows are random to avoid aliasing with periodic patterns, but the same rows
+    are always used. Patterns with few rows are compressed completely.
+
+    :param pattern: uint8 3 x Ny x Nx array of RGB values, Ny x Nx array, or packed Ny x Nx array as produced by
+      pack_patterns()
+    :param compression_mode: 'erle', 'rle', or 'none'
+    :param nsample_rows: number of rows to compute the size of, in addition to the first row
+    :return nbytes: estimated size as returned by compress_pattern()
+    """
+    if pattern.dtype != _packed_dtype:
+        pattern = _as_rgb_pattern(pattern)
+    ny, nx = pattern.shape[-2:]
+
+    if compression_mode == 'none':
+        return 3 * ny * nx
+
+    if ny <= 2 * nsample_rows:
+        return len(compress_pattern(pattern, compression_mode))
+
+    rows = np.sort(np.random.default_rng(0).choice(np.arange(1, ny), nsample_rows, replace=False))
+
+    # the first row, then pairs of rows. Only the first row and the second row of each pair are counted
+    sample_rows = np.concatenate(([0], np.stack((rows - 1, rows), axis=1).ravel()))
+    if compression_mode == 'erle':
+        starts, kinds, lengths = erle.tokenize(_as_packed_pattern(pattern, rows=sample_rows))
+        token_rows = starts // (nx + 1)
+        # no end of line tokens are sent, see encode_erle()
+        token_sizes = erle.token_size(kinds, lengths) * (kinds != erle.EOL)
+        nbytes_end = 3
+    elif compression_mode == 'rle':
+        starts, kinds, lengths = erle.tokenize_rle(_as_packed_pattern(pattern, rows=sample_rows))
+        token_rows = starts // (nx + 1)
+        # including the end of line tokens, see encode_rle()
+        token_sizes = erle.token_size(kinds, lengths, n_short=256)
+        nbytes_end = 2
+    else:
+        raise ValueError(f"compression mode was '{compression_mode:s}', but must be one of 'none', 'rle', or 'erle'")
+
+    nbytes_first = np.sum(token_sizes[token_rows == 0])
+    nbytes_sample = np.sum(token_sizes[np.logical_and(token_rows > 0, token_rows % 2 == 0)])
+
+    return int(round(nbytes_first + nbytes_sample * (ny - 1) / nsample_rows)) + nbytes_end
+
+
+def select_compression_mode(pattern: np.ndarray,
+                            nsample_rows: int = 64) -> str:
+    """
+    Choose the compression mode giving the smallest pattern, based on estimate_compressed_size()
+
+    :param pattern: uint8 3 x Ny x Nx array of RGB values, Ny x Nx array, or packed Ny x Nx array
+    :param nsample_rows: number of rows used to estimate the sizes
+    :return compression_mode: 'erle', 'rle', or 'none'
+    """
+    # ties go to the first, so raw data is only used when compression does not help
+    modes = ['erle', 'rle', 'none']
+    sizes = [estimate_compressed_size(pattern, m, nsample_rows=nsample_rows) for m in modes]
+    return modes[int(np.argmin(sizes))]
 
 
 def decode_erle(dmd_size,
-                pattern_bytes: list):
+                pattern_bytes,
+                out: Optional[np.ndarray] = None,
+                compression_mode: str = 'erle') -> np.ndarray:
     """
-    Decode pattern from ERLE or RLE.
+    Decode pattern from ERLE or RLE. See encode_erle() and encode_rle() for a description of the formats.
 
     :param dmd_size: [ny, nx]
-    :param pattern_bytes: list of bytes representing encoded pattern
-    :return rgb_pattern:
+    :param pattern_bytes: bytes-like object or list of bytes representing encoded pattern
+    :param out: array to write the pattern to, either a uint8 3 x ny x nx array, or a uint32 ny x nx array of
+      packed pixels as produced by _pack_rgb(). If None, a new uint8 3 x ny x nx array is created.
+    :param compression_mode: 'erle' or 'rle'
+    :return rgb_pattern: the pattern, i.e. out if it was provided
     """
+    rle = _is_rle(compression_mode)
 
-    ii = 0  # counter tracking position in compressed byte array
-    line_no = 0  # counter tracking line number
-    line_pos = 0  # counter tracking next position to write in line
-    current_line = np.zeros((3, dmd_size[1]), dtype=np.uint8)
-    rgb_pattern = np.zeros((3, 0, dmd_size[1]), dtype=np.uint8)
-    # todo: maybe should rewrite popping everything to avoid dealing with at least one counter?
-    while ii < len(pattern_bytes):
-
-        # reset each new line
-        if line_pos == dmd_size[1]:
-            rgb_pattern = np.concatenate((rgb_pattern, current_line[:, None, :]), axis=1)
-            current_line = np.zeros((3, dmd_size[1]), dtype=np.uint8)
-            line_pos = 0
-            line_no += 1
-        elif line_pos >= dmd_size[1]:
-            raise ValueError("While reading line %d, length of line exceeded expected value" % line_no)
-
-        # end of image denoted by single 0x00 byte
-        if ii == len(pattern_bytes) - 1:
-            if pattern_bytes[ii] == 0:
-                break
-            else:
-                raise ValueError('Image not terminated with 0x00')
+    try:
+        data = np.frombuffer(pattern_bytes, dtype=np.uint8)
+    except TypeError:
+        data = np.asarray(pattern_bytes, dtype=np.uint8)
+
+    starts, _ = _erle_parse(data, rle=rle)
+    image_end = _erle_end_of_image(data, starts, rle=rle)
+    if not np.any(image_end):
+        raise ValueError(f"Image not terminated with end of image bytes {'0x00 0x01' if rle else '0x00 0x01 0x00'}")
 
-        # control byte of zero indicates special response
-        if pattern_bytes[ii] == 0:
+    starts = starts[:np.argmax(image_end)]
 
-            # end of line
-            if pattern_bytes[ii + 1] == 0:
-                ii += 1
+    return _erle_decode_tokens(data, starts, dmd_size, out, rle=rle)
+
+
+def decode_erle_stream(dmd_size,
+                       chunks,
+                       out: Optional[np.ndarray] = None,
+                       compression_mode: str = 'erle'):
+    """
+    Decode a stream of concatenated ERLE or RLE patterns incrementally, for example while reading them from a file
+    or collecting the data sent in PATMEM_LOAD_DATA commands. Chunks are collected until there are at least 64 kB
+    of new data, which are then parsed once. Each pattern is decoded as soon as its end of image bytes are parsed.
+
+    :param dmd_size: [ny, nx]
+    :param chunks: iterable of bytes-like objects. Patterns may be split across chunks at any byte.
+    :param out: array to decode each pattern to, see decode_erle(). If provided, it is overwritten by every
+      pattern, so copy patterns which should be kept.
+    :param compression_mode: 'erle' or 'rle'. All patterns in the stream must use the same mode
+    :return: generator yielding the decoded patterns
+    """
+    rle = _is_rle(compression_mode)
+    end_of_image_bytes = 2 if rle else 3
+
+    # parsing has a fixed overhead, so small chunks are collected first
+    min_parse_bytes = 2 ** 16
+
+    # bytes from the start of the current pattern, and the starts of its tokens which have been parsed
+    buffer = bytearray()
+    starts = []
+    # position of the first token which has not been parsed
+    pos = 0
+    # None marks the end of the stream
+    for chunk in chain(chunks, [None]):
+        if chunk is not None:
+            buffer += chunk
+            if len(buffer) - pos < min_parse_bytes:
                 continue
 
-            # copy bytes from previous lines
-            elif pattern_bytes[ii + 1] == 1:
-                if pattern_bytes[ii + 2] < 128:
-                    n_to_copy = pattern_bytes[ii + 2]
-                    ii += 3
-                else:
-                    n_to_copy = erle_bytes2len(pattern_bytes[ii + 2:ii + 4])
-                    ii += 4
+        data = np.frombuffer(bytes(buffer[pos:]), dtype=np.uint8)
+        new_starts, next_pos = _erle_parse(data, rle=rle)
+        image_ends = np.flatnonzero(_erle_end_of_image(data, new_starts, rle=rle))
+        new_starts += pos
+        pos += next_pos
 
-                # copy bytes from same position in previous line
-                current_line[:, line_pos:line_pos + n_to_copy] = \
-                    rgb_pattern[:, line_no-1, line_pos:line_pos + n_to_copy]
-                line_pos += n_to_copy
+        pattern_start = 0
+        first_token = 0
+        for image_end in image_ends:
+            starts.append(new_starts[first_token:image_end])
+            image_end_pos = new_starts[image_end]
+            pattern_data = np.frombuffer(bytes(buffer[pattern_start:image_end_pos]), dtype=np.uint8)
 
-            # next n bytes unencoded
-            else:
-                if pattern_bytes[ii + 1] < 128:
-                    n_unencoded = pattern_bytes[ii + 1]
-                    ii += 2
-                else:
-                    n_unencoded = erle_bytes2len(pattern_bytes[ii + 1:ii + 3])
-                    ii += 3
+            yield _erle_decode_tokens(pattern_data, np.concatenate(starts) - pattern_start, dmd_size, out, rle=rle)
 
-                for jj in range(n_unencoded):
-                    current_line[0, line_pos + jj] = int(pattern_bytes[ii + 3*jj])
-                    current_line[1, line_pos + jj] = int(pattern_bytes[ii + 3*jj + 1])
-                    current_line[2, line_pos + jj] = int(pattern_bytes[ii + 3*jj + 2])
+            starts = []
+            pattern_start = image_end_pos + end_of_image_bytes
+            first_token = image_end + 1
 
-                ii += 3 * n_unencoded
-                line_pos += n_unencoded
+        starts.append(new_starts[first_token:])
 
-            continue
+        # drop decoded patterns
+        if pattern_start > 0:
+            del buffer[:pattern_start]
+            pos -= pattern_start
+            starts = [s - pattern_start for s in starts]
 
-        # control byte != 0, regular decoding
-        # get block len
-        if pattern_bytes[ii] < 128:
-            block_len = pattern_bytes[ii]
-            ii += 1
-        else:
-            block_len = erle_bytes2len(pattern_bytes[ii:ii + 2])
-            ii += 2
+    if any(buffer):
+        raise ValueError("stream ended before the end of image bytes of the last pattern")
+
+
+def _is_rle(compression_mode: str) -> bool:
+    """
+    Check the compression mode of a pattern to decode
+
+    :param compression_mode: 'erle' or 'rle'
+    :return rle: True for RLE
+    """
+    if compression_mode not in ('erle', 'rle'):
+        raise ValueError(f"compression mode was '{compression_mode:s}', but only 'erle' and 'rle' can be decoded")
+
+    return compression_mode == 'rle'
+
+
+def _erle_parse(data: np.ndarray,
+                rle: bool = False) -> (np.ndarray, int):
+    """
+    Find the start of every complete ERLE token in data, when decoding from the first byte.
+
+    Following the tokens is inherently sequential, as the position of each token depends on the size of the one
+    before it. Instead, the size of the token which would start at every byte is found at once. The data is split
+    into blocks, and for every byte the first token after the end of its block is found by working backwards through
+    all blocks together. The tokens where the decoding enters each block are then found one block at a time, and
+    finally the tokens inside the blocks are followed for all blocks together.
+
+    Arrays are indexed by position in the block and then by block, so each step backwards reads contiguous memory.
+    Working backwards takes one step per position in a block. Doubling the steps instead, by jumping to the token
+    after next, did fewer steps but took 8 to 10 times as long, as every step works on all bytes.
+
+    :param data: uint8 array
+    :param rle: if True, find RLE tokens instead. Their lengths are always one byte, there are no copy tokens, and
+      0x00 0x01 is the two byte end of image
+    :return starts, next_pos: the starts of all complete tokens, and the start of the first incomplete token, or
+      len(data) if there is none
+    """
+    block_size = 256
+
+    ndata = len(data)
+    if ndata == 0:
+        return np.zeros(0, dtype=np.int64), 0
+    nblocks = -(-ndata // block_size)
+
+    # bytes of each block, and the first two bytes of the next block, shape = (block_size + 2, nblocks). The
+    # blocks are transposed as 4 byte words first, then the bytes of the words, which is much faster than
+    # transposing the bytes directly
+    padded = np.zeros((nblocks + 1) * block_size, dtype=np.uint8)
+    padded[:ndata] = data
+    words = np.ascontiguousarray(padded.view("<u4").reshape(nblocks + 1, block_size // 4).T)
+    word_bytes = words.view(np.uint8).reshape(block_size // 4, nblocks + 1, 4)
+    block_bytes = np.empty((block_size + 2, nblocks), dtype=np.uint8)
+    block_bytes[:block_size].reshape(block_size // 4, 4, nblocks)[:] = word_bytes[:, :-1].transpose(0, 2, 1)
+    block_bytes[block_size:] = word_bytes[0, 1:, :2].T
+
+    # size of the token starting at each byte, including those which run past the end of the data. A token is a
+    # repeat unless its first byte is zero, then the next two bytes give its type and length
+    ctrl1 = block_bytes[:block_size]
+    ctrl2 = block_bytes[1:block_size + 1]
+    ctrl3 = block_bytes[2:]
+    is_zero = ctrl1 == 0
+    if rle:
+        # end of line, end of image, or uncompressed pixels
+        sizes = np.full((block_size, nblocks), 4, dtype=np.int32)
+        zeros = np.flatnonzero(is_zero)
+        lengths = ctrl2.ravel()[zeros].astype(np.int32)
+        sizes.ravel()[zeros] = 2 + 3 * lengths * (lengths > 1)
+    elif np.count_nonzero(is_zero) > is_zero.size // 4:
+        # end of line, copy or uncompressed pixels, at every byte. Faster than selecting the zeros if there are many
+        two_bytes = ctrl2 >> 7
+        sizes = np.multiply(ctrl3, two_bytes, dtype=np.int32)
+        sizes <<= 7
+        sizes |= ctrl2 & 0x7F
+        sizes *= 3
+        sizes += 2 + two_bytes
+        sizes -= (ctrl2 == 1) * (2 - (ctrl3 >> 7))
+        sizes *= is_zero
+        sizes += ((ctrl1 >> 7) + 4) * ~is_zero
+    else:
+        sizes = np.add(ctrl1 >> 7, 4, dtype=np.int32)
+        zeros = np.flatnonzero(is_zero)
+        zero_ctrl2 = ctrl2.ravel()[zeros].astype(np.int32)
+        zero_ctrl3 = ctrl3.ravel()[zeros].astype(np.int32)
+        two_bytes = zero_ctrl2 >> 7
+        lengths = (zero_ctrl2 & 0x7F) | (zero_ctrl3 << 7) * two_bytes
+        sizes.ravel()[zeros] = 2 + two_bytes + 3 * lengths - (zero_ctrl2 == 1) * (2 - (zero_ctrl3 >> 7))
+
+    # first token after the end of the block, starting from each byte. Tokens have at least two bytes, so the
+    # next token from the last byte of a block is always in a later block
+    next_in_block = sizes
+    next_in_block += np.arange(block_size, dtype=np.int32)[:, None]
+    exits_in_block = np.zeros((block_size, nblocks), dtype=np.int32)
+    exits_in_block[-1] = next_in_block[-1]
+    exits_flat = exits_in_block.ravel()
+    block_inds = np.arange(nblocks, dtype=np.int32)
+    for ii in range(block_size - 2, -1, -1):
+        next_pos = next_in_block[ii]
+        exits_in_block[ii] = np.where(next_pos < block_size,
+                                      exits_flat[np.minimum(next_pos, block_size - 1) * nblocks + block_inds],
+                                      next_pos)
+    exits_in_block += block_inds * block_size
+
+    # first token in each block which is reached
+    # memoryviews are much faster than arrays for scalar indexing
+    exits_view = memoryview(exits_flat)
+    entries = []
+    pos = 0
+    while pos < ndata:
+        entries.append(pos)
+        pos = exits_view[(pos % block_size) * nblocks + pos // block_size]
+
+    # follow the tokens inside all reached blocks at once
+    is_start = np.zeros(nblocks * block_size, dtype=bool)
+    entries = np.array(entries, dtype=np.int32)
+    blocks = entries // block_size
+    pos = entries - blocks * block_size
+    next_flat = next_in_block.ravel()
+    while pos.size:
+        is_start[blocks * block_size + pos] = True
+        pos = next_flat[pos * nblocks + blocks]
+        inside = pos < block_size
+        pos = pos[inside]
+        blocks = blocks[inside]
+
+    starts = np.flatnonzero(is_start[:ndata])
+
+    # drop the last token if it runs past the end of the data
+    if len(starts) > 0:
+        last = int(starts[-1])
+        if last // block_size * block_size + next_in_block[last % block_size, last // block_size] > ndata:
+            return starts[:-1], last
+
+    return starts, ndata
+
+
+def _erle_end_of_image(data: np.ndarray,
+                       starts: np.ndarray,
+                       rle: bool = False) -> np.ndarray:
+    """
+    Find which tokens are the end of image bytes 0x00 0x01 0x00, or 0x00 0x01 for RLE
+
+    :param data: uint8 array
+    :param starts: starts of complete tokens, as returned by _erle_parse()
+    :param rle: if True, the tokens are RLE tokens
+    :return is_end:
+    """
+    # only copy tokens can start with 0x00 0x01, and if they are complete they have at least three bytes
+    is_copy = np.logical_and(data[starts] == 0, data[np.minimum(starts + 1, len(data) - 1)] == 1)
+    if rle:
+        return is_copy
+
+    is_end = np.zeros(len(starts), dtype=bool)
+    is_end[is_copy] = data[starts[is_copy] + 2] == 0
+
+    return is_end
+
+
+def _erle_decode_tokens(data: np.ndarray,
+                        starts: np.ndarray,
+                        dmd_size,
+                        out: Optional[np.ndarray] = None,
+                        rle: bool = False) -> np.ndarray:
+    """
+    Decode the pixels of ERLE tokens
+
+    :param data: uint8 array
+    :param starts: the starts of all tokens of the pattern, excluding the end of image token
+    :param dmd_size: [ny, nx]
+    :param out: see decode_erle()
+    :param rle: if True, the tokens are RLE tokens, see _erle_parse()
+    :return rgb_pattern:
+    """
+    ny, nx = dmd_size
+
+    if out is None:
+        out = np.zeros((3, ny, nx), dtype=np.uint8)
 
-        # write values to lists for rgb colors
-        current_line[0, line_pos:line_pos + block_len] = np.asarray([pattern_bytes[ii]] * block_len, dtype=np.uint8)
-        current_line[1, line_pos:line_pos + block_len] = np.asarray([pattern_bytes[ii + 1]] * block_len, dtype=np.uint8)
-        current_line[2, line_pos:line_pos + block_len] = np.asarray([pattern_bytes[ii + 2]] * block_len, dtype=np.uint8)
-        ii += 3
-        line_pos += block_len
+    if out.shape == (ny, nx) and out.dtype == np.uint32:
+        image = out
+    elif out.shape == (3, ny, nx) and out.dtype == np.uint8:
+        image = np.zeros((ny, nx), dtype="<u4")
+    else:
+        raise ValueError(f"out must be a uint8 array of shape {(3, ny, nx)} or a uint32 array of shape {(ny, nx)}")
+
+    # token types and lengths
+    padded = np.zeros(len(data) + 4, dtype=np.int32)
+    padded[:len(data)] = data
+    ctrl1 = padded[starts]
+    ctrl2 = padded[starts + 1]
+    is_repeat = ctrl1 != 0
+    is_end_of_line = np.logical_and(np.logical_not(is_repeat), ctrl2 == 0)
+    is_copy = np.logical_and(np.logical_not(is_repeat), ctrl2 == 1)
+    is_literal = np.logical_and(np.logical_not(is_repeat), ctrl2 >= 2)
+
+    length_pos = starts + np.logical_not(is_repeat) + is_copy
+    lengths = padded[length_pos].astype(np.int64)
+    two_bytes = np.zeros(len(starts), dtype=np.int64) if rle else lengths >> 7
+    lengths += ((padded[length_pos + 1] * two_bytes) << 7) - (two_bytes << 7)
+    lengths[is_end_of_line] = 0
+    values_pos = length_pos + 1 + two_bytes
+
+    # position of each token in the pattern. An end of line moves to the start of the next line, unless the
+    # line is already complete
+    cumulative_lengths = np.cumsum(lengths) - lengths
+    npixels = cumulative_lengths[-1] + lengths[-1] if len(starts) > 0 else 0
+    if np.any(is_end_of_line):
+        line = np.cumsum(is_end_of_line) - is_end_of_line
+        line_start_token = np.flatnonzero(np.concatenate(([True], is_end_of_line[:-1])))
+        line_lengths = np.diff(np.append(cumulative_lengths[line_start_token], npixels))
+        line_nlines = -(-line_lengths // nx)
+        line_pixel_start = nx * (np.cumsum(line_nlines) - line_nlines)
+        pixel_starts = line_pixel_start[line] + cumulative_lengths - cumulative_lengths[line_start_token][line]
+    else:
+        pixel_starts = cumulative_lengths
+
+    if np.any(pixel_starts % nx + lengths > nx) or np.any(pixel_starts + lengths > ny * nx):
+        raise ValueError("length of line exceeded expected value")
+
+    # repeated pixels. Copied pixels are marked by setting the unused fourth byte, and filled in later. The R, G, B
+    # bytes are packed as B, G, R, see _pack_rgb()
+    copy_marker = 1 << 24
+    token_values = padded[values_pos] << 16 | padded[values_pos + 1] << 8 | padded[values_pos + 2]
+    token_values[is_copy] = copy_marker
+    pixel_values = np.repeat(token_values.astype(np.uint32), lengths)
+
+    literal_lengths = lengths[is_literal]
+    if literal_lengths.sum() >= 64 * literal_lengths.size > 0:
+        # a few long blocks of uncompressed pixels, e.g. from noise, are copied as slices of the R G B bytes
+        pixel_bytes = pixel_values.view(np.uint8).reshape(-1, 4)[:, 2::-1]
+        for dst, src, n in zip(cumulative_lengths[is_literal].tolist(), values_pos[is_literal].tolist(),
+                               literal_lengths.tolist()):
+            pixel_bytes[dst:dst + n] = data[src:src + 3 * n].reshape(n, 3)
+    elif literal_lengths.size > 0:
+        # uncompressed pixels. The shift from output index to the position of the RGB bytes is fixed within a block
+        literal_block_start = np.cumsum(literal_lengths) - literal_lengths
+        literal_dst = np.repeat(cumulative_lengths[is_literal] - literal_block_start, literal_lengths) + \
+                      np.arange(np.sum(literal_lengths))
+        literal_src = np.repeat(values_pos[is_literal] - 3 * cumulative_lengths[is_literal], literal_lengths) + \
+                      3 * literal_dst
+        pixel_values[literal_dst] = padded[literal_src] << 16 | padded[literal_src + 1] << 8 | padded[literal_src + 2]
+
+    image_flat = image.reshape(-1)
+    if np.array_equal(pixel_starts, cumulative_lengths):
+        image_flat[:npixels] = pixel_values
+        image_flat[npixels:] = 0
+    else:
+        pixels = np.repeat(pixel_starts - cumulative_lengths, lengths) + np.arange(npixels)
+        image_flat[:] = 0
+        image_flat[pixels] = pixel_values
+
+    # copied pixels take the value of the nearest pixel above them which is not copied
+    if np.any(is_copy):
+        copied = image >= copy_marker
+        if np.any(copied[0]):
+            raise ValueError("pixels in the first line cannot be copied from the previous line")
+
+        source_line = np.multiply(np.arange(ny, dtype=np.int32)[:, None], ~copied, dtype=np.int32)
+        np.maximum.accumulate(source_line, axis=0, out=source_line)
+        image[:] = np.take_along_axis(image, source_line, axis=0)
+
+    if image is not out:
+        image_bytes = image.view(np.uint8).reshape(ny, nx, 4)
+        for ii in range(3):
+            out[ii] = image_bytes[..., 2 - ii]
+
+    return out
 
-    return rgb_pattern
+
+def validate_compressed_pattern(compressed_pattern,
+                                compression_mode: str,
+                                dmd_size,
+                                header: Optional[bytes] = None):
+    """
+    Check that a compressed pattern can be decoded to an image of the given size, so malformed patterns are caught
+    before they are sent to the DMD.
+
+    This is a debugging aid, e.g. for new encoders, and uploads only call it when asked to. The tokens are found
+    with _erle_parse() and checked all at once, and the first error in the pattern is reported. Most of the time is
+    spent parsing, which does the same work for every byte, so patterns with few long tokens take as long as those
+    with many short ones.
+
+    Rows end when they are complete, and may be followed by one end of line token. Tokens may not run past the end
+    of a row, and copy tokens are not allowed in the first row. The pattern must end with the end of image bytes
+    after the last row, followed by at most three bytes of zero padding.
+
+    :param compressed_pattern: bytes-like object, as returned by compress_pattern()
+    :param compression_mode: 'erle', 'rle', or 'none'
+    :param dmd_size: [ny, nx] size of the pattern, i.e. of one half of the DMD for dual controller models
+    :param header: if provided, the 48 byte header sent before the pattern, see _pattern_header(). The size,
+      number of bytes, and compression mode it contains are checked against the pattern.
+    :return:
+    """
+    ny, nx = dmd_size
+
+    try:
+        data = np.frombuffer(compressed_pattern, dtype=np.uint8)
+    except TypeError:
+        data = np.asarray(compressed_pattern, dtype=np.uint8)
+    ndata = len(data)
+
+    if compression_mode not in _compression_mode_names:
+        raise ValueError(f"compression mode was '{compression_mode:s}', but must be one of {_compression_mode_names}")
+
+    if header is not None:
+        if len(header) != 48 or bytes(header[:4]) != b"Spld":
+            raise ValueError("header must be 48 bytes starting with the signature 'Spld'")
+
+        width, height, nbytes = unpack_from('<HHI', header, 4)
+        if (height, width) != (ny, nx):
+            raise ValueError(f"header has pattern size {height:d} x {width:d}, but expected {ny:d} x {nx:d}")
+        if nbytes != ndata:
+            raise ValueError(f"header gives {nbytes:d} bytes, but the pattern has {ndata:d} bytes")
+        if header[25] != _compression_mode_names.index(compression_mode):
+            raise ValueError(f"header has compression byte {header[25]:d}, but the pattern is '{compression_mode:s}'")
+
+    if compression_mode == 'none':
+        if ndata != 3 * ny * nx:
+            raise ValueError(f"uncompressed pattern has {ndata:d} bytes, but expected {3 * ny * nx:d}")
+        return
+
+    # control bytes of each token. The length is the first byte of a repeat, the second byte of uncompressed pixels,
+    # or the third byte of a copy, and continues in the next byte for long ERLE tokens
+    is_rle = compression_mode == 'rle'
+    starts, next_pos = _erle_parse(data, rle=is_rle)
+    padded = np.zeros(ndata + 4, dtype=np.uint8)
+    padded[:ndata] = data
+    ctrl1, ctrl2, ctrl3, ctrl4 = (padded[starts + ii].astype(np.int32) for ii in range(4))
+
+    # tokens up to the first end of image, which is parsed as a copy token for ERLE
+    image_end = np.logical_and(ctrl1 == 0, ctrl2 == 1)
+    if not is_rle:
+        image_end &= ctrl3 == 0
+    terminated = np.any(image_end)
+    if terminated:
+        ntokens = np.argmax(image_end)
+        end_start = int(starts[ntokens])
+        starts, ctrl1, ctrl2, ctrl3, ctrl4 = (a[:ntokens] for a in (starts, ctrl1, ctrl2, ctrl3, ctrl4))
+
+    is_repeat = ctrl1 != 0
+    is_end_of_line = np.logical_and(np.logical_not(is_repeat), ctrl2 == 0)
+    is_copy = np.logical_and(np.logical_not(is_repeat), ctrl2 == 1)
+    is_literal = np.logical_and(np.logical_not(is_repeat), ctrl2 >= 2)
+    lengths = ctrl1 * is_repeat + ctrl2 * is_literal + ctrl3 * is_copy
+    if not is_rle:
+        # ERLE lengths take two bytes if the first is at least 128
+        two_bytes = lengths >> 7
+        lengths += ((ctrl2 * is_repeat + ctrl3 * is_literal + ctrl4 * is_copy) * two_bytes - two_bytes) << 7
+
+    # pixels before each token. Rows end when they are complete, so tokens may not run past the end of a row, and
+    # an end of line is only allowed directly after a complete row which is not preceded by another end of line
+    npixels = ny * nx
+    pixels = np.cumsum(lengths, dtype=np.int64) - lengths
+    row_pixels = pixels % nx
+    after_end_of_line = np.concatenate(([False], is_end_of_line[:-1]))
+    bad_end_of_line = is_end_of_line & ((pixels < nx) | (row_pixels != 0) | after_end_of_line)
+    bad_copy = is_copy & (pixels < nx)
+    bad_length = np.logical_not(is_end_of_line) & ((lengths == 0) | (row_pixels + lengths > nx) |
+                                                   (pixels >= npixels))
+    bad = np.flatnonzero(bad_end_of_line | bad_copy | bad_length)
+
+    if bad.size > 0:
+        ii = bad[0]
+        pos = starts[ii]
+        row = min(pixels[ii] // nx, ny)
+        if bad_end_of_line[ii]:
+            done = nx if row == ny else row_pixels[ii]
+            raise ValueError(f"end of line at byte {pos:d} after {done:d} pixels of row {row:d}, "
+                             f"but rows have {nx:d} pixels")
+        if bad_copy[ii]:
+            raise ValueError(f"copy token at byte {pos:d} is in the first row, which has no previous row")
+        if row == ny:
+            raise ValueError(f"token at byte {pos:d} is after the last row")
+        if lengths[ii] == 0:
+            raise ValueError(f"token at byte {pos:d} has zero length")
+        raise ValueError(f"token at byte {pos:d} with {lengths[ii]:d} pixels runs past the end of row {row:d}, "
+                         f"which has {nx - row_pixels[ii]:d} pixels left")
+
+    if not terminated:
+        if next_pos < ndata:
+            raise ValueError(f"pattern ended inside the token at byte {next_pos:d}, before the end of image bytes")
+        raise ValueError(f"pattern ended at byte {ndata:d} before the end of image bytes")
+
+    decoded_pixels = int(pixels[-1] + lengths[-1]) if len(starts) > 0 else 0
+    if decoded_pixels != npixels:
+        raise ValueError(f"end of image at byte {end_start:d} after {decoded_pixels:d} pixels, "
+                         f"but the pattern has {npixels:d} pixels")
+
+    padding = data[end_start + (2 if is_rle else 3):]
+    if len(padding) > 3 or np.any(padding):
+        raise ValueError(f"{len(padding):d} bytes after the end of image at byte {end_start:d}, "
+                         f"only up to 3 bytes of zero padding are allowed")
 
 
 def erle_len2bytes(length: int) -> list:
@@ -406,9 +1078,743 @@ def erle_bytes2len(byte_list: list) -> int:
     return length
 
 
+##############################################
+# compress patterns for upload
+##############################################
+class encoded_pattern_cache(frame_cache):
+    """
+    On-disk cache of compressed patterns, so that patterns which are uploaded repeatedly only need to be compressed
+    once. This is the cache of the dlpyc900 driver, see frame_cache, with keys built in two steps: the pattern is
+    hashed once, and the hash is combined with the settings which determine the compressed bytes of each part.
+    When the files exceed max_bytes in total, the least recently used are deleted.
+
+    The cache can be shared between processes, as entries are written to a temporary file which is then renamed.
+    """
+
+    # format of the entries, which is part of every key, so entries in an older format are never read. Increase it
+    # whenever the entries or the hashed patterns change. Version 2 entries start with the compression mode byte,
+    # and packed patterns are hashed in the layout of pack_patterns()
+    format_version = 2
+
+    @staticmethod
+    def hash_pattern(pattern: np.ndarray) -> str:
+        """
+        Hash of pattern data, including its shape and dtype
+
+        :param pattern: array
+        :return pattern_hash:
+        """
+        pattern = np.ascontiguousarray(pattern)
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f"{pattern.shape}{pattern.dtype.str}".encode())
+        h.update(pattern.data)
+        return h.hexdigest()
+
+    @classmethod
+    def key(cls, pattern_hash: str, *settings) -> str:
+        """
+        Cache key for a pattern compressed with given settings, in the entry format format_version
+
+        :param pattern_hash: hash of the pattern from hash_pattern()
+        :param settings: everything else which determines the compressed bytes, e.g. the compression mode.
+          These must have a stable repr()
+        :return key:
+        """
+        h = hashlib.blake2b(digest_size=20)
+        h.update(pattern_hash.encode())
+        h.update(repr((cls.format_version,) + settings).encode())
+        return h.hexdigest()
+
+
+def compress_pattern(pattern: np.ndarray,
+                     compression_mode: str = 'erle',
+                     optimal_encoding: bool = False) -> bytes:
+    """
+    Compress a single 24 bit RGB pattern for upload to the DMD
+
+    :param pattern: 3 x Ny x Nx uint8 array, or packed Ny x Nx array as produced by pack_patterns()
+    :param compression_mode: 'erle', 'rle', or 'none'
+    :param optimal_encoding: if True, use the slower encoding which produces the fewest bytes. This is meant
+      for patterns compressed ahead of time, see encode_erle()
+    :return compressed_pattern:
+    """
+    if compression_mode == 'none':
+        return encode_raw(pattern)
+    elif compression_mode == 'rle':
+        return encode_rle(pattern)
+    elif compression_mode == 'erle':
+        return encode_erle(pattern, optimal=optimal_encoding)
+    else:
+        raise ValueError(f"compression mode was '{compression_mode:s}', but must be one of 'none', 'rle', or 'erle'")
+
+
+# compression modes, indexed by the compression byte of the pattern header
+_compression_mode_names = ('none', 'rle', 'erle')
+
+
+def _compress_part(pattern: np.ndarray,
+                   compression_mode: str,
+                   optimal_encoding: bool) -> (str, bytes):
+    """
+    Compress pattern, choosing the compression mode first if compression_mode is 'auto'
+
+    :return compression_mode, compressed_pattern:
+    """
+    if compression_mode == 'auto':
+        compression_mode = select_compression_mode(pattern)
+
+    return compression_mode, compress_pattern(pattern, compression_mode, optimal_encoding)
+
+
+def compress_pattern_parts(pattern: np.ndarray,
+                           nsplit: int = 1,
+                           compression_mode: str = 'erle',
+                           optimal_encoding: bool = False,
+                           threads: int = 1) -> (list, list):
+    """
+    Split pattern into parts along the x-direction and compress each part. ERLE parts are encoded together with
+    encode_erle_split(), which avoids copying the parts.
+
+    :param pattern: 3 x Ny x Nx uint8 array, or packed Ny x Nx array as produced by pack_patterns()
+    :param nsplit: number of parts
+    :param compression_mode: 'erle', 'rle', 'none', or 'auto'
+    :param optimal_encoding: see encode_erle()
+    :param threads: number of threads used to encode ERLE parts, see encode_erle_split()
+    :return compression_modes, compressed_parts:
+    """
+    if compression_mode == 'erle' and pattern.shape[-1] % nsplit == 0:
+        return [compression_mode] * nsplit, encode_erle_split(pattern,
+                                                              nsplit=nsplit,
+                                                              optimal=optimal_encoding,
+                                                              threads=threads)
+
+    modes = []
+    compressed_parts = []
+    for p in np.array_split(pattern, nsplit, axis=-1):
+        mode, compressed = _compress_part(p, compression_mode, optimal_encoding)
+        modes.append(mode)
+        compressed_parts.append(compressed)
+
+    return modes, compressed_parts
+
+
+def compress_patterns(combined_patterns: np.ndarray,
+                      compression_mode: str = 'erle',
+                      optimal_encoding: bool = False,
+                      nsplit: int = 1,
+                      workers: int = 1,
+                      order: Optional[Sequence[int]] = None,
+                      cache: Optional[encoded_pattern_cache] = None,
+                      threads: int = 1):
+    """
+    Compress a series of 24 bit RGB patterns, as produced by pack_patterns() or combine_patterns(), for upload to
+    the DMD.
+    Each pattern can be split along its last axis before compressing, as is needed for the two controllers
+    of the DLP9000.
+
+    If workers > 1, the patterns are compressed in a pool of processes. The patterns are shared with the processes
+    through shared memory, and the processes write the compressed patterns back to shared memory. Compressed
+    patterns are yielded as soon as they are ready, so they can be uploaded while later patterns are compressed.
+    The pool is kept between calls, see _get_compress_pool(), and if the generator is closed before all patterns
+    are yielded, the patterns which have not started compressing are cancelled.
+
+    :param combined_patterns: packed N x Ny x Nx array, or N x 3 x Ny x Nx uint8 array
+    :param compression_mode: 'erle', 'rle', 'none', or 'auto'. If 'auto', each part is compressed with the mode
+      which gives the smallest size, see select_compression_mode()
+    :param optimal_encoding: if True, use the slower encoding which produces the fewest bytes. This is meant
+      for patterns compressed ahead of time, see encode_erle()
+    :param nsplit: number of parts to split each pattern into along the x-direction
+    :param workers: number of processes to use. If 1, compress the patterns in this process as they are requested.
+    :param order: order to compress the patterns in. If None, use the order of combined_patterns.
+    :param cache: if provided, parts found in the cache are not compressed again, and newly compressed parts
+      are added to the cache
+    :param threads: if workers is 1, the number of threads used to encode each pattern, see encode_erle_split().
+      This is meant for when only a few patterns are compressed, where a process pool has nothing to run in parallel
+    :return: generator yielding (index, compressed_parts, compression_modes), where compressed_parts is a list of
+      the nsplit compressed parts of the pattern combined_patterns[index], and compression_modes gives the
+      compression mode used for each part
+    """
+    if order is None:
+        order = range(len(combined_patterns))
+
+    def part_key(ii, jj):
+        # hash of the full combined pattern, so it is only computed once for all parts
+        if ii not in pattern_hashes:
+            pattern_hashes[ii] = cache.hash_pattern(combined_patterns[ii])
+        return cache.key(pattern_hashes[ii], jj, nsplit, compression_mode, optimal_encoding)
+
+    pattern_hashes = {}
+
+    # cache entries start with the compression byte, as the mode is not known in advance for 'auto'
+    def cache_get(ii, jj):
+        data = cache.get(part_key(ii, jj))
+        if data is None:
+            return None
+        return _compression_mode_names[data[0]], data[1:]
+
+    def cache_put(ii, jj, mode, compressed):
+        cache.put(part_key(ii, jj), bytes([_compression_mode_names.index(mode)]) + compressed)
+
+    def cache_get_all(ii):
+        # parts are compressed together, so only use the cache if all parts are present
+        cached_parts = [cache_get(ii, jj) for jj in range(nsplit)]
+        if any(c is None for c in cached_parts):
+            return None
+        return [c[0] for c in cached_parts], [c[1] for c in cached_parts]
+
+    if workers <= 1:
+        for ii in order:
+            cached = None if cache is None else cache_get_all(ii)
+            if cached is not None:
+                modes, compressed_parts = cached
+            else:
+                modes, compressed_parts = compress_pattern_parts(combined_patterns[ii],
+                                                                 nsplit,
+                                                                 compression_mode,
+                                                                 optimal_encoding,
+                                                                 threads=threads)
+                if cache is not None:
+                    for jj, (mode, compressed) in enumerate(zip(modes, compressed_parts)):
+                        cache_put(ii, jj, mode, compressed)
+
+            yield ii, compressed_parts, modes
+        return
+
+    combined_patterns = np.ascontiguousarray(combined_patterns)
+    ny, nx = combined_patterns.shape[-2:]
+
+    # look up all patterns first, so only the missing ones are sent to the pool
+    cached = {}
+    if cache is not None:
+        for ii in order:
+            cached_parts = cache_get_all(ii)
+            if cached_parts is not None:
+                cached[ii] = cached_parts
+    missing = [ii for ii in order if ii not in cached]
+
+    # each compressed part gets a fixed size slot in the output. This is enough for uncompressed line data plus
+    # a few bytes of overhead per line, which only the most pathological patterns exceed. Larger parts are
+    # returned directly instead
+    slot_size = 3 * ny * -(-nx // nsplit) + 4 * ny + 8
+
+    input_shm = SharedMemory(create=True, size=max(combined_patterns.nbytes, 1))
+    output_shm = SharedMemory(create=True, size=max(slot_size * nsplit * len(missing), 1))
+    try:
+        shared_patterns = np.ndarray(combined_patterns.shape, dtype=combined_patterns.dtype, buffer=input_shm.buf)
+        shared_patterns[:] = combined_patterns
+        del shared_patterns
+
+        def submit_all(executor):
+            return {ii: (kk, executor.submit(_compress_shared_pattern,
+                                             input_shm.name,
+                                             combined_patterns.shape,
+                                             combined_patterns.dtype.str,
+                                             ii,
+                                             nsplit,
+                                             compression_mode,
+                                             optimal_encoding,
+                                             output_shm.name,
+                                             kk * nsplit * slot_size,
+                                             slot_size))
+                    for kk, ii in enumerate(missing)}
+
+        try:
+            futures = submit_all(_get_compress_pool(workers))
+        except BrokenProcessPool:
+            # a worker process died during an earlier call
+            futures = submit_all(_get_compress_pool(workers, renew=True))
+
+        try:
+            for ii in order:
+                if ii in cached:
+                    modes, compressed_parts = cached[ii]
+                else:
+                    kk, future = futures[ii]
+                    modes, compressed_sizes, compressed_parts = future.result()
+                    for jj, compressed_size in enumerate(compressed_sizes):
+                        if compressed_parts[jj] is None:
+                            # copy out, so the shared memory can be released once all patterns are compressed
+                            offset = (kk * nsplit + jj) * slot_size
+                            compressed_parts[jj] = bytes(output_shm.buf[offset:offset + compressed_size])
+
+                        if cache is not None:
+                            cache_put(ii, jj, modes[jj], compressed_parts[jj])
+
+                yield ii, compressed_parts, modes
+        finally:
+            # patterns which have not started are cancelled if the generator is closed early, and running ones must
+            # finish before the shared memory is released
+            wait([future for _, future in futures.values() if not future.cancel()])
+    finally:
+        input_shm.close()
+        input_shm.unlink()
+        output_shm.close()
+        output_shm.unlink()
+
+
+# process pool used by compress_patterns(), kept between calls so the worker processes are only started once
+_compress_pool = None
+_compress_pool_workers = 0
+
+
+def _get_compress_pool(workers: int,
+                       renew: bool = False) -> ProcessPoolExecutor:
+    """
+    Get the process pool used by compress_patterns(). It is created on first use, and created again if the number
+    of workers changes
+
+    :param workers: number of processes
+    :param renew: if True, always replace the pool, e.g. because it is broken
+    :return pool:
+    """
+    global _compress_pool, _compress_pool_workers
+
+    if _compress_pool is not None and (renew or _compress_pool_workers != workers):
+        _compress_pool.shutdown(wait=False, cancel_futures=True)
+        _compress_pool = None
+
+    if _compress_pool is None:
+        _compress_pool = ProcessPoolExecutor(max_workers=workers)
+        _compress_pool_workers = workers
+
+    return _compress_pool
+
+
+def _compress_shared_pattern(input_name: str,
+                             shape: tuple,
+                             dtype: str,
+                             index: int,
+                             nsplit: int,
+                             compression_mode: str,
+                             optimal_encoding: bool,
+                             output_name: str,
+                             offset: int,
+                             size: int) -> (list, list, list):
+    """
+    Compress all parts of a pattern stored in shared memory and write them to consecutive slots in shared memory.
+    Run in the worker processes of compress_patterns().
+
+    :return compression_modes, compressed_sizes, compressed_parts: each entry of compressed_parts is None if the
+      compressed part was written to its slot, and otherwise the compressed part, if it was larger than the slot
+    """
+    input_shm = SharedMemory(name=input_name)
+    output_shm = SharedMemory(name=output_name)
+    try:
+        combined_patterns = np.ndarray(shape, dtype=dtype, buffer=input_shm.buf)
+        modes, compressed_parts = compress_pattern_parts(combined_patterns[index],
+                                                         nsplit,
+                                                         compression_mode,
+                                                         optimal_encoding)
+        # views of the shared memory must be released before it is closed
+        del combined_patterns
+
+        compressed_sizes = [len(c) for c in compressed_parts]
+        for jj, compressed in enumerate(compressed_parts):
+            if len(compressed) <= size:
+                start = offset + jj * size
+                output_shm.buf[start:start + len(compressed)] = compressed
+                compressed_parts[jj] = None
+
+        return modes, compressed_sizes, compressed_parts
+    finally:
+        input_shm.close()
+        output_shm.close()
+
+
+class erle_codec(Codec):
+    """
+    numcodecs codec which stores groups of up to 24 binary patterns as the ERLE data sent to the DMD, so patterns
+    saved in a zarr array can be uploaded without encoding them again. Use chunks of 24 x ny x nx, so that each chunk
+    is one combined pattern, see save_config_file(). Each chunk is stored as
+
+    number of patterns (uint16), nsplit (uint16), size of each part (nsplit x uint32), ERLE data of each part
+
+    where the parts are as produced by compress_pattern_parts(), e.g. the halves sent to the two controllers
+    of the DLP9000. Decoding gives back the binary patterns. read_encoded_patterns() reads the ERLE data without
+    decoding it.
+    """
+
+    codec_id = "dlpc900_erle"
+
+    def __init__(self,
+                 ny: int,
+                 nx: int,
+                 nsplit: int = 1,
+                 optimal: bool = False):
+        """
+        :param ny: pattern height
+        :param nx: pattern width
+        :param nsplit: number of parts to split each combined pattern into along the x-direction
+        :param optimal: if True, use the slower encoding which produces the fewest bytes. See encode_erle()
+        """
+        self.ny = ny
+        self.nx = nx
+        self.nsplit = nsplit
+        self.optimal = optimal
+
+    def encode(self, buf):
+        patterns = ensure_contiguous_ndarray(buf).view(np.uint8).reshape(-1, self.ny, self.nx)
+        if len(patterns) > 24:
+            raise ValueError(f"chunks can contain at most 24 patterns, but got {len(patterns):d}")
+
+        _, compressed_parts = compress_pattern_parts(pack_patterns(patterns)[0],
+                                                     self.nsplit,
+                                                     'erle',
+                                                     self.optimal)
+
+        sizes = [len(c) for c in compressed_parts]
+        return b"".join([pack(f'<HH{self.nsplit:d}I', len(patterns), self.nsplit, *sizes)] + compressed_parts)
+
+    @staticmethod
+    def part_offsets(buf) -> np.ndarray:
+        """
+        Offsets of the ERLE data of each part in an encoded chunk, so part jj is buf[offsets[jj]:offsets[jj + 1]]
+
+        :param buf: encoded chunk
+        :return offsets: nsplit + 1 integer array
+        """
+        _, nsplit = unpack_from('<HH', buf)
+        sizes = unpack_from(f'<{nsplit:d}I', buf, 4)
+        return np.cumsum((4 + 4 * nsplit,) + sizes)
+
+    def decode(self, buf, out=None):
+        buf = memoryview(ensure_contiguous_ndarray(buf)).cast("B")
+        npatterns, = unpack_from('<H', buf)
+        offsets = self.part_offsets(buf)
+        decoded_parts = [decode_erle((self.ny, self.nx // self.nsplit), buf[start:end])
+                         for start, end in zip(offsets[:-1], offsets[1:])]
+        patterns = split_combined_patterns(np.concatenate(decoded_parts, axis=-1)[None])[:npatterns]
+        return ndarray_copy(patterns.view(bool), out)
+
+
+register_codec(erle_codec)
+
+
+class encoded_pattern_set:
+    """
+    Compressed parts of a series of combined patterns, stored in one contiguous buffer together with a table of
+    offsets. Part jj of pattern ii is data[offsets[ii, jj]:offsets[ii, jj + 1]], so selecting patterns only selects
+    rows of the offsets table and never copies the data.
+
+    This is the format compressed patterns are passed around in: it is created from the output of
+    compress_patterns(), which may use a process pool and a cache, can be saved to disk and memory-mapped with
+    load(), or read from a zarr array stored with erle_codec with read_encoded_patterns(), and can be passed to
+    upload_pattern_sequence() instead of patterns, which then sends the parts straight from the buffer. The
+    boundaries of the PATMEM_LOAD_DATA commands follow from the offsets, see payloads(). decode() gives back the
+    binary patterns.
+    """
+
+    def __init__(self,
+                 data: np.ndarray,
+                 offsets: np.ndarray,
+                 compression_bytes: np.ndarray,
+                 pattern_counts: np.ndarray,
+                 pattern_shape: Sequence[int]):
+        """
+        :param data: 1D uint8 array with the compressed parts
+        :param offsets: ncombined x (nsplit + 1) integer array. The parts of each pattern are consecutive in data
+        :param compression_bytes: ncombined x nsplit array with the compression mode of each part, as the
+          compression byte of the pattern header, i.e. 0 = 'none', 1 = 'rle', 2 = 'erle'
+        :param pattern_counts: number of binary patterns in each combined pattern
+        :param pattern_shape: (ny, nx) size of the full patterns, before they are split
+        """
+        self.data = data
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.compression_bytes = np.asarray(compression_bytes, dtype=np.uint8)
+        self.pattern_counts = np.asarray(pattern_counts, dtype=np.int64)
+        self.pattern_shape = tuple(int(n) for n in pattern_shape)
+
+        if self.offsets.ndim != 2 or self.compression_bytes.shape != (len(self.offsets), self.nsplit):
+            raise ValueError(f"offsets must be an ncombined x (nsplit + 1) array and compression_bytes an"
+                             f" ncombined x nsplit array, but their shapes were {self.offsets.shape} and"
+                             f" {self.compression_bytes.shape}")
+
+    @classmethod
+    def from_patterns(cls,
+                      patterns: np.ndarray,
+                      compression_mode: str = 'erle',
+                      optimal_encoding: bool = False,
+                      nsplit: int = 1,
+                      workers: int = 1,
+                      cache: Optional[encoded_pattern_cache] = None,
+                      threads: int = 1):
+        """
+        Combine binary patterns into 24 bit images and compress them. See compress_patterns() for the arguments.
+
+        :param patterns: N x Ny x Nx array of binary patterns
+        :return encoded_patterns:
+        """
+        patterns = _as_binary_patterns(patterns)
+        if patterns.ndim == 2:
+            patterns = np.expand_dims(patterns, axis=0)
+
+        packed_patterns = pack_patterns(patterns)
+        compressed_parts = []
+        modes = []
+        for _, parts, part_modes in compress_patterns(packed_patterns,
+                                                      compression_mode,
+                                                      optimal_encoding,
+                                                      nsplit=nsplit,
+                                                      workers=workers,
+                                                      cache=cache,
+                                                      threads=threads):
+            compressed_parts += parts
+            modes += part_modes
+
+        # parts are stored in order, so the last offset of each pattern is the first of the next
+        ncombined = len(packed_patterns)
+        part_offsets = np.zeros(ncombined * nsplit + 1, dtype=np.int64)
+        np.cumsum([len(c) for c in compressed_parts], out=part_offsets[1:])
+        offsets = part_offsets[nsplit * np.arange(ncombined)[:, None] + np.arange(nsplit + 1)]
+        compression_bytes = np.reshape([_compression_mode_names.index(m) for m in modes], (ncombined, nsplit))
+        pattern_counts = np.minimum(len(patterns) - 24 * np.arange(ncombined), 24)
+
+        return cls(np.frombuffer(b"".join(compressed_parts), dtype=np.uint8),
+                   offsets,
+                   compression_bytes,
+                   pattern_counts,
+                   patterns.shape[1:])
+
+    @classmethod
+    def load(cls,
+             path: Union[str, Path],
+             mmap: bool = True):
+        """
+        Load patterns saved with save()
+
+        :param path: directory the patterns were saved to
+        :param mmap: if True, memory-map the compressed data instead of reading it
+        :return encoded_patterns:
+        """
+        path = Path(path)
+        with np.load(path / "index.npz") as index:
+            return cls(np.load(path / "data.npy", mmap_mode="r" if mmap else None),
+                       index["offsets"],
+                       index["compression_bytes"],
+                       index["pattern_counts"],
+                       index["pattern_shape"])
+
+    def save(self, path: Union[str, Path]):
+        """
+        Save to a directory, with the compressed data in data.npy and the offsets table in index.npz. The whole
+        buffer is saved, also for a selection of patterns which only uses part of it.
+
+        :param path: directory to save to. Created if it does not exist.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / "data.npy", self.data)
+        np.savez(path / "index.npz",
+                 offsets=self.offsets,
+                 compression_bytes=self.compression_bytes,
+                 pattern_counts=self.pattern_counts,
+                 pattern_shape=self.pattern_shape)
+
+    def decode(self) -> np.ndarray:
+        """
+        Decode the binary patterns
+
+        :return patterns: npatterns x ny x nx uint8 array
+        """
+        ny, nx = self.pattern_shape
+        part_shape = (ny, nx // self.nsplit)
+        patterns = []
+        for ii, compressed_parts, modes in self.items():
+            decoded_parts = []
+            for compressed_pattern, mode in zip(compressed_parts, modes):
+                if mode == 'none':
+                    raw = np.frombuffer(compressed_pattern, dtype=np.uint8).reshape(part_shape + (3,))
+                    decoded_parts.append(np.moveaxis(raw, -1, 0))
+                else:
+                    decoded_parts.append(decode_erle(part_shape, compressed_pattern, compression_mode=mode))
+            combined_pattern = np.concatenate(decoded_parts, axis=-1)
+            patterns.append(split_combined_patterns(combined_pattern)[:self.pattern_counts[ii]])
+
+        if patterns == []:
+            return np.zeros((0, ny, nx), dtype=np.uint8)
+
+        return np.concatenate(patterns)
+
+    @property
+    def nsplit(self) -> int:
+        return self.offsets.shape[1] - 1
+
+    @property
+    def npatterns(self) -> int:
+        """
+        Number of binary patterns
+        """
+        return int(np.sum(self.pattern_counts))
+
+    @property
+    def sizes(self) -> np.ndarray:
+        """
+        ncombined x nsplit array with the size of each compressed part
+        """
+        return np.diff(self.offsets, axis=1)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Total size of the compressed parts
+        """
+        return int(np.sum(self.sizes))
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, item):
+        """
+        Select combined patterns, without copying the compressed data
+
+        :param item: index, slice, or array of indices
+        :return encoded_patterns:
+        """
+        if np.isscalar(item):
+            item = [item]
+
+        return encoded_pattern_set(self.data,
+                                   self.offsets[item],
+                                   self.compression_bytes[item],
+                                   self.pattern_counts[item],
+                                   self.pattern_shape)
+
+    def parts(self, index: int) -> list:
+        """
+        Compressed parts of one combined pattern
+
+        :param index: index of the combined pattern
+        :return compressed_parts: list of memoryview's of the data
+        """
+        data = memoryview(self.data).cast("B")
+        return [data[start:stop] for start, stop in zip(self.offsets[index, :-1], self.offsets[index, 1:])]
+
+    def items(self, order: Optional[Sequence[int]] = None):
+        """
+        Iterate over the compressed patterns, in the same way as over the output of compress_patterns()
+
+        :param order: order to yield the patterns in. If None, yield them in order
+        :return: generator yielding (index, compressed_parts, compression_modes)
+        """
+        if order is None:
+            order = range(len(self))
+
+        for ii in order:
+            yield ii, self.parts(ii), [_compression_mode_names[b] for b in self.compression_bytes[ii]]
+
+    def payloads(self,
+                 index: int,
+                 part: int = 0,
+                 max_payload: int = 504):
+        """
+        Data blocks of the PATMEM_LOAD_DATA commands which send one part, starting with the pattern header.
+        Only the first block, which contains the header, is copied.
+
+        :param index: index of the combined pattern
+        :param part: index of the part
+        :param max_payload: maximum number of data bytes in one command
+        :return: generator yielding the data of each command, without the two length bytes
+        """
+        ny, nx = self.pattern_shape
+        header = bytearray(_pattern_header(nx // self.nsplit, ny, int(self.compression_bytes[index, part])))
+        compressed_pattern = self.parts(index)[part]
+        pack_into('<I', header, 8, len(compressed_pattern))
+        return _patmem_blocks(header, compressed_pattern, max_payload)
+
+
+@lru_cache(maxsize=None)
+def _pattern_header(width: int,
+                    height: int,
+                    compression_byte: int) -> bytes:
+    """
+    48 byte header sent before the pattern data in PATMEM_LOAD_DATA commands, with the number of encoded bytes
+    set to zero. Taken directly from sniffer of the TI GUI. Built once for each geometry and compression mode.
+
+    :param width: width of the pattern sent to one controller
+    :param height: height of the pattern
+    :param compression_byte: 0 = uncompressed, 1 = RLE, 2 = ERLE
+    :return header:
+    """
+    signature_bytes = [0x53, 0x70, 0x6C, 0x64]
+    width_byte = list(unpack('BB', pack('<H', width)))
+    height_byte = list(unpack('BB', pack('<H', height)))
+    # Number of bytes in encoded image_data
+    num_encoded_bytes = [0x00] * 4
+    reserved_bytes = [0xFF] * 8  # reserved
+    bg_color_bytes = [0x00] * 4  # BG color BB, GG, RR, 00
+
+    general_data = signature_bytes + width_byte + height_byte + num_encoded_bytes + \
+                   reserved_bytes + bg_color_bytes + [0x01] + [compression_byte] + \
+                   [0x01] + [0x00] * 2 + [0x01] + [0x00] * 18  # reserved
+
+    return bytes(general_data)
+
+
+def _patmem_blocks(header: bytes,
+                   compressed_pattern,
+                   max_payload: int = 504):
+    """
+    Split a pattern into the data blocks of consecutive PATMEM_LOAD_DATA commands. The header is sent at the start
+    of the first block, so the pattern is never copied as a whole
+
+    :param header: pattern header, see _pattern_header()
+    :param compressed_pattern: memoryview of the compressed pattern
+    :param max_payload: maximum number of data bytes in one command
+    :return: generator yielding the data of each command
+    """
+    header_len = len(header)
+    data_len = header_len + len(compressed_pattern)
+
+    data_index = 0
+    while data_index < data_len:
+        # slice data to get block to send in this command
+        data_index_next = min(data_index + max_payload, data_len)
+        if data_index < header_len:
+            yield header[data_index:] + compressed_pattern[:data_index_next - header_len]
+        else:
+            yield compressed_pattern[data_index - header_len:data_index_next - header_len]
+
+        data_index = data_index_next
+
+
 ##############################################
 # firmware configuration
 ##############################################
+def read_encoded_patterns(fname: Union[str, Path]) -> encoded_pattern_set:
+    """
+    Read the firmware patterns stored in a zarr configuration file by save_config_file() with erle_nsplit, without
+    decoding them. The chunks stored with erle_codec are read from the store as they are, and can be passed straight
+    to upload_pattern_sequence()
+
+    :param fname: configuration file path
+    :return encoded_patterns:
+    """
+    patterns = zarr.open_group(fname, mode="r")["firmware_patterns"]
+    codec = patterns.compressors[0] if len(patterns.compressors) == 1 else None
+    if not isinstance(codec, erle_codec):
+        raise ValueError(f"firmware patterns in {fname} must be stored with {erle_codec.__name__:s}, but the"
+                         f" compressors were {patterns.compressors}. Save them with erle_nsplit")
+    if patterns.filters or patterns.chunks != (24, codec.ny, codec.nx):
+        raise ValueError(f"patterns must be stored without filters in chunks of shape {(24, codec.ny, codec.nx)}")
+
+    # zarr has no public way to read a chunk without decoding it, so the raw bytes are read from the store
+    npatterns = patterns.shape[0]
+    ncombined = int(np.ceil(npatterns / 24))
+    chunks = [sync((patterns.store_path / patterns.metadata.encode_chunk_key((ii, 0, 0))).get()).to_bytes()
+              for ii in range(ncombined)]
+
+    # the parts are used in place, so the headers of the chunks stay in the buffer between them
+    chunk_starts = np.cumsum([0] + [len(c) for c in chunks[:-1]], dtype=np.int64)
+    offsets = np.array([start + erle_codec.part_offsets(c) for start, c in zip(chunk_starts, chunks)],
+                       dtype=np.int64).reshape(ncombined, codec.nsplit + 1)
+
+    return encoded_pattern_set(np.frombuffer(b"".join(chunks), dtype=np.uint8),
+                               offsets,
+                               np.full((ncombined, codec.nsplit), _compression_mode_names.index('erle')),
+                               np.minimum(npatterns - 24 * np.arange(ncombined), 24),
+                               (codec.ny, codec.nx))
+
+
 def validate_channel_map(cm: dict) -> (bool, str):
     """
     check that channel_map is of the correct format
@@ -437,7 +1843,8 @@ def save_config_file(fname: str,
                      channel_map: Optional[dict] = None,
                      firmware_patterns: Optional[np.ndarray] = None,
                      hid_path: Optional[str] = None,
-                     use_zarr: bool = True):
+                     use_zarr: bool = True,
+                     erle_nsplit: Optional[int] = None):
     """
     Save DMD firmware configuration data to zarr or json file
 
@@ -456,6 +1863,9 @@ def save_config_file(fname: str,
     :param firmware_patterns: 3D array of size npatterns x ny x nx
     :param hid_path: HID device path allowing the user to address a specific DMD
     :param use_zarr: whether to save configuration file as zarr or json
+    :param erle_nsplit: if provided, firmware_patterns are stored as ERLE data with erle_codec, split into this
+      many parts (2 for the DLP9000), so they can be uploaded without encoding them, see read_encoded_patterns().
+      Otherwise they are stored as packed bits.
     :return:
     """
 
@@ -483,14 +1893,24 @@ def save_config_file(fname: str,
                     current_ch_dict[m] = v.tolist()
 
     if use_zarr:
-        z = zarr.open(fname, "w")
+        # numcodecs compressors such as PackBits are used with the zarr version 2 format
+        z = zarr.open_group(fname, mode="w", zarr_format=2)
 
         if firmware_patterns is not None:
-            z.array("firmware_patterns",
-                    firmware_patterns.astype(bool),
-                    compressor=packbits.PackBits(),
-                    dtype=bool,
-                    chunks=(1, firmware_patterns.shape[-2], firmware_patterns.shape[-1]))
+            ny, nx = firmware_patterns.shape[-2:]
+            if erle_nsplit is None:
+                compressor = packbits.PackBits()
+                chunks = (1, ny, nx)
+            else:
+                compressor = erle_codec(ny, nx, nsplit=erle_nsplit)
+                chunks = (24, ny, nx)
+
+            # chunks of blank patterns are written too, so every chunk of ERLE data can be read for upload
+            z.create_array("firmware_patterns",
+                           data=firmware_patterns.astype(bool),
+                           compressors=compressor,
+                           chunks=chunks,
+                           config={"write_empty_chunks": True})
 
         z.attrs["timestamp"] = tstamp
         z.attrs["hid_path"] = hid_path
@@ -534,7 +1954,7 @@ def load_config_file(fname: Union[str, Path]):
             hid_path = None
 
     elif fname.suffix == ".zarr":
-        z = zarr.open(fname, "r")
+        z = zarr.open_group(fname, mode="r")
         tstamp = z.attrs["timestamp"]
         pattern_data = z.attrs["firmware_pattern_data"]
         channel_map = z.attrs["channel_map"]
@@ -546,7 +1966,7 @@ def load_config_file(fname: Union[str, Path]):
 
         try:
             firmware_patterns = z["firmware_patterns"]
-        except ValueError:
+        except KeyError:
             firmware_patterns = None
 
     else:
@@ -590,6 +2010,39 @@ def get_preset_info(inds: Sequence,
 
     return pd_all
 
+
+##############################################
+# USB transport, see dlpyc900.transport
+##############################################
+def benchmark_transports(cls,
+                         transports: Sequence[str] = ("pywinusb", "pyusb", "hidraw"),
+                         **kwargs) -> dict:
+    """
+    Run dlpc900_dmd.benchmark_transport() with each transport, to find which is fastest on this computer.
+    Transports which are not available, e.g. because a module is missing or no DMD is found, are skipped.
+
+    :param cls: DMD class, e.g. dlp6500 or dlp9000
+    :param transports: names of the transports to test, see transport_backends
+    :param kwargs: passed to benchmark_transport()
+    :return results: dictionary with the result of benchmark_transport() for each transport, or an entry
+      "error" describing why the transport could not be used
+    """
+    results = {}
+    for name in transports:
+        try:
+            dmd = cls(transport=name, debug=False)
+        except (ImportError, OSError, ValueError) as e:
+            results[name] = {"error": str(e)}
+            continue
+
+        try:
+            results[name] = dmd.benchmark_transport(**kwargs)
+        finally:
+            dmd.close()
+
+    return results
+
+
 ##############################################
 # dlp6500 DMD
 ##############################################
@@ -598,7 +2051,7 @@ def get_preset_info(inds: Sequence,
 class dlpc900_dmd:
     """
     Base class for communicating with any DMD using the DLPC900 controller, including the DLP6500 and DLP9000.
-    OS specific code should only appear in private functions _get_device(), _send_raw_packet(), and __del__()
+    OS specific code should only appear in the transport, see dlpc900_transport
     """
 
     width = None  # pixels
@@ -607,8 +2060,11 @@ class dlpc900_dmd:
     dual_controller = None
 
     # these used internally
-    _dmd = None
-    _response = []
+    _transport = None
+    # packets of the commands queued by batch(), the position of the last command, and whether to check its reply
+    _batch = None
+    _batch_last_command = 0
+    _batch_check_errors = False
     # USB packet length not including report_id_byte
     _packet_length_bytes = 64
 
@@ -662,6 +2118,14 @@ class dlpc900_dmd:
                     'TRIG_IN2_CTL': 0x1A36,
                     }
 
+    # write-only commands which are queued instead of sent inside batch()
+    batch_commands = frozenset(map(command_dict.get, ('MBOX_DATA',
+                                                      'PAT_CONFIG',
+                                                      'PATMEM_LOAD_INIT_MASTER',
+                                                      'PATMEM_LOAD_DATA_MASTER',
+                                                      'PATMEM_LOAD_INIT_SECONDARY',
+                                                      'PATMEM_LOAD_DATA_SECONDARY')))
+
     err_dictionary = {0: 'no error',
                       1: 'batch file checksum error',
                       2: 'device failure',
@@ -714,11 +2178,12 @@ class dlpc900_dmd:
                  initialize: bool = True,
                  dmd_index: int = 0,
                  hid_path: Optional[str] = None,
-                 platform: Optional[str] = None):
+                 platform: Optional[str] = None,
+                 pattern_cache: Optional[Union[str, Path, encoded_pattern_cache]] = None,
+                 transport: Optional[Union[str, dlpc900_transport]] = None):
         """
-        Get instance of DLP LightCrafter evaluation module (DLP6500 or DLP9000). This is the base class which os
-        dependent classes should inherit from. The derived classes only need to implement _get_device and
-        _send_raw_packet.
+        Get instance of DLP LightCrafter evaluation module (DLP6500 or DLP9000). This is the base class which
+        DMD models inherit from. Operating system dependent code lives in the transport.
 
         Note that DMD can be instantiated before being loaded. In this case, use the constructor with initialize=False
         and later call initialize() method with the desired arguments.
@@ -737,8 +2202,14 @@ class dlpc900_dmd:
         :param dmd_index: If multiple DMD's are attached, choose this one. Indexing starts at zero
         :param hid_path: for more stable identification of a single DMD on multi-DMD systems, provide the hid path.
           This can be obtained from a winusb.hid HIDDevice using the device_path attribute. If an HID path is provided,
-          it overrides the dmd_index argument.
-        :param platform:
+          it overrides the dmd_index argument. For the hidraw transport this is the device file, e.g. "/dev/hidraw0",
+          and for the pyusb transport "bus:address".
+        :param platform: platform as in sys.platform, used to choose the default transport. If "none", no
+          device is used and commands are not sent
+        :param pattern_cache: encoded_pattern_cache, or directory to create one in, used to store compressed
+          on-the-fly patterns. If provided, patterns which were uploaded before are not compressed again.
+        :param transport: name of a transport in transport_backends, e.g. "pywinusb", "pyusb", "hidraw", or "fake",
+          or a dlpc900_transport instance. If None, the default transport for the platform is used
         """
 
         if config_file is not None and (firmware_pattern_info is not None or
@@ -776,8 +2247,12 @@ class dlpc900_dmd:
         self.presets = presets
         self.firmware_patterns = firmware_patterns
 
-        # on-the-fly patterns
-        self.on_the_fly_patterns = None
+        # on-the-fly patterns, as passed to upload_pattern_sequence(). See on_the_fly_patterns
+        self._on_the_fly_source = None
+
+        if pattern_cache is not None and not isinstance(pattern_cache, encoded_pattern_cache):
+            pattern_cache = encoded_pattern_cache(pattern_cache)
+        self.pattern_cache = pattern_cache
 
         self.debug = debug
 
@@ -793,102 +2268,113 @@ class dlpc900_dmd:
         else:
             self._platform = platform
 
+        if transport is None and self._platform != "none":
+            transport = default_transport(self._platform)
+        self.transport = transport
+        self._transport = None
+
         self.initialized = initialize
         if self.initialized:
             self._get_device()
 
     def __del__(self):
-        if self._platform == "win32":
-            try:
-                self._dmd.close()
-            except AttributeError:
-                pass  # this will fail if object destroyed before being initialized
+        try:
+            self.close()
+        except AttributeError:
+            pass  # this will fail if object destroyed before being initialized
+
+    def close(self):
+        """
+        Release the USB device
+        """
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
 
     def initialize(self, **kwargs):
         self.__init__(initialize=True, **kwargs)
 
-    # sending and receiving commands, operating system dependence
+    @property
+    def pattern_width(self) -> int:
+        """
+        Width of the patterns sent to each controller. For dual controller DMD's, each controller receives one half
+        """
+        if self.dual_controller:
+            return self.width // 2
+        else:
+            return self.width
+
+    @property
+    def on_the_fly_patterns(self) -> Optional[np.ndarray]:
+        """
+        Binary patterns last uploaded with upload_pattern_sequence(), so we can check what was uploaded. Patterns
+        which were uploaded compressed as an encoded_pattern_set are decoded each time this is read
+        """
+        if isinstance(self._on_the_fly_source, encoded_pattern_set):
+            return self._on_the_fly_source.decode()
+
+        return self._on_the_fly_source
+
+    # sending and receiving commands
     def _get_device(self):
         """
-        Return handle to DMD. This command can contain OS dependent implementation
+        Connect to the DMD using the transport
 
         :return:
         """
 
-        if self._platform == "win32":
+        if isinstance(self.transport, dlpc900_transport):
+            self._transport = self.transport
+        elif self.transport is not None:
+            if self.transport not in transport_backends.keys():
+                raise ValueError(f"transport was '{self.transport:s}', but must be one of "
+                                 f"{list(transport_backends.keys())}")
 
-            if self._hid_path is None:
-                devices = pyhid.HidDeviceFilter(vendor_id=self.vendor_id,
-                                               product_id=self.product_id).get_devices()
-                devices = [d for d in devices if d.product_name == "DLPC900"]
-
-                if len(devices) <= self.dmd_index:
-                    raise ValueError(f"Not enough DMD's detected for dmd_index={self.dmd_index:d}."
-                                     f"Only {len(devices):d} DMD's were detected.")
-                self._dmd = devices[self.dmd_index]
-                self._hid_path = self._dmd.device_path
+            if self.transport == "fake":
+                self._transport = fake_transport()
             else:
-                self._dmd = pyhid.HidDevice(self._hid_path)
-
-            self._dmd.open()
+                self._transport = transport_backends[self.transport](vendor_id=self.vendor_id,
+                                                                     product_id=self.product_id,
+                                                                     dmd_index=self.dmd_index,
+                                                                     hid_path=self._hid_path)
 
-            # strip off first return byte and add rest to self._response
-            self._dmd.set_raw_data_handler(lambda data: self._response.append(data[1:]))
-        elif self._platform == "none":
-            pass
-        else:
-            raise NotImplementedError(f"Platform was '{self._platform:s}', "
-                                      f"but DMD control is only implemented on 'win32'")
+        if self._transport is not None:
+            self._hid_path = self._transport.path
 
     def _send_raw_packet(self,
                          buffer,
                          listen_for_reply: bool = False,
                          timeout: float = 5):
         """
-        Send a single USB packet. This command can contain OS dependent implementations
+        Send a single USB packet
 
-        :param buffer: list of bytes to send to device
+        :param buffer: bytes to send to device
         :param listen_for_reply: whether to listen for a reply
         :param timeout: timeout in seconds
         :return reply: a list of bytes
         """
 
-        # one interesting issue is it seems on linux the report ID byte is stripped
-        # by the driver, so we would not need to worry about it here. For windows, we must handle manually.
+        # ensure packet is correct length
+        assert len(buffer) == self._packet_length_bytes
 
-        if self._platform == "win32":
-            # ensure packet is correct length
-            assert len(buffer) == self._packet_length_bytes
+        if self._transport is None:
+            raise ValueError("DMD is not connected. Use initialize() to connect to it.")
 
-            report_id_byte = [0x00]
+        # clear reply buffer before sending
+        if listen_for_reply:
+            self._transport.clear()
 
-            # clear reply buffer before sending
-            self._response = []
+        self._transport.write(buffer)
 
-            # send
-            reports = self._dmd.find_output_reports()
-            reports[0].send(report_id_byte + buffer)
+        # only wait for a reply if necessary
+        if not listen_for_reply:
+            return []
 
-            # only wait for a reply if necessary
-            if listen_for_reply:
-                tstart = time.time()
-                while self._response == []:
-                    time.sleep(0.1)
-                    tnow = time.time()
-
-                    if timeout is not None:
-                        if (tnow - tstart) > timeout:
-                            print('read command timed out')
-                            break
-
-            if self._response != []:
-                reply = deepcopy(self._response[0])
-            else:
-                reply = []
+        reply = self._transport.read(timeout)
+        if reply is None:
+            reply = []
 
-            return reply
-        else:
-            raise NotImplementedError("DMD control is only implemented on windows")
+        return reply
 
     def send_raw_command(self,
                          buffer,
@@ -901,12 +2387,18 @@ class dlpc900_dmd:
         This command should not be operating system dependent. All operating system dependence should be
         in _send_raw_packet()
 
-        :param buffer: buffer to send. List of bytes.
+        :param buffer: buffer to send. Bytes-like object, or list of bytes.
         :param listen_for_reply: Boolean. Whether to wait for a reply form USB device
         :param timeout: time to wait for reply, in seconds
         :return: reply: a list of lists of bytes. Each list represents the response for a separate packet.
         """
 
+        # packets are slices of the buffer, not copies
+        try:
+            buffer = memoryview(buffer).cast("B")
+        except TypeError:
+            buffer = memoryview(bytes(buffer))
+
         reply = []
         # handle sending multiple packets if necessary
         data_counter = 0
@@ -918,9 +2410,11 @@ class dlpc900_dmd:
 
             if len(data_to_send) < self._packet_length_bytes:
                 # pad with zeros if necessary
-                data_to_send += [0x00] * (self._packet_length_bytes - len(data_to_send))
+                data_to_send = bytes(data_to_send) + bytes(self._packet_length_bytes - len(data_to_send))
 
-            packet_reply = self._send_raw_packet(data_to_send, listen_for_reply, timeout)
+            # the DMD replies once, after the last packet of a command
+            is_last_packet = data_counter_next >= len(buffer)
+            packet_reply = self._send_raw_packet(data_to_send, listen_for_reply and is_last_packet, timeout)
             reply += packet_reply
 
             # increment for next packet
@@ -943,7 +2437,7 @@ class dlpc900_dmd:
         :param rw_mode: 'r' for read, or 'w' for write
         :param reply: boolean
         :param command: two byte integer
-        :param data: data to be transmitted. List of integers, where each integer gives a byte
+        :param data: data to be transmitted. Bytes-like object, or list of integers where each integer gives a byte
         :param sequence_byte: integer
         :return response_buffer:
         """
@@ -975,17 +2469,10 @@ class dlpc900_dmd:
         flag_byte = int(flagstring, 2)
 
         # second byte is sequence byte. This is used only to identify responses to given commands.
-        # third and fourth are length of payload, respectively LSB and MSB bytes
-        len_payload = len(data) + 2
-        len_lsb, len_msb = unpack('BB', pack('H', len_payload))
-
-        # get USB command bytes
-        cmd_lsb, cmd_msb = unpack('BB', pack('H', command))
-
-        # this does not exactly correspond with what TI calls the header. It is a combination of
-        # the report id_byte, the header, and the USB command bytes
-        header = [flag_byte, sequence_byte, len_lsb, len_msb, cmd_lsb, cmd_msb]
-        buffer = header + list(data)
+        # third and fourth are length of payload, respectively LSB and MSB bytes, followed by the USB command bytes.
+        # The packets are built by pack_command(), which the dlpyc900 driver uses as well
+        buffer = pack_command(flag_byte, sequence_byte, command, data, self._packet_length_bytes)
+        header = buffer[:6]
 
         # print commands during debugging
         if self.debug:
@@ -1007,8 +2494,97 @@ class dlpc900_dmd:
                 print("0x%0.2X" % data[ii], end=' ')
             print('')
 
+        if self._batch is not None:
+            if command in self.batch_commands:
+                # queued commands are not answered, the reply is requested only when the batch is sent
+                buffer[0] &= 0xbf
+                self._batch_last_command = len(self._batch)
+                self._batch += buffer
+                return []
+
+            # keep commands in order
+            self._send_batch(self._batch_check_errors)
+
         return self.send_raw_command(buffer, reply)
 
+    @contextmanager
+    def batch(self,
+              check_errors: bool = False):
+        """
+        Queue write-only commands, i.e. those in batch_commands, and send them all at once when the context exits.
+        The queued commands are assembled into one stream of packets, which is written by the transport without any
+        per-command overhead. Any other command sends the queue first, so commands always arrive in order.
+
+        Queued commands return an empty response instead of the reply of the DMD. If check_errors is True, a reply
+        is requested for the last queued command only, and the error description is printed if it reports an error.
+        Note this does not detect errors in earlier commands, which are only visible in their own replies. This also
+        applies when the queue is sent early because of a command which is not queued.
+
+        If the block raises an exception, the commands still queued are dropped, not sent.
+
+        >>> with dmd.batch(check_errors=True):
+        >>>     for ii in range(npatterns):
+        >>>         dmd._pattern_display_lut_definition(ii)
+
+        :param check_errors: whether to check the reply to the last command when the batch is sent
+        """
+        if self._batch is not None:
+            # nested batches are sent with the outer batch
+            yield
+            return
+
+        self._batch = bytearray()
+        self._batch_check_errors = check_errors
+        try:
+            yield
+            self._send_batch(check_errors)
+        finally:
+            self._batch = None
+            self._batch_check_errors = False
+
+    def _send_batch(self,
+                    check_errors: bool = False,
+                    timeout: float = 5):
+        """
+        Send the commands queued by batch(), and start a new queue
+
+        :param check_errors: request a reply to the last command, and print the error description if it has the
+          error flag set
+        :param timeout: time to wait for the reply, in seconds
+        """
+        if not self._batch:
+            return
+
+        if self._transport is None:
+            raise ValueError("DMD is not connected. Use initialize() to connect to it.")
+
+        if check_errors:
+            self._batch[self._batch_last_command] |= 0x40
+            self._transport.clear()
+
+        self._transport.write_packets(self._batch)
+        self._batch = bytearray()
+
+        if check_errors:
+            buffer = self._transport.read(timeout)
+            if buffer is None or self.decode_response(buffer)['error']:
+                print(self.read_error_description())
+
+    def _check_response(self,
+                        buffer):
+        """
+        Print the error description if the response to a command has the error flag set. Commands queued by
+        batch() have no response, they are checked when the batch is sent
+
+        :param buffer: response, as returned by send_command()
+        """
+        if buffer == [] and self._batch is not None:
+            return
+
+        resp = self.decode_response(buffer)
+        if resp['error']:
+            print(self.read_error_description())
+
     @staticmethod
     def decode_command(buffer,
                        is_first_packet: bool = True):
@@ -1594,10 +3170,11 @@ class dlpc900_dmd:
         return self.send_command('w', True, cmd, data=data)
 
     def _pattern_bmp_load(self,
-                          compressed_pattern: list,
+                          compressed_pattern: bytes,
                           compression_mode: str,
                           pattern_index: int = 0,
-                          primary_controller: bool = True):
+                          primary_controller: bool = True,
+                          validate: bool = False):
         """
         Load DMD pattern data for use in pattern on-the-fly mode. To load all necessary data to DMD correctly,
         invoke this from upload_pattern_sequence()
@@ -1609,47 +3186,44 @@ class dlpc900_dmd:
         since the header is 6 bytes and the length of the data is represented using 2 bytes, there are 504 data bytes
         After this, have to send a new command.
 
-        :param compressed_pattern:
+        :param compressed_pattern: bytes-like object, as returned by encode_erle() or encode_rle(), or a contiguous
+          uint8 array such as one part from encode_raw_parts()
         :param compression_mode:
         :param primary_controller: whether to send command to primary or secondary controller.
           Not all DMD models have a secondary controller.
+        :param validate: if True, check the pattern with validate_compressed_pattern() before sending anything.
+          This is meant for debugging, as it takes about as long as decoding the pattern
         :return:
         """
 
-        if self.dual_controller:
-            width = self.width // 2
-        else:
-            width = self.width
-
-        # get the header, 48 bytes long
-        # Note: taken directly from sniffer of the TI GUI
-        signature_bytes = [0x53, 0x70, 0x6C, 0x64]
-        width_byte = list(unpack('BB', pack('<H', width)))
-        height_byte = list(unpack('BB', pack('<H', self.height)))
-        # Number of bytes in encoded image_data
-        num_encoded_bytes = list(unpack('BBBB', pack('<I', len(compressed_pattern))))
-        reserved_bytes = [0xFF] * 8  # reserved
-        bg_color_bytes = [0x00] * 4  # BG color BB, GG, RR, 00
+        try:
+            compressed_pattern = memoryview(compressed_pattern).cast("B")
+        except TypeError:
+            compressed_pattern = memoryview(bytes(compressed_pattern))
 
         if compression_mode not in self.compression_modes.keys():
             raise ValueError(f"compression_mode was '{compression_mode:s}', "
                              f"but must be one of {self.compression_modes.keys()}")
-        encoding_byte = [self.compression_modes[compression_mode]]
 
-        general_data = signature_bytes + width_byte + height_byte + num_encoded_bytes + \
-                       reserved_bytes + bg_color_bytes + [0x01] + encoding_byte + \
-                       [0x01] + [0x00] * 2 + [0x01] + [0x00] * 18  # reserved
+        # the header only depends on the geometry and compression mode, apart from the number of encoded bytes
+        general_data = bytearray(_pattern_header(self.pattern_width,
+                                                 self.height,
+                                                 self.compression_modes[compression_mode]))
+        pack_into('<I', general_data, 8, len(compressed_pattern))
+
+        if validate:
+            validate_compressed_pattern(compressed_pattern,
+                                        compression_mode,
+                                        (self.height, self.pattern_width),
+                                        header=general_data)
 
-        data = general_data + compressed_pattern
+        data_len = len(general_data) + len(compressed_pattern)
 
         # call init before loading pattern
-        # todo: check len(data) = len(compressed_pattern) + 48 and replace in command
-        buffer = self._init_pattern_bmp_load(len(compressed_pattern) + 48,
+        buffer = self._init_pattern_bmp_load(data_len,
                                              pattern_index=pattern_index,
                                              primary_controller=primary_controller)
-        resp = self.decode_response(buffer)
-        if resp['error']:
-            print(self.read_error_description())
+        self._check_response(buffer)
 
         # send pattern
         if primary_controller:
@@ -1658,21 +3232,155 @@ class dlpc900_dmd:
             cmd = self.command_dict["PATMEM_LOAD_DATA_SECONDARY"]
 
         # send multiple commands, each of maximum size 512 bytes including header
-        data_index = 0
-        command_index = 0
-        while data_index < len(data):
-            # slice data to get block to send in this command
-            data_index_next = np.min([data_index + self._max_cmd_payload, len(data)])
-            data_current = data[data_index:data_index_next]
-
+        for data_current in _patmem_blocks(general_data, compressed_pattern, self._max_cmd_payload):
             # len of current data block
-            data_len_bytes = list(unpack('BB', pack('<H', len(data_current))))
+            data_len_bytes = pack('<H', len(data_current))
 
             # send command
             self.send_command('w', False, cmd, data=data_len_bytes + data_current)
 
-            data_index = data_index_next
-            command_index += 1
+    def _pattern_transfer_size(self,
+                               nbytes: int) -> (int, int):
+        """
+        Number of commands and USB packets needed to send a compressed pattern with _pattern_bmp_load()
+
+        :param nbytes: size of the compressed pattern, not including the header
+        :return ncommands, npackets: number of PATMEM_LOAD_DATA commands, and number of packets sent including the
+          packet of the PATMEM_LOAD_INIT command
+        """
+        header_len = 48
+        # each command has 6 header bytes and 2 bytes giving the length of its data
+        command_overhead = 8
+
+        data_len = header_len + nbytes
+        nfull, remainder = divmod(data_len, self._max_cmd_payload)
+        packets_full = -(-(self._max_cmd_payload + command_overhead) // self._packet_length_bytes)
+        packets_last = -(-(remainder + command_overhead) // self._packet_length_bytes) if remainder > 0 else 0
+        # the init command has 6 header bytes, and 6 bytes giving the pattern index and length
+        packets_init = -(-12 // self._packet_length_bytes)
+
+        return nfull + (remainder > 0), packets_init + nfull * packets_full + packets_last
+
+    def get_transfer_statistics(self,
+                                patterns: np.ndarray,
+                                compression_mode: str = 'erle',
+                                bit_depth: int = 1,
+                                exact: bool = False,
+                                nsample_rows: int = 64) -> dict:
+        """
+        Predict how much data upload_pattern_sequence() sends for each combined 24 bit image, and for each half of
+        it for dual controller DMD's. By default, the compressed sizes are estimated from a sample of rows
+        with estimate_compressed_size(), which is much faster than compressing the patterns.
+
+        This can be used to decide if patterns should be uploaded on-the-fly or pre-stored, or where to split long
+        sequences.
+
+        :param patterns: N x Ny x Nx NumPy array of uint8, as passed to upload_pattern_sequence()
+        :param compression_mode: 'erle', 'rle', 'none', or 'auto'
+        :param bit_depth: bit depth of patterns. Only 1 is supported, as for upload_pattern_sequence()
+        :param exact: if True, compress the patterns to get the exact sizes instead of estimating them
+        :param nsample_rows: number of rows used to estimate the sizes, see estimate_compressed_size()
+        :return statistics: dictionary with entries "compression_mode", "nbytes", "compression_ratio",
+          "ncommands", and "npackets", which are arrays of size ncombined x nparts. "nbytes" is the size of the
+          compressed pattern, "compression_ratio" is the size of the uncompressed 24 bit pattern divided by
+          "nbytes", "ncommands" is the number of PATMEM_LOAD_DATA commands and "npackets" the number of 64 byte USB
+          packets sent, see _pattern_transfer_size(). Entries "total_bytes", "total_commands", and
+          "total_packets" give the sums over all patterns.
+        """
+
+        if patterns.ndim == 2:
+            patterns = np.expand_dims(patterns, axis=0)
+
+        if bit_depth != 1:
+            raise NotImplementedError("Combining multiple images into a 24-bit RGB image is only"
+                                      " implemented for bit depth 1.")
+
+        if compression_mode not in self.compression_modes.keys() and compression_mode != 'auto':
+            raise ValueError(f"compression mode was '{compression_mode:s}', "
+                             f"but must be 'auto' or one of {self.compression_modes.keys()}")
+
+        combined_patterns = pack_patterns(patterns)
+        nsplit = 2 if self.dual_controller else 1
+
+        shape = (len(combined_patterns), nsplit)
+        modes = np.empty(shape, dtype=object)
+        nbytes = np.zeros(shape, dtype=int)
+        nbytes_raw = np.zeros(shape, dtype=int)
+        for ii, pattern in enumerate(combined_patterns):
+            if exact:
+                part_modes, compressed_parts = compress_pattern_parts(pattern, nsplit, compression_mode)
+                modes[ii] = part_modes
+                nbytes[ii] = [len(c) for c in compressed_parts]
+
+            for jj, part in enumerate(np.array_split(pattern, nsplit, axis=-1)):
+                nbytes_raw[ii, jj] = 3 * part.size
+                if exact:
+                    continue
+
+                if compression_mode == 'auto':
+                    modes[ii, jj] = select_compression_mode(part, nsample_rows=nsample_rows)
+                else:
+                    modes[ii, jj] = compression_mode
+                nbytes[ii, jj] = estimate_compressed_size(part, modes[ii, jj], nsample_rows=nsample_rows)
+
+        transfer_sizes = np.array([self._pattern_transfer_size(n) for n in nbytes.ravel()], dtype=int)
+        ncommands = transfer_sizes[:, 0].reshape(shape)
+        npackets = transfer_sizes[:, 1].reshape(shape)
+
+        return {"compression_mode": modes,
+                "nbytes": nbytes,
+                "compression_ratio": nbytes_raw / nbytes,
+                "ncommands": ncommands,
+                "npackets": npackets,
+                "total_bytes": int(np.sum(nbytes)),
+                "total_commands": int(np.sum(ncommands)),
+                "total_packets": int(np.sum(npackets))
+                }
+
+    def benchmark_transport(self,
+                            nrepeats: int = 10,
+                            upload: bool = False) -> dict:
+        """
+        Time USB communication with the DMD, to compare transports. Round trips are measured with
+        get_hw_status(). If upload is True, also time uploading 24 uncompressed patterns with
+        upload_pattern_sequence(), which is dominated by the time to write packets. The patterns are encoded before
+        the timing starts, so only the transfer is measured. Note that this replaces the on-the-fly patterns.
+
+        :param nrepeats: number of times to repeat each measurement
+        :param upload: whether to time uploading patterns
+        :return results: dictionary with entries "transport", "round_trip_times" in seconds, "round_trip_mean",
+          and if upload is True "upload_times" in seconds and "upload_bytes_per_s"
+        """
+
+        debug = self.debug
+        self.debug = False
+        try:
+            round_trip_times = np.zeros(nrepeats)
+            for ii in range(nrepeats):
+                tstart = time.perf_counter()
+                self.get_hw_status()
+                round_trip_times[ii] = time.perf_counter() - tstart
+
+            results = {"transport": type(self._transport).__name__,
+                       "round_trip_times": round_trip_times,
+                       "round_trip_mean": float(np.mean(round_trip_times))}
+
+            if upload:
+                patterns = encoded_pattern_set.from_patterns(np.zeros((24, self.height, self.width), dtype=bool),
+                                                             compression_mode='none',
+                                                             nsplit=2 if self.dual_controller else 1)
+                upload_times = np.zeros(nrepeats)
+                for ii in range(nrepeats):
+                    tstart = time.perf_counter()
+                    self.upload_pattern_sequence(patterns, exp_times=self.min_time_us)
+                    upload_times[ii] = time.perf_counter() - tstart
+
+                results["upload_times"] = upload_times
+                results["upload_bytes_per_s"] = float(patterns.nbytes / np.mean(upload_times))
+        finally:
+            self.debug = debug
+
+        return results
 
     def upload_pattern_sequence(self,
                                 patterns: np.ndarray,
@@ -1682,7 +3390,11 @@ class dlpc900_dmd:
                                 clear_pattern_after_trigger: bool = True,
                                 bit_depth: int = 1,
                                 num_repeats: int = 0,
-                                compression_mode: str = 'erle'):
+                                compression_mode: str = 'erle',
+                                optimal_encoding: bool = False,
+                                encode_workers: int = 1,
+                                validate: bool = False,
+                                encode_threads: int = 1):
         """
         Upload on-the-fly pattern sequence to DMD. This command is based on Table 5-3 in the DLP programming manual.
         After loading patterns, the pattern sequence can be configured with set_pattern_sequence(). If you wish to 
@@ -1699,7 +3411,10 @@ class dlpc900_dmd:
         Advance trigger before it will respond to a rising edge (assuming the advance trigger is set to rising
         edge mode). So it is best practice to keep the advance trigger in the HIGH state when programming the DMD.
 
-        :param patterns: N x Ny x Nx NumPy array of uint8
+        :param patterns: N x Ny x Nx NumPy array of uint8 or bool. Patterns which were already compressed can
+          be passed as an encoded_pattern_set, which is sent as it is, so compression_mode and the encoding
+          options are not used. Firmware patterns stored compressed with save_config_file() can be read as an
+          encoded_pattern_set with read_encoded_patterns()
         :param exp_times: exposure times in us. Either a uint8, or a sequence the same
           length as the number of patterns. Must be >= self.minimum_time_us
         :param dark_times: dark times in us. Either a uint8, or a sequence the same length as the number of patterns
@@ -1708,18 +3423,32 @@ class dlpc900_dmd:
           while awaiting the next trigger. If False, after exp_time keep displaying the current pattern.
         :param bit_depth: bit depth of patterns
         :param num_repeats: Number of repeats. 0 means infinite.
-        :param compression_mode: 'erle', 'rle', or 'none'
+        :param compression_mode: 'erle', 'rle', 'none', or 'auto'. With 'auto', each pattern (and each half for
+          the DLP9000) is sent in the mode giving the fewest bytes, based on estimate_compressed_size()
+        :param optimal_encoding: if True, use the slower encoding which produces the fewest bytes. This is meant
+          for patterns compressed ahead of time, see encode_erle()
+        :param encode_workers: number of processes used to compress patterns. If > 1, all patterns are compressed
+          in a process pool while they are uploaded. See compress_patterns()
+        :param validate: if True, check each compressed pattern with validate_compressed_pattern() before it is
+          sent, so a malformed pattern raises an error instead of being uploaded. This is meant for debugging, as
+          it takes about as long as decoding each pattern
+        :param encode_threads: if encode_workers is 1, number of threads used to compress each pattern, see
+          encode_erle_split(). It is meant to reduce the time until the first pattern is sent, which matters most
+          when uploading a single pattern at a time
         """
         # #########################
         # check arguments
         # #########################
-        if patterns.dtype != np.uint8:
-            raise ValueError('patterns must be of dtype uint8')
+        if isinstance(patterns, encoded_pattern_set):
+            npatterns = patterns.npatterns
+        else:
+            if patterns.dtype != np.uint8 and patterns.dtype != bool:
+                raise ValueError('patterns must be of dtype uint8 or bool')
 
-        if patterns.ndim == 2:
-            patterns = np.expand_dims(patterns, axis=0)
+            if patterns.ndim == 2:
+                patterns = np.expand_dims(patterns, axis=0)
 
-        npatterns = len(patterns)
+            npatterns = len(patterns)
 
         if exp_times is None:
             exp_times = self.min_time_us
@@ -1731,8 +3460,8 @@ class dlpc900_dmd:
         if not all(list(map(lambda t: isinstance(t, int), exp_times))):
             raise ValueError("exp_times must be a list of integers")
 
-        if patterns.shape[0] > 1 and len(exp_times) == 1:
-            exp_times = exp_times * patterns.shape[0]
+        if npatterns > 1 and len(exp_times) == 1:
+            exp_times = exp_times * npatterns
 
         # if only one dark_times, apply to all patterns
         if isinstance(dark_times, int):
@@ -1741,27 +3470,17 @@ class dlpc900_dmd:
         if not all(list(map(lambda t: isinstance(t, int), dark_times))):
             raise ValueError("dark_times must be a list of integers")
 
-        if patterns.shape[0] > 1 and len(dark_times) == 1:
-            dark_times = dark_times * patterns.shape[0]
+        if npatterns > 1 and len(dark_times) == 1:
+            dark_times = dark_times * npatterns
 
-        if compression_mode not in self.compression_modes.keys():
+        if compression_mode not in self.compression_modes.keys() and compression_mode != 'auto':
             raise ValueError(f"compression mode was '{compression_mode:s}', "
-                             f"but must be one of {self.compression_modes.keys()}")
-
-        if compression_mode != "erle":
-            raise NotImplementedError("Currently only `erle` compression is implemented")
-
-        if compression_mode == 'none':
-            def compression_fn(p): return np.packbits(p.ravel())
-        elif compression_mode == 'rle':
-            compression_fn = encode_rle
-        elif compression_mode == 'erle':
-            compression_fn = encode_erle
+                             f"but must be 'auto' or one of {self.compression_modes.keys()}")
 
         # #########################
         # #########################
         # store patterns so we can check what is uploaded later
-        self.on_the_fly_patterns = patterns
+        self._on_the_fly_source = patterns
 
         # need to issue stop before changing mode, otherwise DMD will sometimes lock up and not be responsive.
         self.start_stop_sequence('stop')
@@ -1779,55 +3498,77 @@ class dlpc900_dmd:
         # When uploading 1 bit image, each set of 24 images are first combined to a single 24 bit RGB image.
         # pattern_index refers to which 24 bit RGB image a pattern is in, and pattern_bit_index refers to
         # which bit of that image (i.e. in the RGB bytes, it is stored in.
-        for ii, (p, et, dt) in enumerate(zip(patterns, exp_times, dark_times)):
-            pic_ind, bit_ind = self._index_2pic_bit(ii)
-            buffer = self._pattern_display_lut_definition(ii,
-                                                          exposure_time_us=et,
-                                                          dark_time_us=dt,
-                                                          wait_for_trigger=triggered,
-                                                          clear_pattern_after_trigger=clear_pattern_after_trigger,
-                                                          bit_depth=bit_depth,
-                                                          stored_image_index=pic_ind,
-                                                          stored_image_bit_index=bit_ind)
-            resp = self.decode_response(buffer)
-            if resp['error']:
-                print(self.read_error_description())
-
-        buffer = self._pattern_display_lut_configuration(npatterns, num_repeats)
-        resp = self.decode_response(buffer)
-        if resp['error']:
-            print(self.read_error_description())
+        # A selection from an encoded_pattern_set may have images with fewer than 24 patterns before the last,
+        # so its indices are found from the number of patterns in each image
+        if isinstance(patterns, encoded_pattern_set):
+            counts = patterns.pattern_counts
+            pic_inds = np.repeat(np.arange(len(counts)), counts)
+            bit_inds = np.arange(npatterns) - np.repeat(np.cumsum(counts) - counts, counts)
+        else:
+            pic_inds, bit_inds = self._index_2pic_bit(np.arange(npatterns))
+
+        # the LUT entries are sent in one batch, and only the reply to the last command is checked
+        with self.batch(check_errors=True):
+            for ii, et, dt, pic_ind, bit_ind in zip(range(npatterns), exp_times, dark_times, pic_inds, bit_inds):
+                buffer = self._pattern_display_lut_definition(ii,
+                                                              exposure_time_us=et,
+                                                              dark_time_us=dt,
+                                                              wait_for_trigger=triggered,
+                                                              clear_pattern_after_trigger=clear_pattern_after_trigger,
+                                                              bit_depth=bit_depth,
+                                                              stored_image_index=int(pic_ind),
+                                                              stored_image_bit_index=int(bit_ind))
+                self._check_response(buffer)
+
+            buffer = self._pattern_display_lut_configuration(npatterns, num_repeats)
+            self._check_response(buffer)
 
         # can combine images if bit depth = 1
-        if bit_depth == 1:
-            patterns = combine_patterns(patterns)
-        else:
+        if bit_depth != 1:
             raise NotImplementedError("Combining multiple images into a 24-bit RGB image is only"
                                       " implemented for bit depth 1.")
 
         # compress and load images in backwards order
-        for ii, dmd_pattern in reversed(list(enumerate(patterns))):
+        # for the DLP9000, the left and right halves of each image are sent to the primary and secondary controllers
+        nsplit = 2 if self.dual_controller else 1
+        if isinstance(patterns, encoded_pattern_set):
+            ncombined = len(patterns)
+        else:
+            ncombined = int(np.ceil(npatterns / 24))
+        order = range(ncombined - 1, -1, -1)
+        if isinstance(patterns, encoded_pattern_set):
+            # already compressed, the parts are sent straight from the buffer of the set
+            if (patterns.pattern_shape, patterns.nsplit) != ((self.height, self.width), nsplit):
+                raise ValueError(f"patterns were encoded as {patterns.pattern_shape} patterns in {patterns.nsplit:d}"
+                                 f" parts, but this DMD needs {(self.height, self.width)} patterns in {nsplit:d} parts")
+            compressed_patterns = patterns.items(order=order)
+        elif compression_mode == 'none':
+            patterns = pack_patterns(patterns)
+            # uncompressed data needs no encoding, so all parts are sent straight from one array
+            raw_parts = encode_raw_parts(patterns, nsplit)
+            compressed_patterns = ((ii, raw_parts[ii], ['none'] * nsplit) for ii in order)
+        else:
+            patterns = pack_patterns(patterns)
+            compressed_patterns = compress_patterns(patterns,
+                                                    compression_mode,
+                                                    optimal_encoding,
+                                                    nsplit=nsplit,
+                                                    workers=encode_workers,
+                                                    order=order,
+                                                    cache=self.pattern_cache,
+                                                    threads=encode_threads)
+        for ii, compressed_parts, part_compression_modes in compressed_patterns:
             if self.debug:
-                print(f"sending pattern {ii + 1:d}/{len(patterns):d}")
-
-            if self.dual_controller:
-                p0, p1 = np.array_split(dmd_pattern, 2, axis=-1)
-                cp0 = compression_fn(p0)
-                cp1 = compression_fn(p1)
-                self._pattern_bmp_load(cp0,
-                                       compression_mode,
-                                       pattern_index=ii,
-                                       primary_controller=True)
-                self._pattern_bmp_load(cp1,
-                                       compression_mode,
-                                       pattern_index=ii,
-                                       primary_controller=False)
-            else:
-                compressed_pattern = compression_fn(dmd_pattern)
-                self._pattern_bmp_load(compressed_pattern,
-                                       compression_mode,
-                                       pattern_index=ii,
-                                       primary_controller=True)
+                print(f"sending pattern {ii + 1:d}/{ncombined:d}")
+
+            # each pattern is sent as one batch, so patterns are still sent while later ones are being compressed
+            with self.batch(check_errors=True):
+                for jj, (compressed_pattern, mode) in enumerate(zip(compressed_parts, part_compression_modes)):
+                    self._pattern_bmp_load(compressed_pattern,
+                                           mode,
+                                           pattern_index=ii,
+                                           primary_controller=jj == 0,
+                                           validate=validate)
 
         # this command is necessary, otherwise subsequent calls to set_pattern_sequence() will not behave as expected
         buffer = self._pattern_display_lut_configuration(npatterns, num_repeats)
@@ -1923,18 +3664,17 @@ class dlpc900_dmd:
         self.start_stop_sequence('stop')
 
         # set image parameters for look up table_
-        for ii, (et, dt) in enumerate(zip(exp_times, dark_times)):
-            buffer = self._pattern_display_lut_definition(ii,
-                                                          exposure_time_us=et,
-                                                          dark_time_us=dt,
-                                                          wait_for_trigger=triggered,
-                                                          clear_pattern_after_trigger=clear_pattern_after_trigger,
-                                                          bit_depth=bit_depth,
-                                                          stored_image_index=pic_indices[ii],
-                                                          stored_image_bit_index=bit_indices[ii])
-            resp = self.decode_response(buffer)
-            if resp['error']:
-                print(self.read_error_description())
+        with self.batch(check_errors=True):
+            for ii, (et, dt) in enumerate(zip(exp_times, dark_times)):
+                buffer = self._pattern_display_lut_definition(ii,
+                                                              exposure_time_us=et,
+                                                              dark_time_us=dt,
+                                                              wait_for_trigger=triggered,
+                                                              clear_pattern_after_trigger=clear_pattern_after_trigger,
+                                                              bit_depth=bit_depth,
+                                                              stored_image_index=pic_indices[ii],
+                                                              stored_image_bit_index=bit_indices[ii])
+                self._check_response(buffer)
 
         # PAT_CONFIG command
         buffer = self._pattern_display_lut_configuration(nimgs, num_repeat=num_repeats)
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# dmd imports the ERLE encoder from the dlpyc900 package in this repository, which need not be installed
+sys.path.insert(0, str(Path(__file__).parents[2] / "control_dlp" / "dlpyc900"))
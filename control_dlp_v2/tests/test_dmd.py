@@ -0,0 +1,424 @@
+import time
+import numpy as np
+import pytest
+import dmd
+from dlpyc900 import erle
+
+
+def random_patterns(n, ny, nx, density=0.1, seed=0):
+    '''
+    binary patterns with repeated rows and runs, so that every kind of token is used
+    '''
+    rng = np.random.default_rng(seed)
+    patterns = (rng.random((n, ny, nx)) < density).astype(np.uint8)
+    patterns[:, ny // 3:ny // 2] = patterns[:, ny // 3:ny // 3 + 1]
+    patterns[:, :, nx // 4:nx // 2] = 0
+    return patterns
+
+
+@pytest.mark.parametrize('shape', [(40, 256), (7, 3), (1, 300)])
+def test_erle_round_trip(shape):
+    pattern = dmd.combine_patterns(random_patterns(24, *shape))[0]
+    encoded = dmd.encode_erle(pattern)
+    assert isinstance(encoded, bytes)
+    assert np.array_equal(dmd.decode_erle(shape, encoded), pattern)
+
+
+def test_raw_round_trip():
+    pattern = dmd.combine_patterns(random_patterns(20, 30, 64))[0]
+    encoded = dmd.encode_raw(pattern)
+    assert len(encoded) == pattern.size
+    assert np.array_equal(np.moveaxis(np.frombuffer(encoded, dtype=np.uint8).reshape(30, 64, 3), -1, 0), pattern)
+
+
+def test_2d_pattern():
+    pattern = random_patterns(1, 30, 64)[0]
+    rgb = np.zeros((3, 30, 64), dtype=np.uint8)
+    rgb[2] = pattern
+    assert dmd.encode_erle(pattern) == dmd.encode_erle(rgb)
+    assert dmd.encode_raw(pattern) == dmd.encode_raw(rgb)
+
+
+@pytest.mark.parametrize('shape', [(4, 30, 64), (30, 64, 3), (1, 3, 30, 64)])
+def test_rgb_pattern_shape(shape):
+    with pytest.raises(ValueError):
+        dmd.encode_erle(np.zeros(shape, dtype=np.uint8))
+    with pytest.raises(ValueError):
+        dmd._as_rgb_pattern(np.zeros(shape, dtype=np.uint8))
+
+
+def test_erle_matches_driver_encoder():
+    # dmd and the dlpyc900 driver share the tokenizer and emitter, dmd leaves out the end of line tokens
+    patterns = random_patterns(24, 40, 128)
+    image = erle.merge_stack(patterns)[0]
+    body = erle.emit(image, *erle.tokenize(image), eol=False)
+    assert dmd.encode_erle(dmd.combine_patterns(patterns)[0]) == body.tobytes() + b'\x00\x01\x00'
+    encoded, _ = erle.encode(patterns)
+    assert len(encoded) > 48 + len(body) + 3
+
+
+def test_rle_matches_driver_encoder():
+    # both end every row with the end of line bytes, the driver also pads the pattern to a multiple of 4 bytes
+    patterns = random_patterns(24, 40, 600, density=0.002)
+    encoded = dmd.encode_rle(dmd.combine_patterns(patterns)[0])
+    driver, _ = erle.encode_rle(patterns)
+    assert encoded == bytes(driver[48:48 + len(encoded)])
+    assert not any(driver[48 + len(encoded):])
+
+
+def test_rle_round_trip():
+    # runs longer than 255 pixels are split, and rows of single pixels are sent uncompressed
+    patterns = random_patterns(24, 30, 600, density=0.002)
+    patterns[:, 5] = np.arange(600) % 2
+    pattern = dmd.combine_patterns(patterns)[0]
+    encoded = dmd.encode_rle(pattern)
+    dmd.validate_compressed_pattern(encoded, 'rle', (30, 600))
+    assert np.array_equal(dmd.decode_erle((30, 600), encoded, compression_mode='rle'), pattern)
+    assert dmd.estimate_compressed_size(pattern, 'rle') == len(encoded)
+
+
+def test_decode_packed():
+    patterns = random_patterns(30, 20, 64)
+    packed = dmd.pack_patterns(patterns)[1]
+    out = np.zeros(packed.shape, dtype=np.uint32)
+    dmd.decode_erle(packed.shape, dmd.encode_erle(packed), out=out)
+    assert np.array_equal(out, packed)
+
+
+@pytest.mark.parametrize('threads', [1, 3])
+def test_optimal_round_trip(threads):
+    pattern = dmd.combine_patterns(random_patterns(24, 40, 200))[0]
+    encoded = dmd.encode_erle(pattern, optimal=True, threads=threads)
+    assert len(encoded) <= len(dmd.encode_erle(pattern))
+    assert np.array_equal(dmd.decode_erle((40, 200), encoded), pattern)
+
+
+@pytest.mark.parametrize('optimal', [False, True])
+@pytest.mark.parametrize('threads', [2, 7])
+def test_encode_threads(optimal, threads):
+    pattern = dmd.combine_patterns(random_patterns(24, 30, 128, density=0.05))[0]
+    assert (dmd.encode_erle_split(pattern, optimal=optimal, threads=threads) ==
+            dmd.encode_erle_split(pattern, optimal=optimal))
+
+
+@pytest.mark.parametrize('compression_mode', ['erle', 'rle'])
+def test_decode(compression_mode):
+    pattern = dmd.combine_patterns(random_patterns(24, 30, 300, density=0.01))[0]
+    encoded = dmd.compress_pattern(pattern, compression_mode)
+    assert np.array_equal(dmd.decode_erle((30, 300), encoded, compression_mode=compression_mode), pattern)
+    with pytest.raises(ValueError):
+        dmd.decode_erle((30, 300), encoded[:-2], compression_mode=compression_mode)
+
+
+def test_decode_mode():
+    with pytest.raises(ValueError):
+        dmd.decode_erle((1, 4), b'\x04\x00\x00\x00\x00\x01\x00', compression_mode='none')
+
+
+@pytest.mark.parametrize('density', [0.5, 0.01])
+def test_decode_speed(density):
+    # decoding a full DLP6500 frame keeps up with encoding it. The bound is loose, as timings on shared machines vary
+    pattern = dmd.combine_patterns(random_patterns(24, 1080, 1920, density=density))[0]
+
+    def best_time(func, *args):
+        times = []
+        for _ in range(3):
+            start = time.perf_counter()
+            func(*args)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    encoded = dmd.encode_erle(pattern)
+    assert best_time(dmd.decode_erle, (1080, 1920), encoded) < 2 * best_time(dmd.encode_erle, pattern)
+
+
+@pytest.mark.parametrize('compression_mode', ['erle', 'rle'])
+@pytest.mark.parametrize('chunk_size', [1, 7, 1 << 20])
+def test_decode_stream(compression_mode, chunk_size):
+    combined = dmd.combine_patterns(random_patterns(72, 20, 64, density=0.05))
+    stream = b''.join(dmd.compress_pattern(c, compression_mode) for c in combined)
+    chunks = [stream[ii:ii + chunk_size] for ii in range(0, len(stream), chunk_size)]
+    decoded = [p.copy() for p in dmd.decode_erle_stream((20, 64), chunks, compression_mode=compression_mode)]
+    assert np.array_equal(np.stack(decoded), combined)
+
+    with pytest.raises(ValueError):
+        list(dmd.decode_erle_stream((20, 64), [stream[:-1]], compression_mode=compression_mode))
+
+
+def test_split_combined_patterns():
+    patterns = random_patterns(40, 12, 16)
+    combined = dmd.combine_patterns(patterns)
+    expected = np.zeros((48, 12, 16), dtype=np.uint8)
+    expected[:40] = patterns
+    assert np.array_equal(dmd.split_combined_patterns(combined), expected)
+    assert np.array_equal(dmd.split_combined_patterns(combined[1]), expected[24:])
+    assert np.array_equal(dmd.split_combined_patterns(dmd.pack_patterns(patterns)), expected)
+
+    out = np.empty_like(expected)
+    assert dmd.split_combined_patterns(combined, out=out) is out
+    assert np.array_equal(out, expected)
+    with pytest.raises(ValueError):
+        dmd.split_combined_patterns(combined, out=out[:24])
+
+
+def test_combined_pattern_view():
+    patterns = random_patterns(40, 12, 16)
+    view = dmd.split_combined_patterns(dmd.combine_patterns(patterns), lazy=True)
+    assert isinstance(view, dmd.combined_pattern_view)
+    assert len(view) == 48
+    assert np.array_equal(view[3], patterns[3])
+    assert np.array_equal(view[-9], patterns[39])
+    assert np.array_equal(view[30:40], patterns[30:40])
+    assert not np.any(view[40:])
+    assert np.array_equal(np.asarray(view)[:40], patterns)
+    with pytest.raises(IndexError):
+        view[48]
+    with pytest.raises(ValueError):
+        dmd.split_combined_patterns(dmd.combine_patterns(patterns), out=np.empty((48, 12, 16)), lazy=True)
+
+
+@pytest.mark.parametrize('compression_mode', ['erle', 'auto'])
+def test_compress_patterns_pool(compression_mode):
+    combined = dmd.pack_patterns(random_patterns(24 * 5, 16, 64))
+    expected = list(dmd.compress_patterns(combined, compression_mode, nsplit=2))
+    order = [3, 0, 4, 1, 2]
+    results = list(dmd.compress_patterns(combined, compression_mode, nsplit=2, workers=2, order=order))
+    assert [r[0] for r in results] == order
+    for ii, parts, modes in results:
+        assert parts == expected[ii][1]
+        assert modes == expected[ii][2]
+
+    # the pool is kept between calls, and closing the generator early leaves it usable
+    pool = dmd._compress_pool
+    patterns = dmd.compress_patterns(combined, compression_mode, nsplit=2, workers=2)
+    next(patterns)
+    patterns.close()
+    assert list(dmd.compress_patterns(combined, compression_mode, nsplit=2, workers=2))[-1][1] == expected[-1][1]
+    assert dmd._compress_pool is pool
+
+
+def test_compress_patterns_cache(tmp_path):
+    combined = dmd.pack_patterns(random_patterns(48, 16, 64))
+    cache = dmd.encoded_pattern_cache(tmp_path)
+    expected = list(dmd.compress_patterns(combined, 'erle', nsplit=2))
+    assert list(dmd.compress_patterns(combined, 'erle', nsplit=2, cache=cache)) == expected
+    assert len(list(tmp_path.glob('*.bin'))) == 4
+    assert cache.total_bytes == sum(f.stat().st_size for f in tmp_path.glob('*.bin'))
+    assert list(dmd.compress_patterns(combined, 'erle', nsplit=2, cache=cache)) == expected
+
+
+def test_auto_mode():
+    rng = np.random.default_rng(0)
+    patterns = np.zeros((24, 32, 128), dtype=np.uint8)
+    patterns[:, :, :64] = rng.random((24, 32, 64)) < 0.5
+    packed = dmd.pack_patterns(patterns)[0]
+    modes, parts = dmd.compress_pattern_parts(packed, nsplit=2, compression_mode='auto')
+    assert modes[0] == 'none' and modes[1] == 'erle'
+
+    halves = dmd.combine_patterns(patterns)[0].reshape(3, 32, 2, 64)
+    assert parts[0] == dmd.encode_raw(np.ascontiguousarray(halves[:, :, 0]))
+    assert np.array_equal(dmd.decode_erle((32, 64), parts[1]), halves[:, :, 1])
+    for m in dmd._compression_mode_names:
+        assert len(parts[1]) <= len(dmd.compress_pattern(np.ascontiguousarray(halves[:, :, 1]), m))
+
+
+def test_cache_key_version():
+    pattern_hash = dmd.encoded_pattern_cache.hash_pattern(np.zeros((2, 2), dtype=np.uint32))
+    key = dmd.encoded_pattern_cache.key(pattern_hash, 0, 1, 'auto', False)
+
+    class old_cache(dmd.encoded_pattern_cache):
+        format_version = 1
+
+    assert old_cache.key(pattern_hash, 0, 1, 'auto', False) != key
+
+
+@pytest.mark.parametrize('compression_mode', ['erle', 'rle', 'none'])
+def test_validate_compressed_pattern(compression_mode):
+    pattern = dmd.combine_patterns(random_patterns(24, 20, 64))[0]
+    encoded = dmd.compress_pattern(pattern, compression_mode)
+    dmd.validate_compressed_pattern(encoded, compression_mode, (20, 64))
+    for bad in [encoded[:-1], encoded + b'\x01', encoded[:5] + encoded[6:]]:
+        with pytest.raises(ValueError):
+            dmd.validate_compressed_pattern(bad, compression_mode, (20, 64))
+    with pytest.raises(ValueError):
+        dmd.validate_compressed_pattern(encoded, compression_mode, (21, 64))
+
+
+def command_packets(packets):
+    """
+    split the packets recorded by fake_transport into commands, giving (command number, number of packets, data)
+    """
+    commands = []
+    ii = 0
+    while ii < len(packets):
+        data_len = int.from_bytes(packets[ii][2:4], 'little')
+        npackets = -(-(4 + data_len) // len(packets[ii]))
+        command = b''.join(packets[ii:ii + npackets])
+        commands.append((int.from_bytes(command[4:6], 'little'), npackets, command[6:4 + data_len]))
+        ii += npackets
+    return commands
+
+
+@pytest.mark.parametrize('cls', [dmd.dlp6500, dmd.dlp9000])
+@pytest.mark.parametrize('compression_mode', ['erle', 'rle', 'none', 'auto'])
+def test_transfer_statistics(cls, compression_mode):
+    d = cls(transport='fake', debug=False)
+    patterns = random_patterns(30, d.height, d.width, density=0.01)
+    stats = d.get_transfer_statistics(patterns, compression_mode=compression_mode, exact=True)
+
+    d._transport.packets.clear()
+    d.upload_pattern_sequence(patterns, exp_times=d.min_time_us, compression_mode=compression_mode)
+    commands = command_packets(d._transport.packets)
+    d.close()
+
+    init = {d.command_dict['PATMEM_LOAD_INIT_MASTER'], d.command_dict['PATMEM_LOAD_INIT_SECONDARY']}
+    data = {d.command_dict['PATMEM_LOAD_DATA_MASTER'], d.command_dict['PATMEM_LOAD_DATA_SECONDARY']}
+    assert sum(1 for c, _, _ in commands if c in data) == stats['total_commands']
+    assert sum(n for c, n, _ in commands if c in init | data) == stats['total_packets']
+    assert sum(1 for c, _, _ in commands if c in init) == stats['ncommands'].size
+
+
+def test_encoded_pattern_set_zarr(tmp_path):
+    patterns = random_patterns(30, 20, 64)
+    fname = tmp_path / "config.zarr"
+    dmd.save_config_file(fname, [{}] * 30, firmware_patterns=patterns, erle_nsplit=2)
+    _, _, firmware_patterns, _, _ = dmd.load_config_file(fname)
+    assert np.array_equal(firmware_patterns[:], patterns)
+
+    # the patterns are stored once, as ERLE data, and read without decoding them
+    assert isinstance(firmware_patterns.compressors[0], dmd.erle_codec)
+    encoded = dmd.read_encoded_patterns(fname)
+    expected = dmd.encoded_pattern_set.from_patterns(patterns, 'erle', nsplit=2)
+    assert [list(map(bytes, p)) for _, p, _ in encoded.items()] == [list(map(bytes, p)) for _, p, _ in expected.items()]
+    assert encoded.pattern_shape == (20, 64)
+    assert np.array_equal(encoded.decode(), patterns)
+
+    dmd.save_config_file(fname, [{}] * 30, firmware_patterns=patterns)
+    with pytest.raises(ValueError):
+        dmd.read_encoded_patterns(fname)
+
+
+@pytest.mark.parametrize('compression_mode', ['erle', 'rle', 'none'])
+def test_on_the_fly_patterns(compression_mode):
+    d = dmd.dlp6500(transport='fake', debug=False)
+    patterns = random_patterns(30, d.height, d.width, density=0.01)
+    encoded = dmd.encoded_pattern_set.from_patterns(patterns, compression_mode)
+    d.upload_pattern_sequence(encoded, exp_times=d.min_time_us)
+    assert np.array_equal(d.on_the_fly_patterns, patterns)
+    d.upload_pattern_sequence(patterns[:3], exp_times=d.min_time_us)
+    assert np.array_equal(d.on_the_fly_patterns, patterns[:3])
+    d.close()
+
+
+def test_pack_patterns():
+    # packing directly gives the same as combining and then packing, also for a partly filled last group
+    patterns = random_patterns(30, 12, 16)
+    packed = dmd.pack_patterns(patterns)
+    assert packed.dtype == np.dtype('<u4')
+    assert np.array_equal(packed, dmd._pack_rgb(np.moveaxis(dmd.combine_patterns(patterns), 0, 1)))
+    for combined, packed_pattern in zip(dmd.combine_patterns(patterns), packed):
+        assert np.array_equal(packed_pattern, dmd._pack_rgb(combined))
+        for compression_mode in ['erle', 'rle', 'none']:
+            assert (dmd.compress_pattern(packed_pattern, compression_mode) ==
+                    dmd.compress_pattern(combined, compression_mode))
+            assert (dmd.estimate_compressed_size(packed_pattern, compression_mode, nsample_rows=2) ==
+                    dmd.estimate_compressed_size(combined, compression_mode, nsample_rows=2))
+
+
+@pytest.mark.parametrize('compression_mode', ['erle', 'rle', 'none'])
+def test_upload_decodes(compression_mode):
+    # the pattern data sent to the DMD decodes back to the patterns
+    d = dmd.dlp6500(transport='fake', debug=False)
+    ny, nx = d.height, d.width
+    patterns = random_patterns(30, ny, nx, density=0.01)
+    d._transport.packets.clear()
+    d.upload_pattern_sequence(patterns, exp_times=d.min_time_us, compression_mode=compression_mode)
+    commands = command_packets(d._transport.packets)
+    d.close()
+
+    uploaded = {}
+    for command, _, data in commands:
+        if command == d.command_dict['PATMEM_LOAD_INIT_MASTER']:
+            index = int.from_bytes(data[:2], 'little')
+            uploaded[index] = b''
+        elif command == d.command_dict['PATMEM_LOAD_DATA_MASTER']:
+            assert int.from_bytes(data[:2], 'little') == len(data) - 2
+            uploaded[index] += data[2:]
+    assert sorted(uploaded) == [0, 1]
+
+    combined = np.zeros((2, 3, ny, nx), dtype=np.uint8)
+    for index, pattern_data in uploaded.items():
+        header, compressed = pattern_data[:48], pattern_data[48:]
+        assert int.from_bytes(header[8:12], 'little') == len(compressed)
+        assert header[25] == d.compression_modes[compression_mode]
+        if compression_mode == 'none':
+            combined[index] = np.moveaxis(np.frombuffer(compressed, dtype=np.uint8).reshape(ny, nx, 3), -1, 0)
+        else:
+            dmd.decode_erle((ny, nx), compressed, out=combined[index], compression_mode=compression_mode)
+    assert np.array_equal(dmd.split_combined_patterns(combined)[:30], patterns)
+
+
+def test_upload_pattern_set_lut():
+    # reversing a set gives images with 6 and then 24 patterns, so the LUT cannot assume 24 patterns per image
+    d = dmd.dlp6500(transport='fake', debug=False)
+    patterns = random_patterns(30, d.height, d.width, density=0.01)
+    encoded = dmd.encoded_pattern_set.from_patterns(patterns)[::-1]
+    d._transport.packets.clear()
+    d.upload_pattern_sequence(encoded, exp_times=d.min_time_us)
+    commands = command_packets(d._transport.packets)
+    d.close()
+
+    lut = [(data[10], data[11] // 8) for c, _, data in commands if c == d.command_dict['MBOX_DATA']]
+    assert lut == [(0, b) for b in range(6)] + [(1, b) for b in range(24)]
+    assert np.array_equal(d.on_the_fly_patterns, np.concatenate((patterns[24:], patterns[:24])))
+
+
+def test_send_command():
+    # both drivers frame commands with pack_command(), and a reply is returned for the last packet
+    transport = dmd.fake_transport(responder=lambda command, data: [command & 0xff, len(data)])
+    d = dmd.dlp6500(transport=transport, debug=False)
+    transport.packets.clear()
+    reply = d.send_command('r', True, 0x1A34, data=bytes(range(70)), sequence_byte=5)
+    assert b''.join(transport.packets) == dmd.pack_command(0xc0, 5, 0x1A34, bytes(range(70)))
+    assert reply == [0xc0, 5, 2, 0, 0x34, 70]
+    d.close()
+
+
+@pytest.mark.parametrize('check_errors', [False, True])
+def test_batch_flush(check_errors):
+    # a command which is not queued sends the queue first, asking for a reply to its last command as the batch does
+    d = dmd.dlp6500(transport='fake', debug=False)
+    d._transport.packets.clear()
+    with d.batch(check_errors=check_errors):
+        for ii in range(3):
+            d._pattern_display_lut_definition(ii)
+        assert d._transport.packets == []
+        d.get_hw_status()
+        d._pattern_display_lut_definition(3)
+        assert len(d._transport.packets) == 4
+
+    flags = [p[0] for p in d._transport.packets]
+    commands = [c for c, _, _ in command_packets(d._transport.packets)]
+    mbox = d.command_dict['MBOX_DATA']
+    reply = 0x40 if check_errors else 0
+    assert commands[:4] == [mbox] * 3 + [d.command_dict['Get_Hardware_Status']]
+    assert flags[:4] == [0, 0, reply, 0xc0]
+    # the fake replies have no error flag, so no error description is read
+    assert commands[4:] == [mbox]
+    assert flags[4:] == [reply]
+    d.close()
+
+
+def test_batch_exception():
+    # commands still queued when the block raises are dropped
+    d = dmd.dlp6500(transport='fake', debug=False)
+    d._transport.packets.clear()
+    with pytest.raises(RuntimeError):
+        with d.batch(check_errors=True):
+            d._pattern_display_lut_definition(0)
+            raise RuntimeError()
+    assert d._transport.packets == []
+    assert d._batch is None
+    d._pattern_display_lut_definition(0)
+    assert len(d._transport.packets) == 1
+    d.close()